@@ -2,14 +2,17 @@ import events
 import io
 import json
 import os
+import time
 
 from format import (
-    converter_path, get_validator_analysis, Validator)
+    conv_graph, converter_edges, get_analysis_function, get_validator_analysis,
+    payload_size, record_converter_time, Validator)
 
 from executors.python import run as python_run
 from executors.workflow import run as workflow_run
+from multiprocessing.pool import ThreadPool
 from networkx import NetworkXNoPath
-from . import utils
+from . import cache, utils
 
 from girder_worker import config, PACKAGE_DIR
 
@@ -109,7 +112,16 @@ def isvalid(type, binding, fetch=True, **kwargs):
     :returns: ``True`` if the binding matches the type and format,
         ``False`` otherwise.
     """
-    analysis = get_validator_analysis(Validator(type, binding['format']))
+    validator = Validator(type, binding['format'])
+    analysis = get_validator_analysis(validator)
+    fn = get_analysis_function(validator)
+
+    if fn is not None and _can_call_directly(binding, fetch, **kwargs):
+        if fetch:
+            binding['data'] = io.fetch(
+                binding, **dict({'task_input': fn.input}, **kwargs))
+        return fn(binding['data'], **kwargs)
+
     outputs = run(analysis, {'input': binding},
                   auto_convert=False,
                   validate=False, fetch=fetch, **kwargs)
@@ -149,20 +161,48 @@ def convert(type, input, output, fetch=True, status=None, **kwargs):
     else:
         data_descriptor = input
         try:
-            conversion_path = converter_path(Validator(type, input['format']),
-                                             Validator(type, output['format']))
+            conversion_edges = converter_edges(
+                Validator(type, input['format']),
+                Validator(type, output['format']),
+                size=payload_size(input.get('data')))
         except NetworkXNoPath:
             raise Exception('No conversion path from %s/%s to %s/%s' %
                             (type, input['format'], type, output['format']))
 
-        # Run data_descriptor through each conversion in the path
-        for conversion in conversion_path:
-            result = run(conversion, {'input': data_descriptor},
-                         auto_convert=False, status=status,
-                         **kwargs)
-            data_descriptor = result['output']
+        cache_key = _conversion_cache_key(
+            type, input, output, conversion_edges, **kwargs)
+        if cache_key is not None:
+            found, data = cache.conversion_cache.get(cache_key)
+            if found:
+                conversion_edges = []  # No need to run any conversions
+                data_descriptor = {'format': output['format'], 'data': data}
+
+        # Run data_descriptor through each conversion in the path. The last
+        # converter is given the output binding, e.g. to know where to write
+        # data that stays outside of the worker process.
+        for i, (source, target) in enumerate(conversion_edges):
+            size = payload_size(data_descriptor.get('data'))
+            start = time.time()
+            fn = get_analysis_function(source, target)
+            if fn is not None and 'data' in data_descriptor and \
+                    _can_call_directly(data_descriptor, False, **kwargs):
+                data_descriptor = _call_converter(
+                    fn, data_descriptor, validate=data_descriptor is input,
+                    status=status, **kwargs)
+            else:
+                run_kwargs = kwargs
+                if i == len(conversion_edges) - 1:
+                    run_kwargs = dict(kwargs, _output_binding=output)
+                result = run(conv_graph.edge[source][target],
+                             {'input': data_descriptor}, auto_convert=False,
+                             status=status, **run_kwargs)
+                data_descriptor = result['output']
+            record_converter_time(source, target, time.time() - start, size)
         data = data_descriptor['data']
 
+        if cache_key is not None and conversion_edges:
+            cache.conversion_cache.put(cache_key, data)
+
     if status == utils.JobStatus.CONVERTING_OUTPUT:
         job_mgr = kwargs.get('_job_manager')
         _job_status(job_mgr, utils.JobStatus.PUSHING_OUTPUT)
@@ -175,6 +215,111 @@ def _job_status(mgr, status):
         mgr.updateStatus(status)
 
 
+def _conversion_cache_key(type, input, output, conversion_edges, **kwargs):
+    """
+    Return the conversion cache key for converting the given input, or
+    ``None`` if the conversion cache is disabled or can not be used for it.
+    """
+    if cache.conversion_cache is None or 'data' not in input:
+        return None
+
+    # File paths are not content-addressable
+    for spec in (kwargs.get('task_input'), kwargs.get('task_output')):
+        if spec and spec.get('target') == 'filepath':
+            return None
+
+    for source, target in conversion_edges:
+        if not conv_graph.edge[source][target].get('cacheable', True):
+            return None
+
+    return cache.ConversionCache.key(
+        type, input['format'], output['format'], input['data'])
+
+
+def _can_call_directly(binding, fetch, **kwargs):
+    """
+    Whether a validator or converter with an AnalysisFunction can be called
+    in-process for the given binding rather than via a nested :py:func:`run`.
+    """
+    if kwargs.get('write_script'):
+        return False  # debugging requires every script to be written to file
+    if fetch and '_tempdir' not in kwargs:
+        # Only inline data can be fetched without a temp directory
+        return 'url' not in binding and binding.get(
+            'mode', 'auto') in ('auto', 'inline')
+    return True
+
+
+def _is_handoff(name, binding, task_input, handoffs):
+    """
+    Whether an input binding holds in-memory data that has already been
+    validated in the task input's type and format, so it may be passed to the
+    task without being fetched, validated or converted again. Only inputs
+    named in ``handoffs``, which the workflow executor passes to
+    :py:func:`run` for the outputs of upstream steps, are trusted to be.
+    """
+    return (name in handoffs and 'data' in binding and
+            binding.get('format') == task_input.get('format') and
+            task_input.get('target', 'memory') == 'memory')
+
+
+def _call_converter(fn, input, validate=True, status=None, **kwargs):
+    """
+    Run a single conversion step through its AnalysisFunction, validating its
+    input (if ``validate`` is set) and its output as :py:func:`run` would.
+    """
+    data_type = fn.input['type']
+    if validate and not isvalid(data_type, input, fetch=False, **kwargs):
+        raise Exception(
+            'Input %s (Python type %s) is not in the expected type '
+            '(%s) and format (%s).' % (
+                fn.input_name, type(input['data']), data_type,
+                input['format']))
+
+    _job_status(kwargs.get('_job_manager'), status)
+    output = {
+        'format': fn.output['format'],
+        'data': fn(input['data'], **kwargs)
+    }
+
+    if not isvalid(data_type, output, fetch=False, **kwargs):
+        raise Exception(
+            'Output %s (%s) is not in the expected type (%s) and '
+            'format (%s).' % (
+                fn.output_name, type(output['data']), data_type,
+                output['format']))
+
+    return output
+
+
+def _fetch_inputs(inputs, task_inputs, **kwargs):
+    """
+    Fetch the inputs that are not inline at the same time as each other, up to
+    ``girder_worker.fetch_parallelism`` at once. Returns a dict mapping the
+    name of each fetched input to its data. Inputs are left to be fetched one
+    at a time by :py:func:`run` if there is at most one to fetch.
+    """
+    names = [
+        name for name, d in inputs.iteritems()
+        if not task_inputs[name].get('stream') and
+        io._detect_mode(d) != 'inline'
+    ]
+    parallelism = config.getint('girder_worker', 'fetch_parallelism')
+    if len(names) < 2 or parallelism < 2:
+        return {}
+
+    def fetch(name):
+        return io.fetch(inputs[name], **dict(
+            {'task_input': task_inputs[name]}, **kwargs))
+
+    pool = ThreadPool(min(parallelism, len(names)))
+    try:
+        return dict(zip(names, pool.map(fetch, names)))
+    finally:
+        pool.close()
+        pool.join()
+
+
 @utils.with_tmpdir  # noqa
 def run(task, inputs=None, outputs=None, auto_convert=True, validate=True,
         fetch=True, status=None, **kwargs):
@@ -224,6 +369,10 @@ def run(task, inputs=None, outputs=None, auto_convert=True, validate=True,
     if inputs is None:
         inputs = {}
 
+    # The names of inputs handed off by an upstream workflow step. This is
+    # private to the workflow executor, and not passed on to nested runs.
+    handoffs = kwargs.pop('_handoffs', ())
+
     task_inputs = {extractId(d): d for d in task.get('inputs', ())}
     task_outputs = {extractId(d): d for d in task.get('outputs', ())}
     mode = task.get('mode', 'python')
@@ -256,15 +405,29 @@ def run(task, inputs=None, outputs=None, auto_convert=True, validate=True,
                     raise Exception(
                         'Required input \'%s\' not provided.' % name)
 
+        fetched = {}
+        if fetch:
+            if status == utils.JobStatus.RUNNING and any(
+                    'data' not in d and not task_inputs[name].get('stream')
+                    for name, d in inputs.iteritems()):
+                _job_status(job_mgr, utils.JobStatus.FETCHING_INPUT)
+            fetched = _fetch_inputs(inputs, task_inputs, **kwargs)
+
         for name, d in inputs.iteritems():
             task_input = task_inputs[name]
             if task_input.get('stream'):
                 continue  # this input will be fetched as a stream
 
+            if _is_handoff(name, d, task_input, handoffs):
+                # Handed off in memory by an upstream workflow step that
+                # already validated it in this format
+                d['script_data'] = d['data']
+                continue
+
             # Fetch the input
-            if fetch:
-                if status == utils.JobStatus.RUNNING and 'data' not in d:
-                    _job_status(job_mgr, utils.JobStatus.FETCHING_INPUT)
+            if name in fetched:
+                d['data'] = fetched[name]
+            elif fetch:
                 d['data'] = io.fetch(
                     d, **dict({'task_input': task_input}, **kwargs))
 
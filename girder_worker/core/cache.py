@@ -0,0 +1,467 @@
+"""
+This module contains the content-addressed caches used to avoid repeating
+work across tasks in the same worker process, and optionally across processes
+by way of an on-disk store.
+"""
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import six
+import tempfile
+import threading
+import uuid
+
+from girder_worker import config
+from girder_worker.core.utils import LRUCache
+from six.moves import cPickle as pickle
+
+
+# The Linux ioctl that shares the extents of one file with another (FICLONE)
+_FICLONE = 0x40049409
+
+
+def file_digest(path):
+    """
+    Return the hex SHA-1 digest of the contents of the file at ``path``.
+    """
+    h = hashlib.sha1()
+    with open(path, 'rb') as fd:
+        for buf in iter(lambda: fd.read(65536), b''):
+            h.update(buf)
+    return h.hexdigest()
+
+
+def materialize(source, dest):
+    """
+    Copy the file at ``source`` to ``dest``, sharing its data rather than
+    duplicating it where the filesystem supports reflinks (copy-on-write
+    clones, on filesystems such as btrfs and XFS). Files are never hard
+    linked, so either copy may be modified, chmodded or removed without
+    affecting the other.
+
+    ``source`` may also be a file object open for reading, which is cloned
+    or copied through its descriptor even if its path was since removed.
+    """
+    # Never write through an existing link to another file
+    if os.path.lexists(dest):
+        os.remove(dest)
+
+    if isinstance(source, six.string_types):
+        with open(source, 'rb') as src:
+            _clone_file(src, dest)
+    else:
+        _clone_file(source, dest)
+
+
+def _clone_file(src, dest):
+    with open(dest, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+            return
+        except (IOError, OSError):
+            pass
+
+        src.seek(0)
+        shutil.copyfileobj(src, dst)
+
+
+def digest(data):
+    """
+    Return the hex SHA-1 digest of in-memory string data, or ``None`` if the
+    data is not a string and so can not be cheaply content-addressed.
+    """
+    if isinstance(data, six.text_type):
+        return hashlib.sha1(data.encode('utf8')).hexdigest()
+    elif isinstance(data, six.binary_type):
+        return hashlib.sha1(data).hexdigest()
+    return None
+
+
+class DiskStore(object):
+    """
+    A directory of files keyed by hex digest, holding at most ``size_limit``
+    bytes. Reading an entry marks it as recently used, and the least recently
+    used entries are removed once the limit is exceeded. If ``on_cull`` is
+    given, it is called with the list of keys removed each time entries are
+    culled.
+    """
+    def __init__(self, directory, size_limit, on_cull=None):
+        self.directory = os.path.abspath(directory)
+        self.size_limit = size_limit
+        self.on_cull = on_cull
+        self._lock = threading.Lock()
+
+        try:
+            os.makedirs(self.directory)
+        except OSError:
+            if not os.path.isdir(self.directory):
+                raise
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """
+        Return the bytes stored under ``key``, or ``None`` if not present.
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as fd:
+                value = fd.read()
+            os.utime(path, None)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return value
+
+    def put(self, key, value):
+        """
+        Atomically store ``value`` (a byte string) under ``key``. Returns
+        whether it was stored, which it is not if larger than the store.
+        """
+        if len(value) > self.size_limit:
+            return False
+
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        with os.fdopen(fd, 'wb') as out:
+            out.write(value)
+        os.rename(tmp, self.path(key))
+        self.cull()
+        return True
+
+    def put_file(self, key, path):
+        """
+        Atomically store a copy of the file at ``path`` under ``key``,
+        reflinking rather than copying its data where possible. Returns
+        whether it was stored, which it is not if larger than the store.
+        """
+        if os.path.getsize(path) > self.size_limit:
+            return False
+
+        tmp = self.path('.tmp' + uuid.uuid4().hex)
+        materialize(path, tmp)
+        os.rename(tmp, self.path(key))
+        self.cull()
+        return True
+
+    def touch(self, key):
+        """
+        Mark the entry under ``key`` as recently used. Returns whether the
+        entry exists.
+        """
+        try:
+            os.utime(self.path(key), None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        return True
+
+    def cull(self):
+        """
+        Remove the least recently used entries until the store is within its
+        size limit. Returns the list of removed keys.
+        """
+        removed = []
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.startswith('.tmp'):
+                    continue
+                try:
+                    st = os.stat(self.path(name))
+                except OSError:
+                    continue  # removed by another process
+                entries.append((st.st_mtime, st.st_size, name))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.size_limit:
+                    break
+                try:
+                    os.remove(self.path(name))
+                    removed.append(name)
+                except OSError:
+                    pass
+                total -= size
+
+        if removed and self.on_cull is not None:
+            self.on_cull(removed)
+        return removed
+
+
+class PickleCache(object):
+    """
+    Caches arbitrary picklable values by key. Values are stored pickled, so
+    every hit returns a fresh copy that the caller is free to modify. Entries
+    are kept in an in-memory LRU tier bounded by ``memory_limit`` bytes, and,
+    if ``directory`` is given, in an on-disk tier bounded by ``disk_limit``
+    bytes.
+    """
+    def __init__(self, memory_limit, directory=None, disk_limit=0):
+        self.memory = LRUCache(memory_limit, weigh=len)
+        self.disk = DiskStore(directory, disk_limit) if directory else None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Return a ``(found, value)`` tuple for the given key.
+        """
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.put(key, value)
+
+        if value is None:
+            self.misses += 1
+            return False, None
+
+        self.hits += 1
+        return True, pickle.loads(value)
+
+    def put(self, key, value):
+        """
+        Store ``value`` under the given key. Values that can not be pickled
+        are silently not cached.
+        """
+        try:
+            value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return
+
+        self.memory.put(key, value)
+        if self.disk is not None:
+            self.disk.put(key, value)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'memory': self.memory.stats()
+        }
+
+
+class ConversionCache(PickleCache):
+    """
+    Caches the results of format conversions keyed by the data type, source
+    and target formats, and the digest of the input data.
+    """
+    @staticmethod
+    def key(type, source_format, target_format, data):
+        """
+        Return the cache key for converting ``data``, or ``None`` if the data
+        can not be content-addressed.
+        """
+        data_digest = digest(data)
+        if data_digest is None:
+            return None
+
+        return hashlib.sha1('\0'.join((
+            type, source_format, target_format, data.__class__.__name__,
+            data_digest)).encode('utf8')).hexdigest()
+
+
+class StepCache(PickleCache):
+    """
+    Caches the outputs of workflow steps keyed by the step's task
+    specification and the formats and contents of its input bindings, so
+    that re-running a workflow can skip steps whose inputs did not change.
+    """
+    @staticmethod
+    def key(task, inputs):
+        """
+        Return the cache key for running ``task`` on the given input
+        bindings, or ``None`` if some input is not held in memory or can not
+        be pickled, and so can not be content-addressed.
+        """
+        h = hashlib.sha1(json.dumps(task, sort_keys=True, default=repr))
+        for name in sorted(inputs):
+            binding = inputs[name]
+            if 'data' not in binding:
+                return None
+            try:
+                data = pickle.dumps(binding['data'], pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                return None
+            h.update('\0'.join((
+                name, binding.get('format', ''),
+                hashlib.sha1(data).hexdigest())).encode('utf8'))
+        return h.hexdigest()
+
+
+class InputCache(object):
+    """
+    Caches files downloaded over HTTP in ``directory``, up to ``size_limit``
+    bytes, so that the same input fetched by many jobs is only downloaded
+    again once it changes. Files are stored by the digest of their contents,
+    so identical files at different URLs are stored once. Each URL is mapped
+    to the digest of its file and the ``ETag`` and ``Last-Modified`` headers
+    it was served with, which are used to revalidate it with a conditional
+    request. Index entries are removed along with the files they refer to.
+    """
+    def __init__(self, directory, size_limit):
+        self.files = DiskStore(os.path.join(directory, 'files'), size_limit,
+                               on_cull=self._cull_index)
+        self.index = os.path.join(directory, 'index')
+        self.hits = 0
+        self.misses = 0
+
+        try:
+            os.makedirs(self.index)
+        except OSError:
+            if not os.path.isdir(self.index):
+                raise
+
+    @staticmethod
+    def key(url, headers=None, params=None):
+        """
+        Return the cache key for a GET request, which includes the headers
+        since they may carry credentials that change what is served.
+        """
+        return hashlib.sha1(json.dumps(
+            [url, headers or {}, params or {}], sort_keys=True)).hexdigest()
+
+    def lookup(self, key):
+        """
+        Return the cache entry for ``key``, a dict with the ``digest`` of the
+        file and the ``etag``, ``last_modified`` and ``filename`` it was
+        served with, or ``None`` if the file is not cached.
+        """
+        path = os.path.join(self.index, key)
+        try:
+            with open(path) as fd:
+                entry = json.load(fd)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if not self.files.touch(entry['digest']):
+            try:
+                os.remove(path)  # the file was evicted
+            except OSError:
+                pass
+            return None
+        return entry
+
+    @staticmethod
+    def validators(entry):
+        """
+        Return the headers that make a request for the cached entry
+        conditional on it having changed.
+        """
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, key, path, etag=None, last_modified=None, filename=None):
+        """
+        Store the downloaded file at ``path`` under ``key``. Files served
+        without an ``ETag`` or ``Last-Modified`` header can not be revalidated
+        and are not cached.
+        """
+        if not etag and not last_modified:
+            return
+
+        content_digest = file_digest(path)
+        if not self.files.put_file(content_digest, path):
+            return
+
+        fd, tmp = tempfile.mkstemp(dir=self.index, prefix='.tmp')
+        with os.fdopen(fd, 'w') as out:
+            json.dump({
+                'digest': content_digest,
+                'etag': etag,
+                'last_modified': last_modified,
+                'filename': filename
+            }, out)
+        os.rename(tmp, os.path.join(self.index, key))
+
+    def _cull_index(self, removed):
+        """
+        Remove the index entries that refer to files no longer in the store,
+        including files culled by other processes sharing the directory.
+        """
+        for name in os.listdir(self.index):
+            if name.startswith('.tmp'):
+                continue
+            path = os.path.join(self.index, name)
+            try:
+                with open(path) as fd:
+                    entry = json.load(fd)
+                if os.path.exists(self.files.path(entry['digest'])):
+                    continue
+            except (IOError, OSError, ValueError, KeyError):
+                pass  # removed by another process, or unreadable
+
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def materialize(self, entry, dest):
+        """
+        Make a copy of the cached file of ``entry`` available at ``dest``.
+        Returns ``False`` if the file was evicted in the meantime.
+        """
+        try:
+            materialize(self.files.path(entry['digest']), dest)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        return True
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+def _create_conversion_cache():
+    if not config.getboolean('girder_worker', 'conversion_cache_enabled'):
+        return None
+
+    return ConversionCache(
+        memory_limit=config.getint(
+            'girder_worker', 'conversion_cache_memory_limit'),
+        directory=config.get('girder_worker', 'conversion_cache_directory'),
+        disk_limit=config.getint(
+            'girder_worker', 'conversion_cache_disk_limit'))
+
+
+def _create_step_cache():
+    if not config.getboolean('girder_worker', 'step_cache_enabled'):
+        return None
+
+    return StepCache(
+        memory_limit=config.getint('girder_worker', 'step_cache_memory_limit'),
+        directory=config.get('girder_worker', 'step_cache_directory'),
+        disk_limit=config.getint('girder_worker', 'step_cache_disk_limit'))
+
+
+def _create_input_cache():
+    if not config.getboolean('girder_worker', 'http_cache_enabled'):
+        return None
+
+    return InputCache(
+        directory=config.get('girder_worker', 'http_cache_directory'),
+        size_limit=config.getint('girder_worker', 'http_cache_size_limit'))
+
+
+# The process-wide conversion cache, or None if it is disabled
+conversion_cache = _create_conversion_cache()
+
+# The process-wide workflow step cache, or None if it is disabled
+step_cache = _create_step_cache()
+
+# The process-wide cache of HTTP inputs, or None if it is disabled
+input_cache = _create_input_cache()
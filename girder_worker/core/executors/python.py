@@ -1,8 +1,61 @@
+import hashlib
 import imp
 import json
 import sys
 import tempfile
 
+from girder_worker import config
+from girder_worker.core.utils import LRUCache
+
+# Process-wide cache of compiled task scripts, keyed by a digest of the source
+code_cache = LRUCache(config.getint('girder_worker', 'code_cache_size'))
+
+
+def compile_script(script):
+    """
+    Compile a task script into a code object, reusing a previously compiled
+    code object from :py:data:`code_cache` if the same source has been seen.
+
+    :param script: The python source of the task.
+    :type script: str
+    :returns: The compiled code object.
+    """
+    if isinstance(script, unicode):
+        key = hashlib.sha1(script.encode('utf8')).hexdigest()
+    else:
+        key = hashlib.sha1(script).hexdigest()
+
+    code = code_cache.get(key)
+    if code is None:
+        code = compile(script, '<string>', 'exec')
+        code_cache.put(key, code)
+
+    return code
+
+
+def exec_script(task, namespace):
+    """
+    Execute the script of a ``python`` mode task inside the given namespace
+    using the cached code object. Any exception raised by the script is
+    re-raised with the script source and task attached to the message.
+
+    :param task: The task whose ``script`` should be executed.
+    :type task: dict
+    :param namespace: The global namespace to execute the script in.
+    :type namespace: dict
+    """
+    try:
+        exec compile_script(task['script']) in namespace
+    except Exception, e:
+        trace = sys.exc_info()[2]
+        lines = task['script'].split('\n')
+        lines = [(str(i+1) + ': ' + lines[i]) for i in xrange(len(lines))]
+        error = (
+            str(e) + '\nScript:\n' + '\n'.join(lines) +
+            '\nTask:\n' + json.dumps(task, indent=4)
+        )
+        raise Exception(error), None, trace
+
 
 def run(task, inputs, outputs, task_inputs, task_outputs, **kwargs):
     custom = imp.new_module('__girder_worker__')
@@ -22,17 +75,7 @@ def run(task, inputs, outputs, task_inputs, task_outputs, **kwargs):
             exec fh in custom.__dict__
 
     else:
-        try:
-            exec task['script'] in custom.__dict__
-        except Exception, e:
-            trace = sys.exc_info()[2]
-            lines = task['script'].split('\n')
-            lines = [(str(i+1) + ': ' + lines[i]) for i in xrange(len(lines))]
-            error = (
-                str(e) + '\nScript:\n' + '\n'.join(lines) +
-                '\nTask:\n' + json.dumps(task, indent=4)
-            )
-            raise Exception(error), None, trace
+        exec_script(task, custom.__dict__)
 
     for name, task_output in task_outputs.iteritems():
         outputs[name]['script_data'] = custom.__dict__[name]
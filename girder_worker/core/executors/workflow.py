@@ -1,6 +1,73 @@
 import girder_worker
-
-from girder_worker.core.utils import toposort
+import sys
+import threading
+
+from girder_worker import config
+from girder_worker.core import cache
+from girder_worker.core.utils import toposort, TopologicalSorter
+from multiprocessing.pool import ThreadPool
+from six.moves import queue
+
+
+def _run_steps_parallel(dependencies, run_step, step_done, max_parallelism):
+    """
+    Run each step as soon as all of the steps it depends on have finished,
+    with at most ``max_parallelism`` steps running at once on a thread pool.
+    ``run_step`` is called on the pool threads with the step name, while
+    ``step_done`` is called on the calling thread with the step name and the
+    value returned by ``run_step``, so it may update shared state freely.
+    """
+    sorter = TopologicalSorter(dependencies)
+    results = queue.Queue()
+
+    def wrapped(name):
+        try:
+            results.put((name, run_step(name), None))
+        except Exception:
+            results.put((name, None, sys.exc_info()))
+
+    pool = ThreadPool(max_parallelism)
+    try:
+        while sorter.is_active():
+            for name in sorter.get_ready():
+                pool.apply_async(wrapped, (name,))
+
+            name, out, exc_info = results.get()
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+            step_done(name, out)
+            sorter.done(name)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _port(ports, name):
+    for port in ports:
+        if port.get('id', port.get('name')) == name:
+            return port
+    return None
+
+
+def _handoff(out, producer, consumer):
+    """
+    Build the downstream binding for the output ``out`` of a step. Returns the
+    binding and whether it is handed off: when the producer's output port and
+    the consumer's input port agree on type and format and the consumer wants
+    the data in memory, the object is passed on as-is and :py:func:`core.run`
+    is told not to fetch, validate or convert it again. Otherwise the
+    consumer treats the binding like any other input.
+    """
+    binding = dict(out)
+    handed_off = (
+        producer is not None and consumer is not None and
+        'data' in binding and
+        producer.get('type') == consumer.get('type') and
+        binding.get('format') == consumer.get('format') and
+        consumer.get('target', 'memory') == 'memory' and
+        not consumer.get('stream'))
+    return binding, handed_off
 
 
 def run(task, inputs, outputs, task_inputs, task_outputs, validate,  # noqa
@@ -8,8 +75,10 @@ def run(task, inputs, outputs, task_inputs, task_outputs, validate,  # noqa
     # Make map of steps
     steps = {step['name']: step for step in task['steps']}
 
-    # Make map of input bindings
+    # Make map of input bindings, and of the inputs of each step that are
+    # handed off from upstream steps
     bindings = {step['name']: {} for step in task['steps']}
+    handoffs = {step['name']: set() for step in task['steps']}
 
     # Create dependency graph and downstream pointers
     dependencies = {step['name']: set() for step in task['steps']}
@@ -33,31 +102,91 @@ def run(task, inputs, outputs, task_inputs, task_outputs, validate,  # noqa
                 'data': inputs[name]['script_data']
             }
 
-    # Traverse analyses in topological order
-    for step_set in toposort(dependencies):
-        for step in step_set:
-            # Visualizations cannot be executed
-            if ('visualization' in steps[step] and
-                    steps[step]['visualization']):
-                continue
-
-            # Run step
-            print '--- beginning: %s ---' % steps[step]['name']
-            out = girder_worker.core.run(steps[step]['task'], bindings[step])
-            print '--- finished: %s ---' % steps[step]['name']
-
-            # Update bindings of downstream analyses
-            if step in downstream:
-                for name, conn_list in downstream[step].iteritems():
-                    for conn in conn_list:
-                        if 'input_step' in conn:
-                            # This is a connection to a downstream step
-                            b = bindings[conn['input_step']]
-                            b[conn['input']] = out[name]
-                        else:
-                            # This is a connection to a final output
-                            o = outputs[conn['name']]
-                            o['script_data'] = out[name]['data']
+    serial_modes = set(
+        m.strip() for m in config.get(
+            'girder_worker', 'workflow_serial_modes').split(',') if m.strip())
+    mode_locks = {mode: threading.Lock() for mode in serial_modes}
+
+    step_cache = cache.step_cache
+    stats = {'hits': 0, 'misses': 0}
+    stats_lock = threading.Lock()
+
+    def run_step(step):
+        # Visualizations cannot be executed
+        if ('visualization' in steps[step] and
+                steps[step]['visualization']):
+            return None
+
+        step_task = steps[step]['task']
+        lock = mode_locks.get(step_task.get('mode', 'python'))
+
+        # Restore the outputs of an identical earlier run of this step
+        key = None
+        if step_cache is not None and steps[step].get('cache', True):
+            key = cache.StepCache.key(step_task, bindings[step])
+        if key is not None:
+            found, out = step_cache.get(key)
+            with stats_lock:
+                stats['hits' if found else 'misses'] += 1
+            if found:
+                print '--- cached: %s ---' % steps[step]['name']
+                return out
+
+        # Run step
+        print '--- beginning: %s ---' % steps[step]['name']
+        step_handoffs = frozenset(handoffs[step])
+        if lock is None:
+            out = girder_worker.core.run(
+                step_task, bindings[step], _handoffs=step_handoffs)
+        else:
+            with lock:
+                out = girder_worker.core.run(
+                    step_task, bindings[step], _handoffs=step_handoffs)
+        print '--- finished: %s ---' % steps[step]['name']
+
+        if key is not None:
+            step_cache.put(key, out)
+
+        return out
+
+    def step_done(step, out):
+        # Update bindings of downstream analyses
+        if out is not None and step in downstream:
+            for name, conn_list in downstream[step].iteritems():
+                for conn in conn_list:
+                    if 'input_step' in conn:
+                        # This is a connection to a downstream step. Each
+                        # gets its own copy of the binding since core.run
+                        # modifies it, possibly from several threads at once.
+                        consumer = steps[conn['input_step']]['task']
+                        b, handed_off = _handoff(
+                            out[name],
+                            _port(steps[step]['task'].get('outputs', ()),
+                                  name),
+                            _port(consumer.get('inputs', ()), conn['input']))
+                        bindings[conn['input_step']][conn['input']] = b
+                        if handed_off:
+                            handoffs[conn['input_step']].add(conn['input'])
+                    else:
+                        # This is a connection to a final output
+                        o = outputs[conn['name']]
+                        o['script_data'] = out[name]['data']
+
+    max_parallelism = int(task.get('max_parallelism', config.getint(
+        'girder_worker', 'workflow_max_parallelism')))
+
+    if max_parallelism > 1:
+        _run_steps_parallel(dependencies, run_step, step_done, max_parallelism)
+    else:
+        # Traverse analyses in topological order
+        for step_set in toposort(dependencies):
+            for step in step_set:
+                step_done(step, run_step(step))
+
+    job_mgr = kwargs.get('_job_manager')
+    if job_mgr is not None and (stats['hits'] or stats['misses']):
+        job_mgr.write('Workflow step cache: %d hits, %d misses\n' % (
+            stats['hits'], stats['misses']))
 
     # Output visualization parameters
     outputs['_visualizations'] = []
@@ -1,19 +1,52 @@
 import csv
+import heapq
 import json
 import glob
 import os
 import math
+import six
+import threading
+from girder_worker import config
 from girder_worker.core.io import fetch
+from girder_worker.core.executors.python import exec_script
 import networkx as nx
 from collections import namedtuple
-from networkx.algorithms.shortest_paths.generic import all_shortest_paths
 from networkx.algorithms.shortest_paths.unweighted import (
-    single_source_shortest_path
+    all_pairs_shortest_path_length
 )
 
 
 conv_graph = nx.DiGraph()
 
+# Maps validators and (source, target) converter edges of ``conv_graph`` to
+# their AnalysisFunction, for analyses that can be called in-process.
+_analysis_functions = {}
+
+# Maps each node of ``conv_graph`` to a dict of the nodes reachable from it,
+# which in turn map to the stable shortest conversion path between the two.
+# This is computed lazily and reset by invalidate_routing_table().
+_routing_table = None
+
+# Maps (source, target) converter edges of ``conv_graph`` to the ConverterCost
+# used to estimate how long the conversion will take.
+_converter_costs = {}
+
+# Whether any ConverterCost was declared or learned, so that paths must be
+# chosen by cost rather than taken from the routing table
+_has_known_costs = False
+
+# The number of run times a ConverterCost needs before its fitted model is
+# used, read from the config on first use and by import_converters()
+_min_samples = None
+
+
+def _cost_min_samples():
+    global _min_samples
+    if _min_samples is None:
+        _min_samples = config.getint(
+            'girder_worker', 'converter_cost_min_samples')
+    return _min_samples
+
 
 class Validator(namedtuple('Validator', ['type', 'format'])):
     """Validator
@@ -42,6 +75,198 @@ class Validator(namedtuple('Validator', ['type', 'format'])):
         return self in conv_graph.nodes()
 
 
+class AnalysisFunction(object):
+    """
+    Wraps a single-input, single-output ``python`` mode analysis (i.e. a
+    validator or converter) so it can be called directly as a function,
+    without the temp directory, event dispatch, and binding bookkeeping that
+    :py:func:`girder_worker.core.run` performs.
+
+    Analyses that rely on that machinery may opt out of this mode by setting
+    ``"needs_tempdir": true`` or ``"needs_events": true`` in their JSON.
+    """
+    def __init__(self, analysis):
+        self.analysis = analysis
+        self.input = analysis['inputs'][0]
+        self.output = analysis['outputs'][0]
+        self.input_name = self.input.get('id', self.input.get('name'))
+        self.output_name = self.output.get('id', self.output.get('name'))
+
+    @staticmethod
+    def supports(analysis):
+        """
+        Return whether the given analysis can be run as an AnalysisFunction.
+        """
+        return (analysis.get('mode', 'python') == 'python' and
+                'script' in analysis and
+                len(analysis.get('inputs', ())) == 1 and
+                len(analysis.get('outputs', ())) == 1 and
+                analysis['inputs'][0].get('target', 'memory') == 'memory' and
+                not analysis.get('needs_tempdir') and
+                not analysis.get('needs_events'))
+
+    def __call__(self, data, **kwargs):
+        """
+        Run the analysis on ``data`` and return the value of its output.
+        """
+        namespace = {
+            '__name__': '__girder_worker__',
+            '_job_manager': kwargs.get('_job_manager'),
+            '_tempdir': kwargs.get('_tempdir'),
+            self.input_name: data
+        }
+        exec_script(self.analysis, namespace)
+        return namespace[self.output_name]
+
+
+class ConverterCost(object):
+    """
+    Models the expected run time in seconds of a converter as a fixed cost plus
+    a cost per byte of input. The model may be declared in the converter JSON
+    via a ``"cost"`` field of the form ``{"fixed": 0.1, "per_byte": 1e-8}``.
+    If ``girder_worker.converter_cost_learning`` is enabled, the model is
+    instead fit to the run times recorded with :py:meth:`record` once enough
+    samples have been seen.
+    """
+    def __init__(self, fixed=None, per_byte=None):
+        self.declared = fixed is not None or per_byte is not None
+        self.fixed = config.getfloat('girder_worker', 'converter_cost_fixed') \
+            if fixed is None else fixed
+        self.per_byte = config.getfloat(
+            'girder_worker', 'converter_cost_per_byte') \
+            if per_byte is None else per_byte
+
+        # Running sums for a least squares fit of seconds against size
+        self.samples = 0
+        self._sx = self._sy = self._sxx = self._sxy = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_spec(cls, spec, name):
+        """
+        Create the cost declared by the ``"cost"`` field of the converter
+        called ``name``, raising an exception that names the converter if the
+        field is not a dict of numeric ``fixed`` and ``per_byte`` values.
+        """
+        if not isinstance(spec, dict):
+            raise Exception(
+                'The "cost" of converter %s must be an object.' % name)
+        unknown = set(spec) - {'fixed', 'per_byte'}
+        if unknown:
+            raise Exception(
+                'Unknown key(s) %s in the "cost" of converter %s; expected '
+                '"fixed" and/or "per_byte".' % (
+                    ', '.join(sorted(unknown)), name))
+        for key, value in spec.items():
+            if isinstance(value, bool) or not isinstance(
+                    value, (six.integer_types, float)):
+                raise Exception(
+                    'The "%s" cost of converter %s must be a number.' % (
+                        key, name))
+
+        cost = cls(**spec)
+        if cost.declared:
+            global _has_known_costs
+            _has_known_costs = True
+        return cost
+
+    @property
+    def learned(self):
+        """
+        Whether enough run times have been recorded to use the fitted model.
+        """
+        return self.samples >= _cost_min_samples()
+
+    def is_known(self):
+        """
+        Whether this cost was declared or learned, as opposed to the default.
+        """
+        return self.declared or self.learned
+
+    def record(self, seconds, size=None):
+        """
+        Record the run time of one conversion of an input of ``size`` bytes.
+        Inputs of unknown size are recorded as having size zero.
+        """
+        size = size or 0
+        with self._lock:
+            self.samples += 1
+            self._sx += size
+            self._sy += seconds
+            self._sxx += size * size
+            self._sxy += size * seconds
+
+        if self.learned:
+            global _has_known_costs
+            _has_known_costs = True
+
+    def estimate(self, size=None):
+        """
+        Estimate the run time in seconds of converting ``size`` bytes of input.
+        An unknown size only takes the fixed cost into account.
+        """
+        fixed, per_byte = self.fixed, self.per_byte
+
+        if self.learned:
+            n = self.samples
+            denom = n * self._sxx - self._sx * self._sx
+            if denom > 0:
+                per_byte = max(
+                    0.0, (n * self._sxy - self._sx * self._sy) / denom)
+            else:
+                per_byte = 0.0
+            fixed = max(0.0, (self._sy - per_byte * self._sx) / n)
+
+        return fixed + per_byte * (size or 0)
+
+
+def get_converter_cost(source, target):
+    """
+    Return the :py:class:`ConverterCost` of the converter from ``source`` to
+    ``target``. Converters added to ``conv_graph`` without going through
+    :py:func:`import_converters` are given a new default cost model.
+    """
+    cost = _converter_costs.get((source, target))
+    if cost is None:
+        cost = _converter_costs.setdefault((source, target), ConverterCost())
+    return cost
+
+
+def record_converter_time(source, target, seconds, size=None):
+    """
+    Record how long the converter from ``source`` to ``target`` took to run
+    on an input of ``size`` bytes. This is a no-op unless
+    ``girder_worker.converter_cost_learning`` is enabled.
+    """
+    if config.getboolean('girder_worker', 'converter_cost_learning'):
+        get_converter_cost(source, target).record(seconds, size)
+
+
+def payload_size(data):
+    """
+    Return the size in bytes of in-memory string data, or ``None`` if the size
+    of ``data`` can not be determined cheaply.
+    """
+    if isinstance(data, six.string_types):
+        return len(data)
+    return None
+
+
+def get_analysis_function(source, target=None):
+    """
+    Return the :py:class:`AnalysisFunction` for the validator ``source``, or
+    for the converter from ``source`` to ``target`` if ``target`` is given.
+    Returns ``None`` if the analysis must be executed with a full
+    :py:func:`girder_worker.core.run`.
+
+    :param source: ``Validator`` tuple of the validator or converter input.
+    :param target: ``Validator`` tuple of the converter output.
+    """
+    if target is None:
+        return _analysis_functions.get(source)
+    return _analysis_functions.get((source, target))
+
+
 def get_csv_reader(input):
 
     # csv package does not support unicode
@@ -94,38 +319,56 @@ def csv_to_rows(input):
     return output
 
 
-def converter_path(source, target):
+def converter_path(source, target, size=None):
     """Gives the shortest path that should be taken to go from a source
     type/format to a target type/format.
 
+    If any converter has a declared or learned :py:class:`ConverterCost`, this
+    is the path with the smallest expected run time for an input of ``size``
+    bytes. Otherwise it is the path with the fewest conversions.
+
     Throws a ``NetworkXNoPath`` exception if it can not find a path.
 
     :param source: Validator tuple indicating the type/format being converted
         `from`.
     :param target: ``Validator`` tuple indicating the type/format being
         converted `to`.
+    :param size: The size of the input data in bytes, if known.
+    :type size: int or None
     :returns: An ordered list of the analyses that need to be run to convert
         from ``source`` to ``target``.
     """
+    return [conv_graph.edge[u][v]
+            for (u, v) in converter_edges(source, target, size)]
+
+
+def converter_edges(source, target, size=None):
+    """Like :py:func:`converter_path`, but returns the path as a list of
+    ``(source, target)`` ``Validator`` pairs, one per converter.
+
+    Throws a ``NetworkXNoPath`` exception if it can not find a path.
+    """
     # These are to ensure an exception gets thrown if source/target don't exist
     get_validator_analysis(source)
     get_validator_analysis(target)
 
-    # We sort and pick the first of the shortest paths just to produce a stable
-    # conversion path. This is stable in regards to which plugins are loaded at
-    # the time.
-    paths = all_shortest_paths(conv_graph, source, target)
-    path = sorted(paths)[0]
-    path = zip(path[:-1], path[1:])
+    if _has_known_costs:
+        path = _cheapest_path(source, target, size)
+    else:
+        path = get_routing_table().get(source, {}).get(target)
+
+    if path is None:
+        raise nx.NetworkXNoPath('Node %s not reachable from %s' % (
+            target, source))
 
-    return [conv_graph.edge[u][v] for (u, v) in path]
+    return zip(path[:-1], path[1:])
 
 
 def has_converter(source, target=Validator(type=None, format=None)):
     """Determines if any converters exist from a given type, and optionally format.
 
-    Underneath, this just traverses the edges until it finds one which matches
-    the arguments.
+    Underneath, this just looks through the routing table until it finds a
+    reachable node which matches the arguments.
 
     :param source: ``Validator`` tuple indicating the type/format being
         converted `from`.
@@ -134,23 +377,107 @@ def has_converter(source, target=Validator(type=None, format=None)):
     :returns: ``True`` if it can converter from ``source`` to ``target``,
         ``False`` otherwise.
     """
-    sources = []
+    for u, routes in get_routing_table().iteritems():
+        if ((source.type is None) or (source.type == u.type)) and \
+           ((source.format is None) or (source.format == u.format)):
+            for v in routes:
+                if v == u:
+                    continue  # Ignore path to self, there are no self loops
 
-    for node in conv_graph.nodes():
-        if ((source.type is None) or (source.type == node.type)) and \
-           ((source.format is None) or (source.format == node.format)):
-            sources.append(node)
+                if ((target.type is None) or (target.type == v.type)) and \
+                   ((target.format is None) or (target.format == v.format)):
+                    return True
 
-    for u in sources:
-        reachable = single_source_shortest_path(conv_graph, u)
-        del reachable[u]  # Ignore path to self, since there are no self loops
+    return False
 
-        for v in reachable:
-            if ((target.type is None) or (target.type == v.type)) and \
-               ((target.format is None) or (target.format == v.format)):
-                return True
 
-    return False
+def reachable_formats(source):
+    """Lists every type/format that data in the ``source`` type/format can be
+    converted to, not including ``source`` itself.
+
+    :param source: ``Validator`` tuple indicating the type/format being
+        converted `from`.
+    :returns: A sorted list of ``Validator`` tuples.
+    """
+    return sorted(v for v in get_routing_table().get(source, ())
+                  if v != source)
+
+
+def get_routing_table():
+    """Returns the table of conversion paths between every pair of nodes in
+    ``conv_graph``, computing it first if the graph has changed since it was
+    last built.
+
+    The table is a dict mapping each source ``Validator`` to a dict of the
+    ``Validator`` tuples reachable from it, whose values are the conversion
+    path between the two as a tuple of nodes. Of all the shortest paths
+    between two nodes, the lexicographically smallest one is used in order to
+    produce a stable conversion path. This is stable in regards to which
+    plugins are loaded at the time.
+    """
+    global _routing_table
+
+    if _routing_table is None:
+        _routing_table = _build_routing_table()
+
+    return _routing_table
+
+
+def invalidate_routing_table():
+    """Discards the routing table so that it is rebuilt on next use. This is
+    called by :py:func:`import_converters`, and must also be called by any code
+    that modifies ``conv_graph`` directly.
+    """
+    global _routing_table
+    _routing_table = None
+
+
+def _cheapest_path(source, target, size):
+    """
+    Dijkstra's algorithm over the estimated converter costs. Ties are broken by
+    taking the lexicographically smallest path, so the result is stable.
+    """
+    heap = [(0.0, (source,))]
+    visited = set()
+
+    while heap:
+        cost, path = heapq.heappop(heap)
+        node = path[-1]
+        if node == target:
+            return path
+        if node in visited:
+            continue
+        visited.add(node)
+
+        for v in conv_graph.successors(node):
+            if v not in visited:
+                heapq.heappush(heap, (
+                    cost + get_converter_cost(node, v).estimate(size),
+                    path + (v,)))
+
+    return None
+
+
+def _build_routing_table():
+    lengths = dict(all_pairs_shortest_path_length(conv_graph))
+    table = {}
+
+    for source in conv_graph.nodes():
+        table[source] = routes = {}
+
+        for target in lengths[source]:
+            # Walk from the source always taking the smallest successor that
+            # is still on a shortest path to the target, which yields the
+            # lexicographically smallest of the shortest paths.
+            path = [source]
+            while path[-1] != target:
+                remaining = lengths[path[-1]][target] - 1
+                path.append(min(
+                    v for v in conv_graph.successors(path[-1])
+                    if lengths[v].get(target) == remaining))
+            routes[target] = tuple(path)
+
+    return table
 
 
 def get_validator_analysis(validator):
@@ -205,11 +532,26 @@ def import_converters(search_paths):
     output named ``"output"``. The input and output should have matching
     type but should be of different formats.
 
+    Validators and converters in ``python`` mode are called directly
+    in-process as an :py:class:`AnalysisFunction` rather than through a full
+    :py:func:`girder_worker.core.run`. An analysis that needs its own temp
+    directory or the ``run.*`` events to fire can set ``"needs_tempdir"`` or
+    ``"needs_events"`` to ``true`` in its JSON.
+
+    Converters may also declare a ``"cost"`` field describing their expected
+    run time, which is used to choose between conversion paths. See
+    :py:class:`ConverterCost`. Converters whose output refers to external
+    state, such as a path on disk, should set ``"cacheable": false`` so their
+    results are never stored in the conversion cache.
+
     :param search_paths: A list of search paths relative to the current
         working directory. Passing a single path as a string also works.
     :type search_paths: str or list of str
     """
 
+    global _min_samples
+    _min_samples = config.getint('girder_worker', 'converter_cost_min_samples')
+
     if not isinstance(search_paths, (list, tuple)):
         search_paths = [search_paths]
 
@@ -226,32 +568,48 @@ def import_converters(search_paths):
         return analysis
 
     prevdir = os.getcwd()
-    for path in search_paths:
-        os.chdir(path)
-        validator_files = set(glob.glob(os.path.join(path, 'validate_*.json')))
-        converter_files = set(glob.glob(os.path.join(
-            path, '*_to_*.json'))) - validator_files
-
-        for filename in validator_files:
-            analysis = get_analysis(filename)
-
-            # Validators only contain 1 input and output, so the type/format of
-            # it can be gleaned from the first input.
-            conv_graph.add_node(Validator(analysis['inputs'][0]['type'],
-                                          analysis['inputs'][0]['format']),
-                                analysis)
-
-        for filename in converter_files:
-            analysis = get_analysis(filename)
-            in_type = analysis['inputs'][0]['type']
-            in_format = analysis['inputs'][0]['format']
-            out_format = analysis['outputs'][0]['format']
-
-            conv_graph.add_edge(Validator(in_type, in_format),
-                                Validator(in_type, out_format),
-                                attr_dict=analysis)
-
-    os.chdir(prevdir)
+    # Invalidate the routing table even if an import fails part way, as
+    # some converters may already have been added to the graph
+    try:
+        for path in search_paths:
+            os.chdir(path)
+            validator_files = set(glob.glob(os.path.join(
+                path, 'validate_*.json')))
+            converter_files = set(glob.glob(os.path.join(
+                path, '*_to_*.json'))) - validator_files
+
+            for filename in validator_files:
+                analysis = get_analysis(filename)
+
+                # Validators only contain 1 input and output, so the
+                # type/format of it can be gleaned from the first input.
+                validator = Validator(analysis['inputs'][0]['type'],
+                                      analysis['inputs'][0]['format'])
+                conv_graph.add_node(validator, analysis)
+                _register_analysis_function(validator, analysis)
+
+            for filename in converter_files:
+                analysis = get_analysis(filename)
+                in_type = analysis['inputs'][0]['type']
+                in_format = analysis['inputs'][0]['format']
+                out_format = analysis['outputs'][0]['format']
+
+                source = Validator(in_type, in_format)
+                target = Validator(in_type, out_format)
+                conv_graph.add_edge(source, target, attr_dict=analysis)
+                _converter_costs[(source, target)] = ConverterCost.from_spec(
+                    analysis.get('cost', {}), analysis.get('name', filename))
+                _register_analysis_function((source, target), analysis)
+    finally:
+        os.chdir(prevdir)
+        invalidate_routing_table()
+
+
+def _register_analysis_function(key, analysis):
+    if AnalysisFunction.supports(analysis):
+        _analysis_functions[key] = AnalysisFunction(analysis)
+    else:
+        _analysis_functions.pop(key, None)
 
 
 def print_conversion_graph():
@@ -263,10 +621,7 @@ def print_conversion_graph():
     print 'digraph g {'
 
     for node in conv_graph.nodes():
-        paths = single_source_shortest_path(conv_graph, node)
-        reachable_conversions = [p for p in paths.keys() if p != node]
-
-        for dest in reachable_conversions:
+        for dest in reachable_formats(node):
             print '"%s:%s" -> "%s:%s"' % (node[0], node[1], dest[0], dest[1])
 
     print '}'
@@ -281,10 +636,7 @@ def print_conversion_table():
     print 'from,to'
 
     for node in conv_graph.nodes():
-        paths = single_source_shortest_path(conv_graph, node)
-        reachable_conversions = [p for p in paths.keys() if p != node]
-
-        for dest in reachable_conversions:
+        for dest in reachable_formats(node):
             print '%s:%s,%s:%s' % (node[0], node[1], dest[0], dest[1])
 
 
@@ -186,4 +186,6 @@ register_push_handler('local', local.push)
 register_push_handler('inline', _inline_push)
 
 register_stream_push_adapter('http', http.HttpStreamPushAdapter)
+register_stream_push_adapter('local', local.LocalStreamPushAdapter)
 register_stream_fetch_adapter('http', http.HttpStreamFetchAdapter)
+register_stream_fetch_adapter('local', local.LocalStreamFetchAdapter)
@@ -4,9 +4,32 @@ import re
 import requests
 import six
 import ssl
+import threading
+import time
 import urlparse
 
+from girder_worker import config
+from girder_worker.core import cache
 from girder_worker.core.utils import StreamFetchAdapter, StreamPushAdapter
+from multiprocessing.pool import ThreadPool
+
+# Seconds to wait before retrying a failed segment, doubled on each retry
+RETRY_BACKOFF = 1.0
+
+
+class RangeNotSupported(Exception):
+    """
+    Raised when a server does not honor HTTP Range requests.
+    """
+    pass
+
+
+class ResourceChanged(Exception):
+    """
+    Raised when a resource changes while it is being downloaded in byte
+    ranges, so the ranges already written belong to another version of it.
+    """
+    pass
 
 
 class HttpStreamFetchAdapter(StreamFetchAdapter):
@@ -128,9 +151,193 @@ def _read_filename_from_resp(request, url):
         return match.group(1)
 
 
+def download_segments(url, path, size, segments, headers=None, params=None,
+                      retries=3, session=None, progress=None, etag=None,
+                      last_modified=None):
+    """
+    Download ``size`` bytes from ``url`` into the file at ``path`` as
+    ``segments`` byte ranges fetched at once with HTTP Range requests, which
+    is faster than a single stream over high latency links. The file is
+    preallocated and each range is written in place. A range that fails to
+    download is retried up to ``retries`` times, resuming from the last byte
+    that was written.
+
+    Every range must come from the same version of the resource: the one
+    with the given ``ETag`` and ``Last-Modified`` headers, e.g. those of the
+    response that ``size`` was read from, or else the one the first range
+    comes from. Range requests are made conditional on it with ``If-Range``.
+
+    :param session: The ``requests`` session to send requests with, if any.
+    :param progress: A function called with the number of bytes in each chunk
+        as it is written.
+    :raises RangeNotSupported: If the server does not honor Range requests,
+        in which case the caller should fall back to a single request.
+    :raises ResourceChanged: If the resource changed during the download.
+    """
+    session = session or requests
+    headers = dict(headers or {}, **{'Accept-Encoding': 'identity'})
+    segment_size = -(-size // max(segments, 1))
+    ranges = [(start, min(start + segment_size, size))
+              for start in six.moves.range(0, size, segment_size)]
+    version = {'ETag': etag, 'Last-Modified': last_modified}
+    version_lock = threading.Lock()
+
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+    def if_range():
+        # Weak entity tags can not be used for range requests
+        with version_lock:
+            if version['ETag'] and not version['ETag'].startswith('W/'):
+                return version['ETag']
+            return version['Last-Modified']
+
+    def check_version(resp):
+        with version_lock:
+            for header in ('ETag', 'Last-Modified'):
+                value = resp.headers.get(header)
+                if value is None:
+                    continue
+                if version[header] is None:
+                    version[header] = value
+                elif value != version[header]:
+                    resp.close()
+                    raise ResourceChanged(
+                        '%s changed during the download (%s %s != %s).' % (
+                            url, header, value, version[header]))
+
+    def fetch_range(byte_range):
+        offset, end = byte_range
+        for attempt in six.moves.range(retries + 1):
+            try:
+                range_headers = dict(headers, Range='bytes=%d-%d' % (
+                    offset, end - 1))
+                validator = if_range()
+                if validator:
+                    range_headers['If-Range'] = validator
+
+                resp = session.get(
+                    url, params=params, stream=True, allow_redirects=True,
+                    headers=range_headers)
+                if resp.status_code != 206:
+                    resp.raise_for_status()
+                    # A full response to a request with If-Range is sent if
+                    # the resource changed, or if ranges are not supported.
+                    # Either way the whole download has to start over.
+                    check_version(resp)
+                    resp.close()
+                    raise RangeNotSupported(
+                        'Server returned %d for a Range request.' %
+                        resp.status_code)
+                check_version(resp)
+
+                with open(path, 'r+b') as f:
+                    f.seek(offset)
+                    for buf in resp.iter_content(65536):
+                        buf = buf[:end - offset]
+                        f.write(buf)
+                        offset += len(buf)
+                        if progress is not None:
+                            progress(len(buf))
+                        if offset >= end:
+                            break
+                resp.close()
+
+                if offset < end:
+                    raise IOError(
+                        'Connection closed %d bytes before the end of the '
+                        'range.' % (end - offset))
+                return
+            except IOError as e:
+                # Client errors are not worth retrying
+                response = getattr(e, 'response', None)
+                if attempt == retries or (
+                        response is not None and response.status_code < 500):
+                    raise
+                time.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+    pool = ThreadPool(min(segments, len(ranges)) or 1)
+    try:
+        pool.map(fetch_range, ranges)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _segments_for(spec, request):
+    """
+    Return the number of segments to download the response to ``request``
+    in, or 1 if it should be read as a single stream. Segmented downloads are
+    used if the input spec sets ``segments``, or if the response is at least
+    ``girder_worker.http_segmented_min_size`` bytes, and the server allows
+    byte ranges of the unencoded content.
+    """
+    if spec.get('method', 'GET').upper() != 'GET':
+        return 1
+    if request.headers.get('Accept-Ranges') != 'bytes':
+        return 1
+    if request.headers.get('Content-Encoding', 'identity') != 'identity':
+        return 1
+
+    size = int(request.headers.get('Content-Length', 0))
+    if 'segments' in spec:
+        segments = int(spec['segments'])
+    else:
+        min_size = config.getint('girder_worker', 'http_segmented_min_size')
+        if not min_size or size < min_size:
+            return 1
+        segments = config.getint('girder_worker', 'http_segments')
+
+    return segments if size > 0 else 1
+
+
+def _download(request, spec, path):
+    """
+    Write the body of the response to ``request`` for the given input spec to
+    the file at ``path``, as byte ranges downloaded at once if the response is
+    large enough.
+    """
+    total = 0
+    maxSize = spec.get('maxSize')
+
+    segments = _segments_for(spec, request)
+    if segments > 1:
+        size = int(request.headers['Content-Length'])
+        if maxSize and size > maxSize:
+            raise Exception(
+                'Exceeded max download size of %d bytes.' % maxSize)
+        request.close()
+
+        try:
+            download_segments(
+                spec['url'], path, size, segments, headers=spec.get('headers'),
+                params=spec.get('params'),
+                retries=config.getint('girder_worker', 'http_retries'),
+                etag=request.headers.get('ETag'),
+                last_modified=request.headers.get('Last-Modified'))
+            return
+        except RangeNotSupported:
+            request = requests.request(
+                spec.get('method', 'GET').upper(), spec['url'],
+                headers=spec.get('headers', {}), params=spec.get('params', {}),
+                stream=True, allow_redirects=True)
+            request.raise_for_status()
+
+    with open(path, 'wb') as out:
+        for buf in request.iter_content(65536):
+            length = len(buf)
+            if maxSize and length + total > maxSize:
+                raise Exception(
+                    'Exceeded max download size of %d bytes.' % maxSize)
+            out.write(buf)
+            total += length
+
+
 def fetch(spec, **kwargs):
     """
-    Downloads an input file via HTTP using requests.
+    Downloads an input file via HTTP using requests. If the input cache is
+    enabled, files downloaded to a path are cached, and a cached file is
+    reused if a conditional request shows that it has not changed.
     """
     if 'url' not in spec:
         raise Exception('No URL specified for HTTP input.')
@@ -138,8 +345,22 @@ def fetch(spec, **kwargs):
     target = task_input.get('target', 'memory')
     url = spec['url']
     method = spec.get('method', 'GET').upper()
-    request = requests.request(method, url, headers=spec.get('headers', {}),
-                               params=spec.get('params', {}),
+    headers = spec.get('headers', {})
+    params = spec.get('params', {})
+
+    input_cache = cache.input_cache
+    if target != 'filepath' or method != 'GET' or not spec.get(
+            'use_cache', True):
+        input_cache = None
+
+    entry = None
+    if input_cache is not None:
+        key = input_cache.key(url, headers, params)
+        entry = input_cache.lookup(key)
+        if entry is not None:
+            headers = dict(headers, **input_cache.validators(entry))
+
+    request = requests.request(method, url, headers=headers, params=params,
                                stream=True, allow_redirects=True)
 
     try:
@@ -151,24 +372,39 @@ def fetch(spec, **kwargs):
     if target == 'filepath':
         tmpDir = kwargs['_tempdir']
 
+        if entry is not None and request.status_code == httplib.NOT_MODIFIED:
+            request.close()
+            path = os.path.join(tmpDir, task_input.get(
+                'filename', entry['filename'] or
+                _read_filename_from_resp(request, url)))
+            if input_cache.materialize(entry, path):
+                maxSize = spec.get('maxSize')
+                if maxSize and os.path.getsize(path) > maxSize:
+                    raise Exception(
+                        'Exceeded max download size of %d bytes.' % maxSize)
+                input_cache.hits += 1
+                return path
+
+            # The file was evicted since it was looked up
+            request = requests.request(
+                method, url, headers=spec.get('headers', {}), params=params,
+                stream=True, allow_redirects=True)
+            request.raise_for_status()
+
         if 'filename' in task_input:
             filename = task_input['filename']
         else:
             filename = _read_filename_from_resp(request, url)
 
         path = os.path.join(tmpDir, filename)
-
-        total = 0
-        maxSize = spec.get('maxSize')
-
-        with open(path, 'wb') as out:
-            for buf in request.iter_content(65536):
-                length = len(buf)
-                if maxSize and length + total > maxSize:
-                    raise Exception(
-                        'Exceeded max download size of %d bytes.' % maxSize)
-                out.write(buf)
-                total += length
+        _download(request, spec, path)
+
+        if input_cache is not None:
+            input_cache.misses += 1
+            input_cache.store(
+                key, path, etag=request.headers.get('ETag'),
+                last_modified=request.headers.get('Last-Modified'),
+                filename=filename)
 
         return path
     elif target == 'memory':
@@ -1,3 +1,8 @@
+import os
+
+from girder_worker.core.utils import StreamFetchAdapter, StreamPushAdapter
+
+
 def fetch(spec, **kwargs):
     """
     Fetches a file on the local filesystem into memory.
@@ -12,3 +17,51 @@ def push(data, spec, **kwargs):
     """
     with open(spec['path'], 'wb') as out:
         out.write(data)
+
+
+class LocalStreamFetchAdapter(StreamFetchAdapter):
+    """
+    Streams the file at ``input_spec['path']``. Since the file is read through
+    a plain descriptor, :py:func:`run_process` can copy it into a pipe without
+    it passing through this process.
+    """
+    blocking = False
+
+    def __init__(self, input_spec):
+        super(LocalStreamFetchAdapter, self).__init__(input_spec)
+        self._fd = os.open(input_spec['path'], os.O_RDONLY)
+
+    def read(self, buf_len):
+        return os.read(self._fd, buf_len)
+
+    def source_fd(self):
+        return self._fd
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class LocalStreamPushAdapter(StreamPushAdapter):
+    """
+    Streams data into the file at ``output_spec['path']``. Since the file is
+    written through a plain descriptor, :py:func:`run_process` can copy data
+    into it from a pipe without it passing through this process.
+    """
+    def __init__(self, output_spec):
+        super(LocalStreamPushAdapter, self).__init__(output_spec)
+        self._fd = os.open(
+            output_spec['path'], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+
+    def write(self, buf):
+        while buf:
+            buf = buf[os.write(self._fd, buf):]
+
+    def target_fd(self):
+        return self._fd
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,220 @@
+"""
+Pools of long-lived interpreter processes, such as Julia runtimes or Scala
+REPLs, that executors can send task scripts to instead of starting a new
+interpreter for every task. This avoids paying for interpreter startup and JIT
+or JVM warmup on each task.
+
+Each process reads commands from its stdin. After running a task it prints a
+marker line to its stdout, which tells the pool that the task is done and
+that the process can take another one.
+"""
+import atexit
+import os
+import subprocess
+import sys
+import threading
+
+from girder_worker import config
+
+
+def _rss(pid):
+    """
+    Return the resident memory of the process with the given id in bytes, or
+    0 if it can not be determined on this platform.
+    """
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return 0
+
+
+class InterpreterProcess(object):
+    """
+    A single interpreter process running ``command``, which prints a line
+    containing ``marker`` after it runs each task.
+    """
+    def __init__(self, command, marker):
+        self.command = command
+        self.marker = marker
+        self.tasks = 0
+        self.process = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def memory(self):
+        return _rss(self.process.pid)
+
+    def run(self, lines):
+        """
+        Write the given command lines to the process and wait for it to print
+        the marker. Returns everything the process printed before the marker.
+        """
+        self.tasks += 1
+        self.process.stdin.write(''.join(line + '\n' for line in lines))
+        self.process.stdin.flush()
+
+        output = []
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise Exception(
+                    'Interpreter process %s exited unexpectedly with code '
+                    '%s.\n%s' % (self.command[0], self.process.wait(),
+                                 ''.join(output)))
+            if self.marker in line:
+                output.append(line[:line.index(self.marker)])
+                break
+            output.append(line)
+
+        return ''.join(output)
+
+    def terminate(self):
+        if self.alive():
+            try:
+                self.process.stdin.close()
+                self.process.terminate()
+            except (IOError, OSError):
+                pass
+            self.process.wait()
+
+
+class InterpreterPool(object):
+    """
+    Runs tasks in up to ``size`` interpreter processes at once. Processes are
+    started as they are needed, and are replaced if they exit, once they have
+    run ``max_tasks`` tasks, or once their resident memory grows past
+    ``max_memory`` bytes. A limit of 0 means no limit.
+    """
+    def __init__(self, command, marker, size=1, max_tasks=0, max_memory=0):
+        self.command = list(command)
+        self.marker = marker
+        self.size = size
+        self.max_tasks = max_tasks
+        self.max_memory = max_memory
+
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(size)
+
+    def _new_process(self):
+        """
+        Start a new process for the pool. Subclasses may override this to
+        use a subclass of :py:class:`InterpreterProcess`.
+        """
+        return InterpreterProcess(self.command, self.marker)
+
+    def _acquire(self):
+        self._slots.acquire()
+        with self._lock:
+            while self._idle:
+                process = self._idle.pop()
+                if process.alive():
+                    return process
+        try:
+            return self._new_process()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _release(self, process, reuse=True):
+        if self.max_tasks and process.tasks >= self.max_tasks:
+            reuse = False
+        elif self.max_memory and process.memory() >= self.max_memory:
+            reuse = False
+
+        if reuse and process.alive():
+            with self._lock:
+                self._idle.append(process)
+        else:
+            process.terminate()
+        self._slots.release()
+
+    def run(self, lines):
+        """
+        Run a task by sending ``lines`` to one of the pooled processes. A
+        process that fails while running the task is not reused.
+
+        :param lines: The commands to write to the process.
+        :type lines: list of str
+        :returns: The output printed by the process while running the task.
+        """
+        process = self._acquire()
+        reuse = False
+        try:
+            output = process.run(lines)
+            reuse = True
+            return output
+        finally:
+            self._release(process, reuse)
+
+    def shutdown(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for process in idle:
+            process.terminate()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(section, command, marker):
+    """
+    Return the process-wide pool of interpreters started with ``command``,
+    creating it on first use. The pool is configured by the ``pool_size``,
+    ``pool_max_tasks`` and ``pool_max_memory`` settings in the given config
+    section.
+    """
+    key = (section, tuple(command))
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = InterpreterPool(
+                command, marker,
+                size=max(config.getint(section, 'pool_size'), 1),
+                max_tasks=config.getint(section, 'pool_max_tasks'),
+                max_memory=config.getint(section, 'pool_max_memory'))
+            atexit.register(_pools[key].shutdown)
+        return _pools[key]
+
+
+def run_job(pool, lines, job_dir, pipes=None):
+    """
+    Run a task in a pooled process, where ``lines`` tell the process to run
+    the task with its stdout and stderr written to the ``stdout`` and
+    ``stderr`` files in ``job_dir``. The task must write its error message to
+    the ``status`` file in ``job_dir``, or empty it if it succeeded.
+
+    The task output is written to the ``_stdout`` and ``_stderr`` adapters in
+    ``pipes`` if present, and to the stdout and stderr of the worker
+    otherwise, as :py:func:`girder_worker.core.utils.run_process` does.
+    """
+    pipes = pipes or {}
+    status = os.path.join(job_dir, 'status')
+    with open(status, 'w') as f:
+        f.write('The task script did not run.')
+
+    output = pool.run(lines)
+
+    for id, stream in (('_stdout', sys.stdout), ('_stderr', sys.stderr)):
+        path = os.path.join(job_dir, id[1:])
+        data = ''
+        if os.path.exists(path):
+            with open(path) as f:
+                data = f.read()
+        if id in pipes:
+            pipes[id].write(data)
+            pipes[id].close()
+        else:
+            stream.write(data)
+
+    with open(status) as f:
+        error = f.read().strip()
+    if error:
+        raise Exception('Error in task script: %s\n%s' % (error, output))
@@ -1,5 +1,9 @@
+import array
+import collections
 import contextlib
+import ctypes
 import errno
+import fcntl
 import functools
 import imp
 import os
@@ -13,6 +17,7 @@ import subprocess
 import stat
 import sys
 import tempfile
+import threading
 import time
 import traceback
 
@@ -62,6 +67,99 @@ class TerminalColor(object):
         return TerminalColor._color(TerminalColor.INFO, text)
 
 
+class LogBuffer(object):
+    """
+    Accumulates log messages as a list of chunks, so that appending is cheap
+    regardless of how much has been buffered. If ``limit`` is set and more
+    than ``limit`` bytes are written before the buffer is emptied, only the
+    first and last ``limit / 2`` bytes are kept, and the middle is replaced by
+    a note saying how much was left out. A ``limit`` of 0 or less means the
+    buffer is unlimited. Messages may be written from several threads at once.
+    """
+    def __init__(self, limit=None):
+        self.limit = limit if limit is not None and limit > 0 else None
+        self._lock = threading.Lock()
+        self._reset()
+
+    def __len__(self):
+        return self._size
+
+    def _reset(self):
+        self._chunks = []
+        self._tail = collections.deque()
+        self._tailSize = 0
+        self._size = 0
+        self._dropped = 0
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+
+    def write(self, message):
+        with self._lock:
+            self._write(message)
+
+    def _write(self, message):
+        self._size += len(message)
+        if self._dropped:
+            self._tail.append(message)
+            self._tailSize += len(message)
+            self._trimTail()
+        else:
+            self._chunks.append(message)
+            if self.limit is not None and self._size > self.limit:
+                self._truncate()
+
+    def _truncate(self):
+        # Split the buffered data into the head that is kept and the tail
+        # that is trimmed from the front as more data arrives
+        data = ''.join(self._chunks)
+        half = self.limit // 2
+        self._chunks = [data[:half]]
+        self._tail = collections.deque([data[half:]])
+        self._tailSize = len(data) - half
+        self._trimTail()
+
+    def _trimTail(self):
+        half = self.limit - self.limit // 2
+        while self._tailSize > half:
+            excess = self._tailSize - half
+            first = self._tail[0]
+            if len(first) <= excess:
+                self._tail.popleft()
+                self._tailSize -= len(first)
+                self._dropped += len(first)
+                self._size -= len(first)
+            else:
+                self._tail[0] = first[excess:]
+                self._tailSize -= excess
+                self._dropped += excess
+                self._size -= excess
+
+    def getvalue(self):
+        """
+        Return the buffered messages as a single string.
+        """
+        with self._lock:
+            return self._getvalue()
+
+    def _getvalue(self):
+        data = ''.join(self._chunks)
+        if self._dropped:
+            data += '\n... [%d bytes of log output truncated] ...\n%s' % (
+                self._dropped, ''.join(self._tail))
+        return data
+
+    def pop(self):
+        """
+        Return the buffered messages as a single string and empty the buffer.
+        """
+        with self._lock:
+            data = self._getvalue()
+            self._reset()
+        return data
+
+
 class JobManager(object):
     """
     This class is a context manager that can be used to write log messages to
@@ -71,9 +169,17 @@ class JobManager(object):
 
     It also exposes utilities for updating other job fields such as progress
     and status.
+
+    If ``asynchronous`` is set, updates are handed to a background thread
+    through a bounded queue rather than being sent on the calling thread, so
+    that a task is not blocked by the latency of Girder. Updates that queue up
+    while a request is in flight are coalesced into a single request. Once the
+    queue is full, the calling thread blocks until there is room again. All
+    pending updates are sent before the context is exited.
     """
     def __init__(self, logPrint, url, method=None, headers=None, interval=0.5,
-                 reference=None):
+                 reference=None, asynchronous=False, queueSize=100,
+                 bufferLimit=None):
         """
         :param on: Whether print messages should be logged to the job log.
         :type on: bool
@@ -84,6 +190,14 @@ class JobManager(object):
         back to Girder over HTTP (seconds).
         :type interval: int or float
         :param reference: optional reference to store with the job.
+        :param asynchronous: Whether to send updates from a background thread.
+        :type asynchronous: bool
+        :param queueSize: Maximum number of updates waiting to be sent by the
+            background thread.
+        :type queueSize: int
+        :param bufferLimit: Maximum number of bytes of log output to hold
+            between updates; see :py:class:`LogBuffer`.
+        :type bufferLimit: int or None
         """
         self.logPrint = logPrint
         self.method = method or 'PUT'
@@ -94,10 +208,22 @@ class JobManager(object):
         self.reference = reference
 
         self._last = time.time()
-        self._buf = ''
+        self._buf = LogBuffer(bufferLimit)
+        # Guards the progress fields and flushing, since tasks may write to
+        # the job log from several threads at once
+        self._lock = threading.RLock()
         self._progressTotal = None
         self._progressCurrent = None
         self._progressMessage = None
+        self._session = requests.Session()
+
+        self._sender = None
+        if asynchronous and url:
+            self._queue = six.moves.queue.Queue(queueSize)
+            self._sender = threading.Thread(
+                target=self._sendLoop, name='JobManager sender')
+            self._sender.daemon = True
+            self._sender.start()
 
         if logPrint:
             self._pipes = sys.stdout, sys.stderr
@@ -113,17 +239,20 @@ class JobManager(object):
         previous values. We also set the job status to ERROR if we exited the
         context with an exception, or SUCCESS otherwise.
         """
-        if excType:
-            msg = '%s: %s\n%s' % (
-                excType, excValue, ''.join(traceback.format_tb(tb)))
+        try:
+            if excType:
+                msg = '%s: %s\n%s' % (
+                    excType, excValue, ''.join(traceback.format_tb(tb)))
 
-            self.write(msg)
-            self.updateStatus(JobStatus.ERROR)
-        else:
-            self.updateStatus(JobStatus.SUCCESS)
+                self.write(msg)
+                self.updateStatus(JobStatus.ERROR)
+            else:
+                self.updateStatus(JobStatus.SUCCESS)
 
-        self._flush()
-        self._redirectPipes(False)
+            self._flush()
+        finally:
+            self._stopSender()
+            self._redirectPipes(False)
 
     def _redirectPipes(self, redirect):
         if self.logPrint:
@@ -132,6 +261,55 @@ class JobManager(object):
             else:
                 sys.stdout, sys.stderr = self._pipes
 
+    def _send(self, data):
+        """
+        Send a job update, or queue it to be sent by the background thread.
+        """
+        if self._sender is None:
+            self._redirectPipes(False)
+            try:
+                self._request(data)
+            finally:
+                self._redirectPipes(True)
+        else:
+            self._queue.put(data)
+
+    def _request(self, data):
+        self._session.request(
+            self.method.upper(), self.url, allow_redirects=True,
+            headers=self.headers, data=data)
+
+    def _sendLoop(self):
+        """
+        Body of the background sender thread. Sends everything that has been
+        queued since the last request in as few requests as possible, until
+        the ``None`` sentinel is received.
+        """
+        while True:
+            batch = [self._queue.get()]
+            while batch[-1] is not None:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except six.moves.queue.Empty:
+                    break
+
+            for data in _coalesceJobUpdates(batch):
+                try:
+                    self._request(data)
+                except Exception:
+                    pipe = self._pipes[1] if self.logPrint else sys.stderr
+                    pipe.write('Failed to send job update:\n%s' %
+                               traceback.format_exc())
+
+            if batch[-1] is None:
+                return
+
+    def _stopSender(self):
+        if self._sender is not None:
+            self._queue.put(None)
+            self._sender.join()
+            self._sender = None
+
     def _flush(self):
         """
         If there are contents in the buffer, send them up to the server. If the
@@ -140,21 +318,16 @@ class JobManager(object):
         if not self.url:
             return
 
-        if len(self._buf) or self._progressTotal or self._progressMessage or \
-                self._progressCurrent is not None:
-            self._redirectPipes(False)
-
-            requests.request(
-                self.method.upper(), self.url, allow_redirects=True,
-                headers=self.headers, data={
-                    'log': self._buf,
+        with self._lock:
+            if len(self._buf) or self._progressTotal or \
+                    self._progressMessage or self._progressCurrent is not None:
+                data = {
+                    'log': self._buf.pop(),
                     'progressTotal': self._progressTotal,
                     'progressCurrent': self._progressCurrent,
                     'progressMessage': self._progressMessage
-                })
-            self._buf = ''
-
-            self._redirectPipes(True)
+                }
+                self._send(data)
 
     def flush(self):
         """
@@ -179,13 +352,20 @@ class JobManager(object):
         if self.logPrint:
             self._pipes[0].write(message)
 
-        if type(message) == unicode:
+            if threading.current_thread() is self._sender:
+                return  # printed while sending an update, e.g. a warning
+
+        if isinstance(message, unicode):
             message = message.encode('utf8')
 
-        self._buf += message
-        if forceFlush or time.time() - self._last > self.interval:
-            self._flush()
-            self._last = time.time()
+        self._buf.write(message)
+        self._maybeFlush(forceFlush)
+
+    def _maybeFlush(self, force):
+        with self._lock:
+            if force or time.time() - self._last > self.interval:
+                self._flush()
+                self._last = time.time()
 
     def updateStatus(self, status):
         """
@@ -198,12 +378,10 @@ class JobManager(object):
             return
 
         # Ensure that the logs are flushed before the status is changed
-        self._flush()
-        self.status = status
-        self._redirectPipes(False)
-        requests.request(self.method.upper(), self.url, headers=self.headers,
-                         data={'status': status}, allow_redirects=True)
-        self._redirectPipes(True)
+        with self._lock:
+            self._flush()
+            self.status = status
+            self._send({'status': status})
 
     def updateProgress(self, total=None, current=None, message=None,
                        forceFlush=False):
@@ -220,16 +398,165 @@ class JobManager(object):
             server. Useful if you don't expect another update for some time.
         :type forceFlush: bool
         """
-        if total is not None:
-            self._progressTotal = total
-        if current is not None:
-            self._progressCurrent = current
-        if message is not None:
-            self._progressMessage = message
+        with self._lock:
+            if total is not None:
+                self._progressTotal = total
+            if current is not None:
+                self._progressCurrent = current
+            if message is not None:
+                self._progressMessage = message
 
-        if forceFlush or time.time() - self._last > self.interval:
-            self._flush()
-            self._last = time.time()
+        self._maybeFlush(forceFlush)
+
+
+def _coalesceJobUpdates(updates):
+    """
+    Merge a sequence of job update dicts (ending at the first ``None``, if
+    any) into as few updates as possible, preserving their order. Log
+    messages are concatenated and the latest progress values win. Each update
+    carries at most one status, so that every status change is recorded.
+    """
+    merged = None
+    for update in updates:
+        if update is None:
+            break
+        if merged is None or ('status' in update and 'status' in merged):
+            if merged is not None:
+                yield merged
+            merged = dict(update)
+            continue
+
+        for key, value in update.iteritems():
+            if key == 'log':
+                merged['log'] = merged.get('log', '') + value
+            elif value is not None:
+                merged[key] = value
+
+    if merged is not None:
+        yield merged
+
+
+class CyclicDependencyError(Exception):
+    """
+    Raised when a dependency graph contains a cycle. The ``cycle`` attribute
+    holds one of the shortest cycles in the graph as a list of items, each
+    depending on the next, where the first and last items are the same.
+    """
+    def __init__(self, cycle):
+        self.cycle = cycle
+        super(CyclicDependencyError, self).__init__(
+            'Cyclic dependencies detected: %s' % ' -> '.join(
+                repr(x) for x in cycle))
+
+
+class TopologicalSorter(object):
+    """
+    Incremental topological sort using Kahn's algorithm. Dependencies are
+    expressed as a dictionary whose keys are items and whose values are a set
+    of items they depend on; the dictionary is not modified. Items are handed
+    out by :py:meth:`get_ready` as soon as everything they depend on has been
+    marked finished with :py:meth:`done`, which makes this suitable for
+    driving a scheduler that runs items concurrently::
+
+        sorter = TopologicalSorter(data)
+        while sorter.is_active():
+            for item in sorter.get_ready():
+                start(item)
+            sorter.done(wait_for_any_item())
+
+    A :py:class:`CyclicDependencyError` is raised on construction if the
+    dependency graph is not acyclic.
+    """
+    def __init__(self, data):
+        self._dependents = {}
+        self._npending = {}
+
+        for item, deps in six.viewitems(data):
+            deps = set(deps)
+            deps.discard(item)  # Ignore self dependencies.
+            self._npending[item] = self._npending.get(item, 0) + len(deps)
+
+            for dep in deps:
+                # Add empty dependencies for items that aren't keys of data
+                self._npending.setdefault(dep, 0)
+                self._dependents.setdefault(dep, []).append(item)
+
+        self._ready = collections.deque(
+            item for item, n in six.viewitems(self._npending) if n == 0)
+        self._nactive = 0
+
+        self._check_cycles(data)
+
+    def _check_cycles(self, data):
+        npending = dict(self._npending)
+        queue = list(self._ready)
+        while queue:
+            for dependent in self._dependents.get(queue.pop(), ()):
+                npending[dependent] -= 1
+                if not npending[dependent]:
+                    queue.append(dependent)
+
+        remaining = set(item for item, n in six.viewitems(npending) if n)
+        if remaining:
+            raise CyclicDependencyError(_shortest_cycle(data, remaining))
+
+    def get_ready(self):
+        """
+        Return a tuple of all items that are ready to be processed and have not
+        been returned by a previous call.
+        """
+        ready = tuple(self._ready)
+        self._ready.clear()
+        self._nactive += len(ready)
+        return ready
+
+    def done(self, *items):
+        """
+        Mark the given items, previously returned by :py:meth:`get_ready`, as
+        finished. This may make the items that depend on them ready.
+        """
+        for item in items:
+            self._nactive -= 1
+            for dependent in self._dependents.get(item, ()):
+                self._npending[dependent] -= 1
+                if not self._npending[dependent]:
+                    self._ready.append(dependent)
+
+    def is_active(self):
+        """
+        Whether any items are ready or still waiting to be marked finished.
+        Once this returns ``False``, every item has been processed.
+        """
+        return bool(self._ready) or self._nactive > 0
+
+
+def _shortest_cycle(data, items):
+    """
+    Find one of the shortest cycles in the dependency graph ``data`` among the
+    given items using a breadth-first search from each of them.
+    """
+    best = None
+    for start in sorted(items, key=repr):
+        parents = {}
+        queue = collections.deque([start])
+        while queue:
+            item = queue.popleft()
+            deps = set(data.get(item, ())) & items
+            deps.discard(item)
+            if start in deps:
+                cycle = [start]
+                while item != start:
+                    cycle.append(item)
+                    item = parents[item]
+                cycle = [start] + cycle[:0:-1] + [start]
+                if best is None or len(cycle) < len(best):
+                    best = cycle
+                break
+            for dep in sorted(deps - set(parents), key=repr):
+                parents[dep] = item
+                queue.append(dep)
+
+    return best
 
 
 def toposort(data):
@@ -237,37 +564,121 @@ def toposort(data):
     General-purpose topological sort function. Dependencies are expressed as a
     dictionary whose keys are items and whose values are a set of dependent
     items. Output is a list of sets in topological order. This is a generator
-    function that returns a sequence of sets in topological order.
+    function that returns a sequence of sets in topological order. The input
+    dictionary is not modified.
 
     :param data: The dependency information.
     :type data: dict
     :returns: Yields a list of sorted sets representing the sorted order.
+    :raises CyclicDependencyError: If the dependencies contain a cycle.
     """
     if not data:
         return
 
-    # Ignore self dependencies.
-    for k, v in data.items():
-        v.discard(k)
+    sorter = TopologicalSorter(data)
+    while sorter.is_active():
+        ordered = set(sorter.get_ready())
+        yield ordered
+        sorter.done(*ordered)
 
-    # Find all items that don't depend on anything.
-    extra = functools.reduce(
-        set.union, data.itervalues()) - set(data.iterkeys())
-    # Add empty dependences where needed
-    data.update({item: set() for item in extra})
 
-    # Perform the toposort.
-    while True:
-        ordered = set(item for item, dep in data.iteritems() if not dep)
-        if not ordered:
-            break
-        yield ordered
-        data = {item: (dep - ordered)
-                for item, dep in data.iteritems() if item not in ordered}
-    # Detect any cycles in the dependency graph.
-    if data:
-        raise Exception('Cyclic dependencies detected:\n%s' % '\n'.join(
-                        repr(x) for x in data.iteritems()))
+class LRUCache(object):
+    """
+    A simple thread-safe, size-bounded mapping that evicts the least recently
+    used entries once the total size of the stored entries exceeds
+    ``maxsize``. By default each entry has a size of 1, so ``maxsize`` is the
+    maximum number of entries. The number of cache hits and misses seen by
+    :py:meth:`get` are recorded in the ``hits`` and ``misses`` attributes.
+    """
+    def __init__(self, maxsize=128, weigh=None):
+        """
+        :param maxsize: The maximum total size of the entries to retain. A value
+            of 0 or less disables caching entirely.
+        :type maxsize: int
+        :param weigh: Optional function returning the size of a value, e.g.
+            ``len`` to bound the cache by the number of bytes stored.
+        :type weigh: function
+        """
+        self.maxsize = maxsize
+        self.weigh = weigh or (lambda value: 1)
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """
+        Return the value stored under ``key``, marking it as most recently
+        used, or ``default`` if the key is not present.
+        """
+        with self._lock:
+            try:
+                entry = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """
+        Store ``value`` under ``key``, evicting the least recently used entries
+        if the cache is full. Values larger than ``maxsize`` are not stored.
+        """
+        size = self.weigh(value)
+        if size > self.maxsize:
+            return
+
+        with self._lock:
+            self._discard(key)
+            self._data[key] = (value, size)
+            self._size += size
+            while self._size > self.maxsize:
+                self._size -= self._data.popitem(last=False)[1][1]
+
+    def pop(self, key, default=None):
+        """
+        Remove the entry stored under ``key`` and return its value, or
+        ``default`` if the key is not present.
+        """
+        with self._lock:
+            entry = self._discard(key)
+            return default if entry is None else entry[0]
+
+    def _discard(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self._size -= entry[1]
+        return entry
+
+    def clear(self):
+        """
+        Remove all entries from the cache and reset the hit/miss counters.
+        """
+        with self._lock:
+            self._data.clear()
+            self._size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Return a dictionary describing the current state of the cache.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': self._size,
+            'maxsize': self.maxsize
+        }
 
 
 @contextlib.contextmanager
@@ -382,7 +793,7 @@ def load_plugin(name, paths):
                 name, '\n   '.join(paths)))
 
 
-def _close_pipes(rds, wds, input_pipes, output_pipes, stdout, stderr):
+def _close_pipes(rds, wds, input_pipes, output_pipes, stdout, stderr, stdin):
     """
     Helper to close remaining input and output adapters after the subprocess
     completes.
@@ -396,7 +807,7 @@ def _close_pipes(rds, wds, input_pipes, output_pipes, stdout, stderr):
 
     # close any remaining input adapters
     for fd in wds:
-        if fd in input_pipes:
+        if fd in input_pipes and fd != stdin:
             os.close(fd)
 
 
@@ -409,7 +820,7 @@ def _setup_input_pipes(input_pipes, stdin):
     """
     wds = []
     fifos = {}
-    for pipe, adapter in six.viewitems(input_pipes):
+    for pipe, adapter in list(six.viewitems(input_pipes)):
         if isinstance(pipe, int):
             # This is assumed to be an open system-level file descriptor
             wds.append(pipe)
@@ -446,7 +857,7 @@ def _open_ipipes(wds, fifos, input_pipes):
     return wds, fifos, input_pipes
 
 
-def run_process(command, output_pipes=None, input_pipes=None):
+def run_process(command, output_pipes=None, input_pipes=None, buf_len=None):
     """
     Run a subprocess, and listen for its outputs on various pipes.
 
@@ -470,8 +881,17 @@ def run_process(command, output_pipes=None, input_pipes=None):
         filesystem. This third case supports the use of named pipes, since they
         must be opened for reading before they can be opened for writing
     :type input_pipes: dict
+    :param buf_len: The number of bytes to copy at once between a pipe and its
+        adapter, unless the adapter sets its own ``buf_len``. Defaults to the
+        ``girder_worker.pipe_buffer_size`` config setting.
+    :type buf_len: int
     """
-    BUF_LEN = 65536
+    FIFO_OPEN_INTERVAL = 0.1  # seconds between attempts to open input fifos
+    if buf_len is None:
+        buf_len = girder_worker.config.getint(
+            'girder_worker', 'pipe_buffer_size')
+    pipe_size = girder_worker.config.getint(
+        'girder_worker', 'pipe_kernel_buffer_size')
     input_pipes = input_pipes or {}
     output_pipes = output_pipes or {}
     p = subprocess.Popen(args=command, stdout=subprocess.PIPE,
@@ -481,6 +901,8 @@ def run_process(command, output_pipes=None, input_pipes=None):
     stdout = p.stdout.fileno()
     stderr = p.stderr.fileno()
     stdin = p.stdin.fileno()
+    for fd in (stdout, stderr, stdin):
+        _set_pipe_size(fd, pipe_size)
     output_pipes[stdout] = output_pipes.get(
         '_stdout', WritePipeAdapter({}, sys.stdout))
     output_pipes[stderr] = output_pipes.get(
@@ -488,72 +910,429 @@ def run_process(command, output_pipes=None, input_pipes=None):
 
     rds = [fd for fd in output_pipes.keys() if isinstance(fd, int)]
     wds, fifos = _setup_input_pipes(input_pipes, stdin)
+    pending = {}  # data read from input adapters but not yet written
+
+    # Pipes that can not be copied to or from in the kernel, or None if
+    # copying in the kernel is disabled altogether
+    copy_fallback = set() if girder_worker.config.getboolean(
+        'girder_worker', 'pipe_zero_copy') else None
+
+    # Read from blocking input adapters on their own threads
+    for fd in wds:
+        input_pipes[fd] = _threaded_adapter(input_pipes[fd], buf_len)
+    for fifo in fifos:
+        fifos[fifo] = _threaded_adapter(fifos[fifo], buf_len)
+    adapters = set(input_pipes.values()) | set(fifos.values())
+
+    # Wait for the process on another thread, which wakes up the loop below
+    # by writing to a pipe once the process has exited.
+    wakeup_r, wakeup_w = os.pipe()
+    exited = threading.Event()
+
+    def wait():
+        p.wait()
+        os.write(wakeup_w, '\0')
+        exited.set()
+
+    waiter = threading.Thread(target=wait)
+    waiter.daemon = True
+    waiter.start()
 
     try:
-        while True:
-            status = p.poll()
-            # get ready pipes
-            readable, writable, _ = select.select(rds, wds, (), 0)
+        for fd in wds:
+            _set_nonblocking(fd)
+
+        while rds or wds or fifos:
+            if exited.is_set():
+                timeout = 0  # drain whatever is left, but do not wait
+            elif fifos:
+                timeout = FIFO_OPEN_INTERVAL
+            else:
+                timeout = None
+
+            # Only wait to write to pipes that have data ready to be written,
+            # and otherwise wait for their input adapter to have data.
+            ready_wds, waiting = [], []
+            for fd in wds:
+                if fd in pending or input_pipes[fd].ready():
+                    ready_wds.append(fd)
+                else:
+                    waiting.append(input_pipes[fd].fileno())
+            if not exited.is_set():
+                waiting.append(wakeup_r)
+
+            readable, writable = _wait_for_pipes(
+                rds + waiting, ready_wds, timeout)
 
             for ready_pipe in readable:
-                buf = os.read(ready_pipe, BUF_LEN)
+                if ready_pipe not in output_pipes:
+                    continue  # only there to wake us up
 
-                if buf:
-                    output_pipes[ready_pipe].write(buf)
-                else:
+                if not _read_output(ready_pipe, output_pipes[ready_pipe],
+                                    buf_len, copy_fallback):
                     output_pipes[ready_pipe].close()
                     if ready_pipe not in (stdout, stderr):
                         # bad things happen if parent closes stdout or stderr
                         os.close(ready_pipe)
                     rds.remove(ready_pipe)
             for ready_pipe in writable:
-                # TODO for now it's OK for the input reads to block since
-                # input generally happens first, but we should consider how to
-                # support non-blocking stream inputs in the future.
-                buf = input_pipes[ready_pipe].read(BUF_LEN)
-
-                if buf:
-                    os.write(ready_pipe, buf)
-                else:   # end of stream
+                if not _write_input(ready_pipe, input_pipes[ready_pipe],
+                                    buf_len, pending, copy_fallback):
+                    # end of stream
                     wds.remove(ready_pipe)
-                    os.close(ready_pipe)
+                    if ready_pipe == stdin:
+                        p.stdin.close()  # the file object owns the descriptor
+                    else:
+                        os.close(ready_pipe)
 
+            opened = len(wds)
             wds, fifos, input_pipes = _open_ipipes(wds, fifos, input_pipes)
-            empty = (not rds or not readable) and (not wds or not writable)
-            if empty and status is not None:
+            for fd in wds[opened:]:
+                _set_nonblocking(fd)
+                _set_pipe_size(fd, pipe_size)
+
+            if exited.is_set() and not readable and not writable:
                 # all pipes are empty and the process has returned, we are done
                 break
-            elif not rds and not wds and status is None:
-                # all pipes are closed but the process is still running
-                p.wait()
     except Exception:
         p.kill()  # kill child process if something went wrong on our end
         raise
     finally:
-        _close_pipes(rds, wds, input_pipes, output_pipes, stdout, stderr)
+        _close_pipes(rds, wds, input_pipes, output_pipes, stdout, stderr,
+                     stdin)
+        p.stdin.close()
+        for adapter in adapters:
+            adapter.close()
+        exited.wait()  # the waiter must be done with the wakeup pipe
+        os.close(wakeup_r)
+        os.close(wakeup_w)
 
     return p
 
 
+def _threaded_adapter(adapter, buf_len):
+    if not adapter.blocking:
+        return adapter
+    return ThreadedFetchAdapter(adapter, adapter.buf_len or buf_len)
+
+
+def _read_output(fd, adapter, buf_len, copy_fallback):
+    """
+    Pass the data available on the output pipe ``fd`` to its adapter,
+    returning ``False`` at the end of the stream. If the adapter writes to a
+    descriptor of its own, the data is spliced into it directly unless ``fd``
+    is in ``copy_fallback`` (or it is ``None``).
+    """
+    buf_len = adapter.buf_len or buf_len
+    target = None
+    if copy_fallback is not None and fd not in copy_fallback:
+        target = adapter.target_fd()
+    if target is not None:
+        copied = _zero_copy(
+            _libc_splice, fd, None, target, None, buf_len,
+            _SPLICE_F_MOVE | _SPLICE_F_NONBLOCK)
+        if copied is not None:
+            return copied != 0
+        copy_fallback.add(fd)
+
+    buf = os.read(fd, buf_len)
+    if buf:
+        adapter.write(buf)
+    return bool(buf)
+
+
+def _write_input(fd, adapter, buf_len, pending, copy_fallback):
+    """
+    Write the next chunk of input from its adapter to the non-blocking pipe
+    ``fd``, returning ``False`` at the end of the stream. Data the pipe does
+    not accept is kept in ``pending``. If the adapter reads from a descriptor
+    of its own, the data is sent from it directly unless ``fd`` is in
+    ``copy_fallback`` (or it is ``None``).
+    """
+    buf = pending.pop(fd, None)
+    if buf is None:
+        buf_len = adapter.buf_len or buf_len
+        source = None
+        if copy_fallback is not None and fd not in copy_fallback:
+            source = adapter.source_fd()
+        if source is not None:
+            copied = _zero_copy(_libc_sendfile, fd, source, None, buf_len)
+            if copied is not None:
+                return copied != 0
+            copy_fallback.add(fd)
+
+        buf = adapter.read(buf_len)
+        if buf is None:
+            return True  # no input data available yet
+
+    if not buf:
+        return False
+
+    written = _write_nonblocking(fd, buf)
+    if written < len(buf):
+        pending[fd] = buf[written:]
+    return True
+
+
+def _set_pipe_size(fd, size):
+    """
+    Set the size of the kernel buffer of the pipe ``fd`` to ``size`` bytes,
+    where supported (Linux). This is best effort; failures are ignored.
+    """
+    if size and _F_SETPIPE_SZ is not None:
+        try:
+            fcntl.fcntl(fd, _F_SETPIPE_SZ, size)
+        except (IOError, OSError, OverflowError):
+            pass  # not a pipe, or larger than /proc/sys/fs/pipe-max-size
+
+
+def _libc_function(name, restype, *argtypes):
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        fn = getattr(ctypes.CDLL(None, use_errno=True), name)
+    except (AttributeError, OSError):
+        return None
+    fn.restype = restype
+    fn.argtypes = argtypes
+    return fn
+
+
+if sys.platform.startswith('linux'):
+    _F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+else:
+    _F_SETPIPE_SZ = None
+_SPLICE_F_MOVE = 1
+_SPLICE_F_NONBLOCK = 2
+_libc_splice = _libc_function(
+    'splice', ctypes.c_ssize_t, ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+    ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint)
+_libc_sendfile = _libc_function(
+    'sendfile', ctypes.c_ssize_t, ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+    ctypes.c_size_t)
+
+
+def _zero_copy(fn, *args):
+    """
+    Copy data between descriptors in the kernel by calling the libc function
+    ``fn`` (``splice`` or ``sendfile``) with the given arguments. Returns the
+    number of bytes copied, ``0`` at the end of the stream, ``-1`` if the copy
+    would block, or ``None`` if the descriptors can not be copied between this
+    way and the data should be read and written instead.
+    """
+    if fn is None:
+        return None  # not available on this platform
+
+    copied = fn(*args)
+    if copied >= 0:
+        return copied
+
+    err = ctypes.get_errno()
+    if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+        return -1
+    if err in (errno.EINVAL, errno.ENOSYS, errno.EBADF):
+        return None
+    raise OSError(err, os.strerror(err))
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def _write_nonblocking(fd, buf):
+    """
+    Write as much of ``buf`` to the non-blocking descriptor ``fd`` as it will
+    accept, returning the number of bytes written.
+    """
+    try:
+        return os.write(fd, buf)
+    except OSError as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return 0
+        raise
+
+
+def _wait_for_pipes(rds, wds, timeout=None):
+    """
+    Block until some of the given descriptors are ready for reading or
+    writing, or until ``timeout`` seconds have passed if it is not ``None``.
+    Uses ``poll`` where available, since unlike ``select`` it is not limited
+    in the values of descriptors it can wait on.
+
+    :returns: A tuple of the lists of readable and writable descriptors.
+    """
+    if not hasattr(select, 'poll'):
+        readable, writable, _ = _eintr_retry(
+            select.select, rds, wds, (), timeout)
+        return readable, writable
+
+    poller = select.poll()
+    for fd in rds:
+        poller.register(fd, select.POLLIN | select.POLLPRI)
+    for fd in wds:
+        poller.register(fd, select.POLLOUT)
+
+    events = _eintr_retry(
+        poller.poll, None if timeout is None else int(timeout * 1000))
+
+    readable, writable = [], []
+    for fd, event in events:
+        # Hang-ups and errors are reported as ready so that the following read
+        # or write will see the end of the stream or raise the error.
+        if fd in rds and event & ~select.POLLOUT:
+            readable.append(fd)
+        if fd in wds and event & ~(select.POLLIN | select.POLLPRI):
+            writable.append(fd)
+    return readable, writable
+
+
+def _eintr_retry(fn, *args):
+    while True:
+        try:
+            return fn(*args)
+        except (OSError, select.error) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+
 class StreamFetchAdapter(object):
     """
     This represents the interface that must be implemented by fetch adapters
     for IO modes that want to implement streaming input.
     """
+    #: Whether ``read`` may block, e.g. while waiting on the network.
+    #: :py:func:`run_process` reads from blocking adapters on a separate thread
+    #: (see :py:class:`ThreadedFetchAdapter`) so that they do not hold up the
+    #: other pipes of the process.
+    blocking = True
+
+    #: The number of bytes to read at once, if not the default for the pipe.
+    buf_len = None
+
     def __init__(self, input_spec):
         self.input_spec = input_spec
 
     def read(self, buf_len):
         """
         Fetch adapters must implement this method, which is responsible for
-        reading up to ``self.buf_len`` bytes from the stream. For now, this is
-        expected to be a blocking read, and should return an empty string to
-        indicate the end of the stream.
+        reading up to ``self.buf_len`` bytes from the stream. This may be a
+        blocking read, and should return an empty string to indicate the end of
+        the stream.
         """
         raise NotImplemented
 
+    def ready(self):
+        """
+        Whether ``read`` will return data (or the end of the stream) right
+        away. Adapters that only return data when it is available should
+        override this, as well as ``fileno``, which returns a descriptor that
+        becomes readable when they are ready.
+        """
+        return True
+
+    def source_fd(self):
+        """
+        Adapters that read from a file descriptor may return it here, in which
+        case :py:func:`run_process` copies from it into the pipe directly,
+        without the data passing through this process, where possible.
+        """
+        return None
+
+    def close(self):
+        """
+        Release any resources held by the adapter. Called once the stream is
+        no longer needed, whether or not it was read to the end.
+        """
+        pass
+
+
+class ThreadedFetchAdapter(StreamFetchAdapter):
+    """
+    Wraps a blocking fetch adapter, reading from it on a background thread
+    into a buffer of at most ``max_chunks`` chunks of ``buf_len`` bytes. The
+    ``read`` method of this adapter never blocks: it returns ``None`` if no
+    data is buffered yet. The descriptor returned by ``fileno`` is readable
+    whenever there is buffered data or the end of the stream was reached, so
+    it can be waited on along with other pipes.
+    """
+    blocking = False
+
+    def __init__(self, adapter, buf_len=65536, max_chunks=16):
+        super(ThreadedFetchAdapter, self).__init__(adapter.input_spec)
+        self.adapter = adapter
+        self.buf_len = buf_len
+
+        self._chunks = six.moves.queue.Queue(max_chunks)
+        self._current = b''  # the unread part of the chunk being read
+        self._error = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self._notify_r, self._notify_w = os.pipe()
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                buf = self.adapter.read(self.buf_len)
+            except Exception:
+                self._error = sys.exc_info()
+                buf = b''
+
+            self._chunks.put(buf)  # waits while the buffer is full
+            with self._lock:
+                if self._closed:
+                    return
+                os.write(self._notify_w, b'\0')  # one byte per chunk
+            if not buf:
+                return
+
+    def fileno(self):
+        return self._notify_r
+
+    def ready(self):
+        return bool(self._current) or not self._chunks.empty()
+
+    def read(self, buf_len):
+        if not self._current:
+            try:
+                chunk = self._chunks.get_nowait()
+            except six.moves.queue.Empty:
+                return None
+            os.read(self._notify_r, 1)
+
+            if not chunk:
+                if self._error is not None:
+                    raise self._error[0], self._error[1], self._error[2]
+                return b''
+            self._current = chunk
+
+        buf, self._current = self._current[:buf_len], self._current[buf_len:]
+        return buf
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            os.close(self._notify_r)
+            os.close(self._notify_w)
+
+        # Make room for a reader thread waiting on a full buffer, so it exits
+        try:
+            while True:
+                self._chunks.get_nowait()
+        except six.moves.queue.Empty:
+            pass
+        self.adapter.close()
+
 
 class MemoryFetchAdapter(StreamFetchAdapter):
+    blocking = False
+
     def __init__(self, input_spec, data):
         """
         Simply reads data from memory. This can be used to map traditional
@@ -572,6 +1351,9 @@ class StreamPushAdapter(object):
     This represents the interface that must be implemented by push adapters for
     IO modes that want to implement streaming output.
     """
+    #: The number of bytes to write at once, if not the default for the pipe.
+    buf_len = None
+
     def __init__(self, output_spec):
         """
         Initialize the adpater based on the output spec.
@@ -584,6 +1366,14 @@ class StreamPushAdapter(object):
         """
         raise NotImplemented
 
+    def target_fd(self):
+        """
+        Adapters that write to a file descriptor may return it here, in which
+        case :py:func:`run_process` copies data from the pipe into it directly,
+        without the data passing through this process, where possible.
+        """
+        return None
+
     def close(self):
         """
         Close the output stream. Called after the last data is sent.
@@ -608,12 +1398,117 @@ class WritePipeAdapter(StreamPushAdapter):
         self.pipe.write(buf)
 
 
+def stream_output_path(task_output, name, tempdir):
+    """
+    Return the path of the file that the ``_stdout`` or ``_stderr`` output
+    ``name`` should be written to if its task output spec has a ``filepath``
+    target, or ``None`` if it should be held in memory.
+    """
+    if task_output.get('target') != 'filepath':
+        return None
+    return os.path.join(tempdir, name)
+
+
+def _int64_typecode():
+    for code in ('l', 'q'):
+        try:
+            if array.array(code).itemsize == 8:
+                return code
+        except ValueError:
+            pass
+    return None
+
+
+# The array module typecodes of the element types of numeric arrays
+ARRAY_TYPECODES = {
+    'float64': 'd',
+    'int64': _int64_typecode()
+}
+
+
+def numeric_array_type(value):
+    """
+    Return the element type, ``'int64'`` or ``'float64'``, that a list of
+    numbers can be stored as in a binary array file, or ``None`` if ``value``
+    is not a non-empty list of numbers or holds integers that do not fit in
+    64 bits, which can only be passed losslessly as JSON.
+    """
+    if not isinstance(value, (list, tuple)) or not value:
+        return None
+
+    dtype = 'int64'
+    for item in value:
+        if isinstance(item, bool):
+            return None
+        elif isinstance(item, six.integer_types):
+            if not -2 ** 63 <= item < 2 ** 63:
+                return None
+        elif isinstance(item, float):
+            dtype = 'float64'
+        else:
+            return None
+
+    if ARRAY_TYPECODES[dtype] is None:
+        return None
+    return dtype
+
+
+def write_numeric_array(path, value, dtype):
+    """
+    Write a list of numbers to a file as a raw array of ``dtype`` elements in
+    native byte order, which programs in other languages can read without
+    parsing text.
+    """
+    with open(path, 'wb') as f:
+        array.array(ARRAY_TYPECODES[dtype], value).tofile(f)
+
+
+def read_numeric_array(path, dtype):
+    """
+    Read a list of numbers from a file written as a raw array of ``dtype``
+    elements in native byte order.
+    """
+    values = array.array(ARRAY_TYPECODES[dtype])
+    with open(path, 'rb') as f:
+        values.fromfile(f, os.fstat(f.fileno()).st_size // values.itemsize)
+    return values.tolist()
+
+
+# The element types of the binary array files that outputs in these formats
+# are returned in
+ARRAY_OUTPUT_FORMATS = {
+    'number_list': 'float64',
+    'integer_list': 'int64'
+}
+
+
+def numeric_array_input_type(task_input, value):
+    """
+    Return the element type to pass an input bound to ``value`` as a binary
+    array file, or ``None`` to pass it as JSON. Only inputs declared in the
+    ``number_list`` or ``integer_list`` formats are passed as arrays, so a
+    list of numbers in e.g. a ``json`` input keeps its JSON representation.
+    """
+    if task_input.get('format') not in ARRAY_OUTPUT_FORMATS:
+        return None
+    return numeric_array_type(value)
+
+
 class AccumulateDictAdapter(StreamPushAdapter):
-    def __init__(self, output_spec, key, dictionary=None):
+    def __init__(self, output_spec, key, dictionary=None, path=None,
+                 spill_threshold=None, memory_limit=None):
         """
-        Appends all data from a stream under a key inside a dict. Can be used
-        to bind traditional (non-streaming) outputs to pipes when using
-        ``run_process``.
+        Collects all data from a stream and stores it under a key inside a
+        dict once the stream is closed. Can be used to bind traditional
+        (non-streaming) outputs to pipes when using ``run_process``.
+
+        The data is held in memory until more than ``spill_threshold`` bytes
+        have been received, after which it is written to a temporary file and
+        only read back into memory when the stream is closed. Closing the
+        stream raises an exception rather than reading back more than
+        ``memory_limit`` bytes. If ``path`` is given, the data is instead
+        written to that file, and its path is stored under the key, so it
+        never has to be held in memory.
 
         :param output_spec: The output specification.
         :type output_spec: dict
@@ -622,6 +1517,16 @@ class AccumulateDictAdapter(StreamPushAdapter):
         :param dictionary: Dictionary to write into. If not specified, uses the
             output_spec.
         :type dictionary: dict
+        :param path: Path of a file to write the data to instead.
+        :type path: str
+        :param spill_threshold: The number of bytes to hold in memory. Defaults
+            to the ``girder_worker.output_spill_threshold`` config setting; 0
+            means no limit.
+        :type spill_threshold: int
+        :param memory_limit: The number of bytes that may be stored under the
+            key. Defaults to the ``girder_worker.output_memory_limit`` config
+            setting; 0 means no limit.
+        :type memory_limit: int
         """
         super(AccumulateDictAdapter, self).__init__(output_spec)
 
@@ -631,8 +1536,58 @@ class AccumulateDictAdapter(StreamPushAdapter):
         if key not in dictionary:
             dictionary[key] = ''
 
+        if spill_threshold is None:
+            spill_threshold = girder_worker.config.getint(
+                'girder_worker', 'output_spill_threshold')
+        if memory_limit is None:
+            memory_limit = girder_worker.config.getint(
+                'girder_worker', 'output_memory_limit')
+
         self.dictionary = dictionary
         self.key = key
+        self.path = path
+        self.spill_threshold = spill_threshold
+        self.memory_limit = memory_limit
+
+        self._chunks = []
+        self._size = 0
+        self._file = open(path, 'wb') if path else None
 
     def write(self, buf):
-        self.dictionary[self.key] += buf
+        self._size += len(buf)
+        if self._file is not None:
+            self._file.write(buf)
+            return
+
+        self._chunks.append(buf)
+        if self.spill_threshold and self._size > self.spill_threshold:
+            self._file = tempfile.TemporaryFile()
+            self._file.writelines(self._chunks)
+            self._chunks = []
+
+    def close(self):
+        if self.path:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self.dictionary[self.key] = self.path
+            return
+
+        if self.memory_limit and self._size > self.memory_limit:
+            size, self._size, self._chunks = self._size, 0, []
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            raise Exception(
+                'Output of %d bytes exceeds the output_memory_limit of %d '
+                'bytes. Give the output a "filepath" target to have it written '
+                'to a file instead.' % (size, self.memory_limit))
+
+        if self._file is not None:
+            self._file.seek(0)
+            self.dictionary[self.key] += self._file.read()
+            self._file.close()
+            self._file = None
+        elif self._chunks:
+            self.dictionary[self.key] += ''.join(self._chunks)
+            self._chunks = []
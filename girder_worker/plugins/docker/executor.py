@@ -148,6 +148,19 @@ def validate_task_outputs(task_outputs):
                 'filepath-target outputs.')
 
 
+def _output_path(spec, name, tempdir):
+    """
+    Return the path on the host of the file for a ``filepath`` output.
+    """
+    path = spec.get('path', name)
+    if not path.startswith('/'):
+        # Assume relative paths are relative to the data volume
+        path = os.path.join(DATA_VOLUME, path)
+
+    # Convert data volume refs to the temp dir on the host
+    return path.replace(DATA_VOLUME, tempdir, 1)
+
+
 def _setup_pipes(task_inputs, inputs, task_outputs, outputs, tempdir):
     """
     Returns a 2 tuple of input and output pipe mappings. The first element is
@@ -203,8 +216,11 @@ def _setup_pipes(task_inputs, inputs, task_outputs, outputs, tempdir):
             if task_outputs[id].get('stream'):
                 opipes[id] = make_stream_push_adapter(outputs[id])
             else:
+                path = None
+                if task_outputs[id].get('target') == 'filepath':
+                    path = _output_path(task_outputs[id], id, tempdir)
                 opipes[id] = utils.AccumulateDictAdapter(
-                    outputs[id], 'script_data')
+                    outputs[id], 'script_data', path=path)
 
     return ipipes, opipes
 
@@ -249,13 +265,7 @@ def run(task, inputs, outputs, task_inputs, task_outputs, **kwargs):
 
     for name, spec in task_outputs.iteritems():
         if spec.get('target') == 'filepath' and not spec.get('stream'):
-            path = spec.get('path', name)
-            if not path.startswith('/'):
-                # Assume relative paths are relative to the data volume
-                path = os.path.join(DATA_VOLUME, path)
-
-            # Convert data volume refs to the temp dir on the host
-            path = path.replace(DATA_VOLUME, tempdir, 1)
+            path = _output_path(spec, name, tempdir)
             if not os.path.exists(path):
                 raise Exception('Output filepath %s does not exist.' % path)
             outputs[name]['script_data'] = path
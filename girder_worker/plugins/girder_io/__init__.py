@@ -1,6 +1,17 @@
+import collections
+import contextlib
+import functools
 import girder_client
 import os
+import requests
+import shutil
+import six
+import tempfile
+import threading
+import time
+import weakref
 from girder_worker import config
+from multiprocessing.pool import ThreadPool
 from six import StringIO
 
 
@@ -19,11 +30,139 @@ def _get_cache_settings(spec):
     )
 
 
-def _init_client(spec, require_token=False):
+class GirderClient(girder_client.GirderClient):
+    """
+    A Girder client that sends all of its requests through one
+    ``requests.Session``, so that connections to the server are kept alive
+    and reused from one request to the next.
+    """
+    def __init__(self, *args, **kwargs):
+        super(GirderClient, self).__init__(*args, **kwargs)
+        self.created = time.time()
+        self.users = 0
+        self.evicted = False
+        self.session = requests.Session()
+        self.METHODS = {
+            method: functools.partial(self.session.request, method)
+            for method in girder_client.GirderClient.METHODS
+        }
+
+        # Allow a connection per download thread
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(
+            config.getint('girder_io', 'download_threads'),
+            requests.adapters.DEFAULT_POOLSIZE))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        """
+        Close the connections of the client's session, and its cache.
+        """
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
+
+    def downloadFile(self, fileId, path, created=None, size=None):
+        """
+        Download a file to the given local path or file-like object, as
+        :py:meth:`girder_client.GirderClient.downloadFile` does, but over the
+        client's session. Files of at least
+        ``girder_worker.http_segmented_min_size`` bytes are downloaded as
+        several byte ranges at once.
+        """
+        if created is None or size is None:
+            file = self.getFile(fileId)
+            created, size = file['created'], file.get('size')
+        cacheKey = '\n'.join([self.urlBase, fileId, created])
+
+        # see if file is in local cache
+        if self.cache is not None:
+            fp = self.cache.get(cacheKey, read=True)
+            if fp:
+                with fp:
+                    self._materializeFile(fp, path)
+                return
+
+        from girder_worker.core.io import http
+
+        # download to a tempfile
+        url = '%sfile/%s/download' % (self.urlBase, fileId)
+        headers = {'Girder-Token': self.token}
+        with tempfile.NamedTemporaryFile(delete=False) as tmp:
+            segments = 1
+            min_size = config.getint('girder_worker', 'http_segmented_min_size')
+            if size and min_size and size >= min_size:
+                segments = config.getint('girder_worker', 'http_segments')
+
+            if segments > 1:
+                try:
+                    http.download_segments(
+                        url, tmp.name, size, segments, headers=headers,
+                        retries=config.getint('girder_worker', 'http_retries'),
+                        session=self.session)
+                except http.RangeNotSupported:
+                    # Start over with a single stream
+                    tmp.seek(0)
+                    tmp.truncate()
+                    segments = 1
+
+            if segments <= 1:
+                req = self.session.get(url, stream=True, headers=headers)
+                req.raise_for_status()
+                for chunk in req.iter_content(
+                        chunk_size=girder_client.REQ_BUFFER_SIZE):
+                    tmp.write(chunk)
+
+        # save file in cache
+        if self.cache is not None:
+            with open(tmp.name, 'rb') as fp:
+                self.cache.set(cacheKey, fp, read=True)
+
+        if isinstance(path, six.string_types):
+            # we can just rename the tempfile
+            girder_client._safeMakedirs(os.path.dirname(path))
+            shutil.move(tmp.name, path)
+        else:
+            # write to file-like object
+            with open(tmp.name, 'rb') as fp:
+                shutil.copyfileobj(fp, path)
+            os.remove(tmp.name)
+
+    def _materializeFile(self, fp, path):
+        """
+        Write a file read from the cache to ``path``. If the cache holds it as
+        a file on disk and ``diskcache_link_files`` is set, it is reflinked
+        where the filesystem allows, so that its data is shared with the
+        cache's copy until either is modified. Files are never hard linked,
+        since tasks could then change the cached copy through their inputs.
+        The clone is made through ``fp``, which pins the cached file while it
+        is in use, so eviction can not remove it from under the job.
+        """
+        if (isinstance(path, six.string_types) and
+                isinstance(getattr(fp, 'name', None), six.string_types) and
+                config.getboolean('girder_io', 'diskcache_link_files')):
+            from girder_worker.core.cache import materialize
+
+            girder_client._safeMakedirs(os.path.dirname(path))
+            materialize(fp, path)
+            return
+
+        self._copyFile(fp, path)
+
+
+# Seconds to wait before retrying a failed download, doubled on each retry
+RETRY_BACKOFF = 1.0
+
+# Clients shared by the inputs and outputs of all jobs in this process, keyed
+# by the server, token and cache settings they were created with
+_clients = collections.OrderedDict()
+_clients_lock = threading.Lock()
+
+
+def _client_args(spec):
+    cache_settings = _get_cache_settings(spec)
     if 'api_url' in spec:
-        client = girder_client.GirderClient(
-            apiUrl=spec['api_url'],
-            cacheSettings=_get_cache_settings(spec))
+        return dict(apiUrl=spec['api_url'], cacheSettings=cache_settings)
     elif 'host' in spec:
         scheme = spec.get('scheme', 'http')
         port = spec.get('port', {
@@ -31,22 +170,192 @@ def _init_client(spec, require_token=False):
             'https': 443
         }[scheme])
         api_root = spec.get('api_root', '/api/v1')
-        client = girder_client.GirderClient(
-            host=spec['host'], scheme=scheme, apiRoot=api_root, port=port,
-            cacheSettings=_get_cache_settings(spec))
+        return dict(host=spec['host'], scheme=scheme, apiRoot=api_root,
+                    port=port, cacheSettings=cache_settings)
     else:
         raise Exception('You must pass either an api_url or host key for '
                         'Girder input and output bindings.')
 
-    if 'token' in spec:
-        client.token = spec['token']
-    elif require_token:
+
+def _evict_client(client):
+    # Called with _clients_lock held. Clients still used by a job are closed
+    # once the last of those jobs releases them.
+    client.evicted = True
+    if not client.users:
+        client.close()
+
+
+def _init_client(spec, require_token=False):
+    """
+    Return a client for the server and token of the given binding, reusing
+    a pooled one if possible. The caller must hand the client back with
+    :py:func:`_release_client` once it is done with it.
+    """
+    if 'token' not in spec and require_token:
         raise Exception('You must pass a token for Girder authentication.')
 
+    args = _client_args(spec)
+    key = (tuple(sorted((name, value) for name, value in args.items()
+                        if name != 'cacheSettings')),
+           tuple(sorted((args['cacheSettings'] or {}).items())),
+           spec.get('token'))
+    pool_size = config.getint('girder_io', 'client_pool_size')
+    max_age = config.getint('girder_io', 'client_max_age')
+
+    with _clients_lock:
+        client = _clients.pop(key, None)
+        if client is not None and max_age and (
+                time.time() - client.created > max_age):
+            _evict_client(client)
+            client = None
+
+        if client is None:
+            client = GirderClient(**args)
+            if 'token' in spec:
+                client.token = spec['token']
+        client.users += 1
+
+        if pool_size > 0:
+            _clients[key] = client
+            while len(_clients) > pool_size:
+                _evict_client(_clients.popitem(last=False)[1])
+        else:
+            client.evicted = True
+
     return client
 
 
-def _fetch_parent_item(file_id, client, dest):
+def _release_client(client):
+    """
+    Hand back a client returned by :py:func:`_init_client`, closing it if it
+    was evicted from the pool and no other job is using it.
+    """
+    with _clients_lock:
+        client.users -= 1
+        if client.evicted and not client.users:
+            client.close()
+
+
+@contextlib.contextmanager
+def _client(spec, require_token=False):
+    client = _init_client(spec, require_token)
+    try:
+        yield client
+    finally:
+        _release_client(client)
+
+
+class _Progress(object):
+    """
+    Adds up the progress of all downloads of a job, which may be running at
+    the same time, and reports it through the job manager.
+    """
+    def __init__(self, job_manager):
+        self.job_manager = job_manager
+        self.total = 0
+        self.current = 0
+        self.lock = threading.Lock()
+
+    def add(self, total=0, current=0):
+        with self.lock:
+            self.total += total
+            self.current += current
+            self.job_manager.updateProgress(
+                total=self.total, current=self.current,
+                message='Downloading inputs from Girder')
+
+
+_progress = weakref.WeakKeyDictionary()
+_progress_lock = threading.Lock()
+
+
+def _job_progress(job_manager):
+    if job_manager is None:
+        return None
+    with _progress_lock:
+        if job_manager not in _progress:
+            _progress[job_manager] = _Progress(job_manager)
+        return _progress[job_manager]
+
+
+def _download_files(client, files, job_manager=None):
+    """
+    Download a list of ``(file, path)`` pairs, where each file is a Girder
+    file document, using up to ``girder_io.download_threads`` threads. Each
+    download is retried ``girder_io.download_retries`` times if it fails, and
+    the number of bytes downloaded is reported as the progress of the job.
+    """
+    threads = config.getint('girder_io', 'download_threads')
+    retries = config.getint('girder_io', 'download_retries')
+    progress = _job_progress(job_manager)
+    if progress is not None:
+        progress.add(total=sum(file.get('size', 0) for file, _ in files))
+
+    def download(entry):
+        file, path = entry
+        for attempt in range(retries + 1):
+            try:
+                client.downloadFile(file['_id'], path, created=file['created'],
+                                    size=file.get('size'))
+                break
+            except IOError as e:
+                # Client errors such as a missing file are not worth retrying
+                response = getattr(e, 'response', None)
+                if attempt == retries or (
+                        response is not None and response.status_code < 500):
+                    raise
+                time.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+        if progress is not None:
+            progress.add(current=file.get('size', 0))
+
+    if len(files) < 2 or threads < 2:
+        for entry in files:
+            download(entry)
+        return
+
+    pool = ThreadPool(min(threads, len(files)))
+    try:
+        pool.map(download, files)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _item_files(client, item_id, dest, name):
+    """
+    List the files of an item to download into the ``dest`` directory, laid
+    out as :py:meth:`girder_client.GirderClient.downloadItem` does.
+    """
+    files = list(client.listFile(item_id))
+    if len(files) == 1 and files[0]['name'] == name:
+        return [(files[0], os.path.join(dest, client.transformFilename(name)))]
+
+    dest = os.path.join(dest, client.transformFilename(name))
+    girder_client._safeMakedirs(dest)
+    return [(file, os.path.join(dest, client.transformFilename(file['name'])))
+            for file in files]
+
+
+def _folder_files(client, folder_id, dest):
+    """
+    List the files in a folder and its subfolders to download into the
+    ``dest`` directory, laid out as
+    :py:meth:`girder_client.GirderClient.downloadFolderRecursive` does.
+    """
+    files = []
+    for folder in client.listFolder(folder_id):
+        local = os.path.join(dest, client.transformFilename(folder['name']))
+        girder_client._safeMakedirs(local)
+        files.extend(_folder_files(client, folder['_id'], local))
+
+    for item in client.listItem(folder_id):
+        files.extend(_item_files(client, item['_id'], dest, item['name']))
+
+    return files
+
+
+def _fetch_parent_item(file_id, client, dest, job_manager=None):
     """
     Fetches the whole item that contains the given file ID into the given
     destination directory. Returns the path to the specific file once the
@@ -57,13 +366,16 @@ def _fetch_parent_item(file_id, client, dest):
     dest = os.path.join(dest, client.transformFilename(item['name']))
     target_path = dest
 
+    files = []
     for file in client.listFile(item['_id']):
         path = os.path.join(dest, client.transformFilename(file['name']))
-        client.downloadFile(file['_id'], path)
+        files.append((file, path))
 
         if file['_id'] == target_file['_id']:
             target_path = path
 
+    _download_files(client, files, job_manager)
+
     return target_path
 
 
@@ -72,27 +384,33 @@ def fetch_handler(spec, **kwargs):
     task_input = kwargs.get('task_input', {})
     target = task_input.get('target', 'filepath')
     fetch_parent = spec.get('fetch_parent', False)
+    job_manager = kwargs.get('_job_manager')
 
     if 'id' not in spec:
         raise Exception('Must pass a resource ID for girder inputs.')
     if 'name' not in spec:
         raise Exception('Must pass a name for girder inputs.')
 
-    client = _init_client(spec)
-    filename = client.transformFilename(spec['name'])
-    dest = os.path.join(kwargs['_tempdir'], filename)
-
-    if resource_type == 'folder':
-        client.downloadFolderRecursive(spec['id'], dest)
-    elif resource_type == 'item':
-        client.downloadItem(spec['id'], kwargs['_tempdir'], filename)
-    elif resource_type == 'file':
-        if fetch_parent:
-            dest = _fetch_parent_item(spec['id'], client, kwargs['_tempdir'])
+    with _client(spec) as client:
+        filename = client.transformFilename(spec['name'])
+        dest = os.path.join(kwargs['_tempdir'], filename)
+
+        if resource_type == 'folder':
+            girder_client._safeMakedirs(dest)
+            _download_files(
+                client, _folder_files(client, spec['id'], dest), job_manager)
+        elif resource_type == 'item':
+            _download_files(client, _item_files(
+                client, spec['id'], kwargs['_tempdir'], filename), job_manager)
+        elif resource_type == 'file':
+            if fetch_parent:
+                dest = _fetch_parent_item(
+                    spec['id'], client, kwargs['_tempdir'], job_manager)
+            else:
+                _download_files(
+                    client, [(client.getFile(spec['id']), dest)], job_manager)
         else:
-            client.downloadFile(spec['id'], dest)
-    else:
-        raise Exception('Invalid resource type: ' + resource_type)
+            raise Exception('Invalid resource type: ' + resource_type)
 
     if target == 'filepath':
         return dest
@@ -117,25 +435,25 @@ def push_handler(data, spec, **kwargs):
     if 'parent_id' not in spec:
         raise Exception('Must pass parent ID for girder outputs.')
 
-    client = _init_client(spec, require_token=True)
-
-    if target == 'memory':
-        if not spec.get('name'):
-            raise Exception('Girder uploads from memory objects must '
-                            'explicitly pass a "name" field.')
-        fd = StringIO(data)
-        client.uploadFile(parentId=spec['parent_id'], stream=fd, size=len(data),
-                          parentType=parent_type, name=spec['name'],
-                          reference=reference)
-    elif target == 'filepath':
-        name = spec.get('name') or os.path.basename(data)
-        size = os.path.getsize(data)
-        with open(data, 'rb') as fd:
-            client.uploadFile(parentId=spec['parent_id'], stream=fd, size=size,
-                              parentType=parent_type, name=name,
-                              reference=reference)
-    else:
-        raise Exception('Invalid Girder push target: ' + target)
+    with _client(spec, require_token=True) as client:
+        if target == 'memory':
+            if not spec.get('name'):
+                raise Exception('Girder uploads from memory objects must '
+                                'explicitly pass a "name" field.')
+            fd = StringIO(data)
+            client.uploadFile(
+                parentId=spec['parent_id'], stream=fd, size=len(data),
+                parentType=parent_type, name=spec['name'],
+                reference=reference)
+        elif target == 'filepath':
+            name = spec.get('name') or os.path.basename(data)
+            size = os.path.getsize(data)
+            with open(data, 'rb') as fd:
+                client.uploadFile(
+                    parentId=spec['parent_id'], stream=fd, size=size,
+                    parentType=parent_type, name=name, reference=reference)
+        else:
+            raise Exception('Invalid Girder push target: ' + target)
 
 
 def load(params):
@@ -1,11 +1,15 @@
 import copy
 import json
 import httmock
+import mock
 import os
 import girder_worker
 import girder_worker.tasks
 import shutil
 import unittest
+import urlparse
+
+from girder_worker.plugins import girder_io
 
 _tmp = None
 
@@ -439,6 +443,203 @@ class TestGirderIo(unittest.TestCase):
             with open(file1_path, 'rb') as fd:
                 self.assertEqual(fd.read(), 'file_contents')
 
+    def test_folder_download(self):
+        api_root = '/girder/api/v1'
+        items = {
+            'folder_id': [{'_id': 'item1_id', 'name': 'a.txt'}],
+            'sub_id': [{'_id': 'item2_id', 'name': 'b'},
+                       {'_id': 'item3_id', 'name': 'c.txt'}]
+        }
+        files = {
+            'item1_id': [{'_id': 'file1_id', 'name': 'a.txt'}],
+            'item2_id': [{'_id': 'file2_id', 'name': 'b1.txt'},
+                         {'_id': 'file3_id', 'name': 'b2.txt'}],
+            'item3_id': [{'_id': 'file4_id', 'name': 'c.txt'}]
+        }
+        for item_files in files.values():
+            for file in item_files:
+                file.update(created='2000-01-01 00:00:00', size=7)
+        failures = []
+
+        @httmock.all_requests
+        def girder_mock(url, request):
+            params = dict(urlparse.parse_qsl(url.query))
+            path = url.path[len(api_root) + 1:].split('/')
+            if path == ['folder']:
+                return json.dumps([{'_id': 'sub_id', 'name': 'sub'}]
+                                  if params['parentId'] == 'folder_id'
+                                  else [])
+            elif path == ['item']:
+                return json.dumps(items[params['folderId']])
+            elif path[0] == 'item' and path[2] == 'files':
+                return json.dumps(files[path[1]])
+            elif path[0] == 'file' and path[2] == 'download':
+                # Fail the first attempt to download one of the files
+                if path[1] == 'file3_id' and not failures:
+                    failures.append(path[1])
+                    return {'status_code': 503, 'content': ''}
+                return 'data_%s' % path[1][4]
+            raise Exception('Unexpected url ' + repr(url))
+
+        job_manager = mock.Mock()
+        spec = {
+            'mode': 'girder',
+            'api_url': 'http://localhost:8080' + api_root,
+            'id': 'folder_id',
+            'name': 'folder',
+            'resource_type': 'folder'
+        }
+
+        with httmock.HTTMock(girder_mock), \
+                mock.patch.object(girder_io, 'RETRY_BACKOFF', 0):
+            dest = girder_io.fetch_handler(
+                spec, _tempdir=_tmp, _job_manager=job_manager,
+                task_input={'target': 'filepath'})
+
+        self.assertEqual(dest, os.path.join(_tmp, 'folder'))
+        for path, data in (('a.txt', 'data_1'), ('sub/b/b1.txt', 'data_2'),
+                           ('sub/b/b2.txt', 'data_3'),
+                           ('sub/c.txt', 'data_4')):
+            with open(os.path.join(dest, path)) as f:
+                self.assertEqual(f.read(), data)
+        self.assertEqual(failures, ['file3_id'])
+
+        job_manager.updateProgress.assert_called_with(
+            total=28, current=28, message='Downloading inputs from Girder')
+
+    def test_segmented_download(self):
+        api_root = '/girder/api/v1'
+        data = os.urandom(1000)
+        ranges = []
+
+        @httmock.all_requests
+        def girder_mock(url, request):
+            self.assertEqual(url.path, api_root + '/file/file_id/download')
+            start, end = map(int, request.headers['Range'][6:].split('-'))
+            ranges.append((start, end))
+            return {'status_code': 206, 'content': data[start:end + 1]}
+
+        config = girder_io.config
+        for key, value in (('http_segmented_min_size', '100'),
+                           ('http_segments', '3')):
+            self.addCleanup(config.set, 'girder_worker', key,
+                            config.get('girder_worker', key))
+            config.set('girder_worker', key, value)
+
+        client = girder_io.GirderClient(
+            apiUrl='http://localhost:8080' + api_root)
+        path = os.path.join(_tmp, 'segmented', 'file.bin')
+        with httmock.HTTMock(girder_mock):
+            client.downloadFile(
+                'file_id', path, created='2000-01-01 00:00:00', size=1000)
+
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(
+            sorted(ranges), [(0, 333), (334, 667), (668, 999)])
+
+    def test_cache_links(self):
+        downloads = []
+
+        @httmock.all_requests
+        def girder_mock(url, request):
+            downloads.append(url.path)
+            return 'file_contents'
+
+        client = girder_io.GirderClient(
+            apiUrl='http://localhost:8080/girder/api/v1', cacheSettings={
+                'directory': os.path.join(_tmp, 'link_cache'),
+                'large_value_threshold': 0
+            })
+        created = '2000-01-01 00:00:00'
+
+        def download(name):
+            path = os.path.join(_tmp, 'linked', name)
+            clones = []
+
+            def ioctl(*args):
+                clones.append(args)
+                raise IOError()
+
+            with httmock.HTTMock(girder_mock), mock.patch(
+                    'fcntl.ioctl', side_effect=ioctl):
+                client.downloadFile('file_id', path, created=created, size=13)
+            with open(path) as f:
+                self.assertEqual(f.read(), 'file_contents')
+            self.assertEqual(os.stat(path).st_nlink, 1)
+            return len(clones)
+
+        self.assertEqual(download('miss'), 0)
+        self.assertEqual(download('hit'), 1)
+        self.assertEqual(len(downloads), 1)
+
+        # Cached files are never shared with the task's copy
+        path = os.path.join(_tmp, 'linked', 'hit')
+        os.chmod(path, 0o666)
+        with open(path, 'a') as f:
+            f.write('modified')
+        download('hit')
+
+        # Files evicted while they are read are still available to the job
+        def evict(self, fp, path):
+            client.cache.clear()
+            return materialize(self, fp, path)
+
+        materialize = girder_io.GirderClient._materializeFile
+        with mock.patch.object(girder_io.GirderClient, '_materializeFile',
+                               evict):
+            download('evicted')
+        self.assertEqual(len(downloads), 1)
+
+        config = girder_io.config
+        self.addCleanup(config.set, 'girder_io', 'diskcache_link_files',
+                        config.get('girder_io', 'diskcache_link_files'))
+        config.set('girder_io', 'diskcache_link_files', '0')
+        self.assertEqual(download('copied'), 0)
+        self.assertEqual(len(downloads), 2)
+        client.cache.close()
+
+    def test_client_pool(self):
+        from girder_worker.plugins.girder_io import (
+            _clients, _init_client, _release_client)
+        _clients.clear()
+        self.addCleanup(_clients.clear)
+
+        spec = {'api_url': 'http://localhost:8080/girder/api/v1',
+                'token': 'foo'}
+        client = _init_client(spec)
+        self.assertEqual(client.token, 'foo')
+        self.assertIs(_init_client(dict(spec)), client)
+        self.assertEqual(client.users, 2)
+        self.assertIsNot(_init_client(dict(spec, token='bar')), client)
+        self.assertEqual(len(_clients), 2)
+
+        # Clients are replaced once they reach their maximum age, and closed
+        # once the last job using them releases them
+        client.created -= 3600
+        with mock.patch.object(client, 'close') as close:
+            self.assertIsNot(_init_client(spec), client)
+            self.assertTrue(client.evicted)
+            _release_client(client)
+            self.assertFalse(close.called)
+            _release_client(client)
+            close.assert_called_once_with()
+
+        # Clients evicted while no job uses them are closed right away
+        config = girder_io.config
+        self.addCleanup(config.set, 'girder_io', 'client_pool_size',
+                        config.get('girder_io', 'client_pool_size'))
+        config.set('girder_io', 'client_pool_size', '1')
+        idle = _clients.values()[-1]
+        _release_client(idle)
+        with mock.patch.object(idle, 'close') as close:
+            other = _init_client(dict(spec, token='baz'))
+            close.assert_called_once_with()
+        self.assertEqual(_clients.values(), [other])
+
+        with self.assertRaisesRegexp(Exception, 'must pass a token'):
+            _init_client({'api_url': spec['api_url']}, require_token=True)
+
 
 if __name__ == '__main__':
     unittest.main()
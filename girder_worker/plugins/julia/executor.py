@@ -1,61 +1,115 @@
 import os
 import json
+import tempfile
 
-from girder_worker.core import utils
+from girder_worker.core import pool, utils
 
+WORKER_SCRIPT = os.path.join(os.path.dirname(__file__), 'worker.jl')
+DONE_MARKER = '\x01girder_worker_julia_job_done\x01'
 
-def _write_julia_script(script, inputs, task_outputs, tmp_dir):
+# The Julia element types of binary array files
+_JULIA_TYPES = {
+    'float64': 'Float64',
+    'int64': 'Int64'
+}
+
+
+def _write_julia_script(script, inputs, task_inputs, task_outputs, tmp_dir):
     script_fname = os.path.join(tmp_dir, 'script.julia')
     with open(script_fname, 'w') as script_file:
-        # Send input values to the script
+        # Send input values to the script. Number and integer lists are
+        # passed as binary array files rather than as array literals.
         for name, binding in inputs.iteritems():
-            value = json.dumps(binding['script_data'])
+            dtype = utils.numeric_array_input_type(
+                task_inputs[name], binding['script_data'])
+            if dtype:
+                fname = os.path.join(tmp_dir, name + '.input')
+                utils.write_numeric_array(
+                    fname, binding['script_data'], dtype)
+                value = 'collect(reinterpret({}, read({})))'.format(
+                    _JULIA_TYPES[dtype], json.dumps(fname))
+            else:
+                value = json.dumps(binding['script_data'])
             script_file.write(name + ' = ' + value + '\n')
 
         # Run the script
         script_file.write(script)
 
         # Write output values to temporary files
-        for name in task_outputs:
+        for name, task_output in task_outputs.iteritems():
             if name != '_stderr' and name != '_stdout':
                 fname = os.path.join(tmp_dir, name)
+                dtype = utils.ARRAY_OUTPUT_FORMATS.get(
+                    task_output.get('format'))
+                if dtype:
+                    value = 'convert(Vector{{{}}}, {})'.format(
+                        _JULIA_TYPES[dtype], name)
+                else:
+                    value = '"${}"'.format(name)
                 script_file.write("""
 outfile = open({}, "w")
-write(outfile, "${}")
+write(outfile, {})
 close(outfile)
-""".format(json.dumps(fname), name))
+""".format(json.dumps(fname), value))
 
     return script_fname
 
 
+def _run_pooled(script_fname, tmp_dir, pipes):
+    """
+    Run the script in one of the pooled long-lived Julia processes rather
+    than starting a new one.
+    """
+    command = ['julia', '--startup-file=no', WORKER_SCRIPT, DONE_MARKER]
+    job_dir = tempfile.mkdtemp(prefix='julia_job', dir=tmp_dir)
+    line = '\t'.join((script_fname,) + tuple(
+        os.path.join(job_dir, name) for name in ('stdout', 'stderr', 'status')))
+
+    print('Running julia in pool: "%s"' % script_fname)
+
+    pool.run_job(
+        pool.get_pool('julia', command, DONE_MARKER), [line], job_dir, pipes)
+
+
 def run(task, inputs, outputs, task_inputs, task_outputs, **kwargs):
     tmp_dir = kwargs.get('_tempdir')
 
     script_fname = _write_julia_script(
-        task['script'], inputs, task_outputs, tmp_dir)
+        task['script'], inputs, task_inputs, task_outputs, tmp_dir)
 
     pipes = {}
     for id in ('_stdout', '_stderr'):
         if id in task_outputs and id in outputs:
-            pipes[id] = utils.AccumulateDictAdapter(outputs[id], 'script_data')
+            pipes[id] = utils.AccumulateDictAdapter(
+                outputs[id], 'script_data',
+                path=utils.stream_output_path(task_outputs[id], id, tmp_dir))
 
-    command = ['julia', script_fname]
+    if task.get('julia_pool', False):
+        _run_pooled(script_fname, tmp_dir, pipes)
+    else:
+        command = ['julia', script_fname]
 
-    print('Running julia: "%s"' % ' '.join(command))
+        print('Running julia: "%s"' % ' '.join(command))
 
-    p = utils.run_process(command, output_pipes=pipes)
+        p = utils.run_process(command, output_pipes=pipes)
 
-    if p.returncode != 0:
-        raise Exception('Error: julia run returned code {}.'.format(
-                        p.returncode))
+        if p.returncode != 0:
+            raise Exception('Error: julia run returned code {}.'.format(
+                            p.returncode))
 
     for name, task_output in task_outputs.iteritems():
         if name != '_stderr' and name != '_stdout':
             fname = os.path.join(tmp_dir, name)
+            dtype = utils.ARRAY_OUTPUT_FORMATS.get(task_output.get('format'))
+            if dtype:
+                outputs[name]['script_data'] = utils.read_numeric_array(
+                    fname, dtype)
+                continue
+
             with open(fname) as output_file:
                 outputs[name]['script_data'] = output_file.read()
 
             # Deal with converting from string - assume JSON
-            if task_output['type'] in ('number', 'boolean'):
+            if task_output['type'] in ('number', 'integer', 'boolean'):
                 outputs[name]['script_data'] = json.loads(
                     outputs[name]['script_data'])
@@ -35,7 +35,7 @@ f = open(file)
 lines = readlines(f)
 counter = 1
 for l in lines
-   print("$counter. $l")
+   println("$counter. $l")
    counter += 1
 end
 close(f)
@@ -130,3 +130,71 @@ It was the worst of times
                 'format': 'boolean'
             }
         })
+
+    def testJuliaPool(self):
+        task = {
+            'mode': 'julia',
+            'script': 'println("x = $x")\ny = x * 2',
+            'inputs': [{'id': 'x', 'format': 'number', 'type': 'number'}],
+            'outputs': [
+                {'id': '_stdout', 'format': 'text', 'type': 'string'},
+                {'id': 'y', 'format': 'number', 'type': 'number'}
+            ],
+            'julia_pool': True
+        }
+
+        for x in (1, 2):
+            out = girder_worker.tasks.run(
+                task, inputs={'x': {'format': 'number', 'data': x}})
+            self.assertEqual(out, {
+                '_stdout': {'data': 'x = %d\n' % x, 'format': 'text'},
+                'y': {'data': x * 2, 'format': 'number'}
+            })
+
+        # Errors are reported without taking down the pool
+        task['script'] = 'error("failed")'
+        with self.assertRaisesRegexp(Exception, 'Error in task script'):
+            girder_worker.tasks.run(
+                task, inputs={'x': {'format': 'number', 'data': 1}})
+
+    def testJuliaArrays(self):
+        task = {
+            'mode': 'julia',
+            'script': 'c = a * 2\nd = [b[1:2] * 2; 2 ^ 40]',
+            'inputs': [
+                {'id': 'a', 'format': 'number_list', 'type': 'number_list'},
+                {'id': 'b', 'format': 'integer_list', 'type': 'integer_list'}
+            ],
+            'outputs': [
+                {'id': 'c', 'format': 'number_list', 'type': 'number_list'},
+                {'id': 'd', 'format': 'integer_list', 'type': 'integer_list'}
+            ]
+        }
+
+        out = girder_worker.tasks.run(task, inputs={
+            'a': {'format': 'number_list', 'data': [0.5, 1.5, 2.5]},
+            'b': {'format': 'integer_list', 'data': [1, 2, 3]}
+        })
+        self.assertEqual(out, {
+            'c': {'format': 'number_list', 'data': [1.0, 3.0, 5.0]},
+            'd': {'format': 'integer_list', 'data': [2, 4, 2 ** 40]}
+        })
+
+    def testJuliaArrayInputFormats(self):
+        from girder_worker.plugins.julia.executor import _write_julia_script
+
+        inputs = {
+            'a': {'script_data': [1, 2]},
+            'b': {'script_data': [1, 2]}
+        }
+        task_inputs = {
+            'a': {'id': 'a', 'format': 'integer_list'},
+            'b': {'id': 'b', 'format': 'json'}
+        }
+        script_fname = _write_julia_script('', inputs, task_inputs, {}, _tmp)
+        with open(script_fname) as script_file:
+            script = script_file.read()
+
+        # Only number and integer lists are passed as binary arrays
+        self.assertIn('a = collect(reinterpret(Int64, read(', script)
+        self.assertIn('b = [1, 2]\n', script)
@@ -0,0 +1,35 @@
+# Runs julia mode tasks in a long-lived Julia process, see
+# girder_worker/core/pool.py. Each line read from stdin holds the tab-separated
+# paths of the task script and of the files to write its stdout, stderr and
+# error message to. Each task is run in a fresh module, so that variables do
+# not carry over from one task to the next.
+
+function run_job(script, stdout_path, stderr_path, status_path)
+    message = ""
+    dir = pwd()
+    open(stdout_path, "w") do out
+        open(stderr_path, "w") do err
+            redirect_stdout(out) do
+                redirect_stderr(err) do
+                    try
+                        Base.include(Module(:GirderWorkerTask), script)
+                    catch e
+                        message = sprint(showerror, e, catch_backtrace())
+                    end
+                end
+            end
+        end
+    end
+    cd(dir)
+    write(status_path, message)
+end
+
+function main(marker)
+    for line in eachline(stdin)
+        run_job(split(chomp(line), '\t')...)
+        println(marker)
+        flush(stdout)
+    end
+end
+
+main(ARGS[1])
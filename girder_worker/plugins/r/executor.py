@@ -1,7 +1,9 @@
 import rpy2.robjects
 
+from . import pool
 
-def run(task, inputs, outputs, task_inputs, task_outputs, **kwargs):
+
+def _run_in_process(script, inputs, outputs, tempdir):
     env = rpy2.robjects.globalenv
 
     # Clear out workspace variables and packages
@@ -14,16 +16,32 @@ def run(task, inputs, outputs, task_inputs, task_outputs, **kwargs):
         }
         """, env)
 
-    env['tempdir'] = kwargs.get('_tempdir')
+    env['tempdir'] = tempdir
+
+    for name, value in inputs.iteritems():
+        env[str(name)] = value
 
-    for name in inputs:
-        env[str(name)] = inputs[name]['script_data']
+    rpy2.robjects.reval(script, env)
 
-    rpy2.robjects.reval(task['script'], env)
+    return {name: env[str(name)] for name in outputs}
+
+
+def run(task, inputs, outputs, task_inputs, task_outputs, **kwargs):
+    script_inputs = {name: inputs[name]['script_data'] for name in inputs}
+    r_pool = pool.get_pool()
+
+    if r_pool is not None and task.get('r_pool', True):
+        results = r_pool.run(task['script'], script_inputs, list(task_outputs),
+                             kwargs.get('_tempdir'))
+    else:
+        with pool.rpy2_lock:
+            results = _run_in_process(
+                task['script'], script_inputs, task_outputs,
+                kwargs.get('_tempdir'))
 
     for name, task_output in task_outputs.iteritems():
         d = outputs[name]
-        d['script_data'] = env[str(name)]
+        d['script_data'] = results[name]
 
         # Hack to detect scalar values from R.
         # The R value might not have a len() so wrap in a try/except.
@@ -0,0 +1,149 @@
+"""
+A pool of long-lived R processes that tasks in ``r`` mode can be run in, so
+that each task does not pay for loading R packages again, and R tasks do not
+have to share the R interpreter embedded in the worker.
+
+Inputs and outputs are exchanged with the R processes as RDS files in a job
+directory under the task's temporary directory, which keeps R objects in R's
+own binary serialization format throughout.
+"""
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+from girder_worker import config
+from girder_worker.core.pool import InterpreterPool, InterpreterProcess
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(__file__), 'worker.R')
+DONE_MARKER = '\x01girder_worker_r_job_done\x01'
+
+# Serializes use of the R interpreter embedded in this process
+rpy2_lock = threading.RLock()
+
+
+class RProcess(InterpreterProcess):
+    """
+    A single R process running ``worker.R``, which forwards anything the jobs
+    it runs print to stdout as it is printed.
+    """
+    def run(self, lines):
+        self.tasks += 1
+        self.process.stdin.write(''.join(line + '\n' for line in lines))
+        self.process.stdin.flush()
+
+        pending_newline = False
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise Exception(
+                    'R worker process exited unexpectedly with code %s.' %
+                    self.process.wait())
+            if line.rstrip('\n') == self.marker:
+                break
+
+            # The marker is preceded by a newline of its own, which is only
+            # printed once it is clear that it is not part of the marker.
+            if pending_newline:
+                sys.stdout.write('\n')
+            pending_newline = line.endswith('\n')
+            sys.stdout.write(line[:-1] if pending_newline else line)
+
+        return ''
+
+
+class RProcessPool(InterpreterPool):
+    """
+    Runs R tasks in up to ``size`` R processes at once, each of which has
+    ``packages`` loaded when it starts. Processes are started as they are
+    needed and replaced once they have run ``max_tasks`` tasks (if nonzero),
+    or if they exit.
+    """
+    def __init__(self, size, packages=(), max_tasks=0, rscript='Rscript'):
+        super(RProcessPool, self).__init__(
+            [rscript, '--vanilla', WORKER_SCRIPT] + list(packages),
+            DONE_MARKER, size=size, max_tasks=max_tasks)
+
+    def _new_process(self):
+        return RProcess(self.command, self.marker)
+
+    def run(self, script, inputs, outputs, tempdir=None):
+        """
+        Run an R script in one of the pooled processes.
+
+        :param script: The R script to run.
+        :type script: str
+        :param inputs: Maps the names of the variables to set before running
+            the script to their values, either R objects or Python values that
+            rpy2 can convert.
+        :type inputs: dict
+        :param outputs: The names of the variables to return.
+        :type outputs: list
+        :param tempdir: The temporary directory of the task, which is made
+            available to the script as ``tempdir`` and holds the job directory.
+        :returns: A dict mapping each output name to its R object.
+        """
+        import rpy2.robjects
+
+        job_dir = tempfile.mkdtemp(prefix='r_job', dir=tempdir)
+        try:
+            with open(os.path.join(job_dir, 'script.R'), 'w') as f:
+                f.write(script)
+            with open(os.path.join(job_dir, 'tempdir'), 'w') as f:
+                f.write(tempdir or '')
+            _write_names(os.path.join(job_dir, 'inputs'), inputs)
+            _write_names(os.path.join(job_dir, 'outputs'), outputs)
+
+            with rpy2_lock:
+                for i, name in enumerate(inputs, 1):
+                    rpy2.robjects.r['saveRDS'](inputs[name], file=os.path.join(
+                        job_dir, 'input%d.rds' % i))
+
+            super(RProcessPool, self).run([job_dir])
+            with open(os.path.join(job_dir, 'status')) as f:
+                error = f.read().strip()
+            if error:
+                raise Exception('Error in R script: %s' % error)
+
+            with rpy2_lock:
+                return {
+                    name: rpy2.robjects.r['readRDS'](os.path.join(
+                        job_dir, 'output%d.rds' % i))
+                    for i, name in enumerate(outputs, 1)
+                }
+        finally:
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+
+def _write_names(path, names):
+    with open(path, 'w') as f:
+        for name in names:
+            f.write(name + '\n')
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Return the process-wide pool of R processes, creating it on first use, or
+    ``None`` if the ``r.pool_size`` config setting is 0.
+    """
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            size = config.getint('r', 'pool_size')
+            if size <= 0:
+                return None
+
+            packages = config.get('r', 'pool_packages').split(',')
+            _pool = RProcessPool(
+                size, packages=[p.strip() for p in packages if p.strip()],
+                max_tasks=config.getint('r', 'pool_max_tasks'),
+                rscript=config.get('r', 'rscript'))
+            atexit.register(_pool.shutdown)
+        return _pool
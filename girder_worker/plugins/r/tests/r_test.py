@@ -1,4 +1,6 @@
 from girder_worker.tasks import run
+from girder_worker.plugins.r import pool
+import mock
 import unittest
 
 
@@ -59,5 +61,30 @@ class TestR(unittest.TestCase):
             self.function_in, inputs={'input': outputs['output']})
         self.assertEqual(outputs['output']['data'], 16)
 
+    def test_pool(self):
+        r_pool = pool.RProcessPool(1, max_tasks=2)
+        self.addCleanup(r_pool.shutdown)
+
+        with mock.patch.object(pool, 'get_pool', return_value=r_pool):
+            self.test_array()
+            self.test_function()
+
+            # Variables do not leak from one task to the next
+            outputs = run({
+                'inputs': [],
+                'outputs': [
+                    {'name': 'output', 'type': 'boolean', 'format': 'boolean'}],
+                'script': 'output = exists("input")',
+                'mode': 'r'
+            })
+            self.assertFalse(outputs['output']['data'])
+
+            # Errors in the script are raised and the process is reused
+            with self.assertRaises(Exception):
+                run({'inputs': [], 'outputs': [], 'script': 'stop("failed")',
+                     'mode': 'r'})
+            self.assertEqual(len(r_pool._idle), 1)
+
+
 if __name__ == '__main__':
     unittest.main()
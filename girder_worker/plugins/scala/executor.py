@@ -1,17 +1,103 @@
 import os
 import json
-
-from girder_worker.core import utils
-
-
-def _write_scala_script(script, inputs, task_outputs, tmp_dir):
+import tempfile
+
+from girder_worker.core import pool, utils
+
+DONE_MARKER = '\x01girder_worker_scala_job_done\x01'
+
+# Wraps a pooled task so that its console output goes to the job directory and
+# any error it raises is recorded, rather than being reported by the REPL.
+_POOL_HEADER = """import java.io._
+val _gwOut = new PrintStream(new FileOutputStream({stdout}))
+val _gwErr = new PrintStream(new FileOutputStream({stderr}))
+val _gwStatus = try {{
+Console.withOut(_gwOut) {{ Console.withErr(_gwErr) {{
+"""
+
+_POOL_FOOTER = """
+()
+}} }}
+""
+}} catch {{
+    case e: Throwable => e.toString
+}} finally {{
+    _gwOut.close()
+    _gwErr.close()
+}}
+new PrintWriter({status}) {{
+    write(_gwStatus); close
+}}
+}}
+"""
+
+
+# Reads and writes the binary array files that lists of numbers are passed
+# to and from the script in
+_ARRAY_HELPERS = """
+def _gwReadArray(path: String) = java.nio.ByteBuffer.wrap(
+    java.nio.file.Files.readAllBytes(java.nio.file.Paths.get(path))
+).order(java.nio.ByteOrder.nativeOrder)
+def _gwReadDoubles(path: String): Array[Double] = {
+    val buffer = _gwReadArray(path).asDoubleBuffer
+    val values = new Array[Double](buffer.remaining)
+    buffer.get(values)
+    values
+}
+def _gwReadLongs(path: String): Array[Long] = {
+    val buffer = _gwReadArray(path).asLongBuffer
+    val values = new Array[Long](buffer.remaining)
+    buffer.get(values)
+    values
+}
+def _gwWriteArray(path: String, length: Int)(
+        fill: java.nio.ByteBuffer => Unit) {
+    val buffer = java.nio.ByteBuffer.allocate(8 * length).order(
+        java.nio.ByteOrder.nativeOrder)
+    fill(buffer)
+    java.nio.file.Files.write(java.nio.file.Paths.get(path), buffer.array)
+}
+def _gwWriteDoubles(path: String, values: Array[Double]) {
+    _gwWriteArray(path, values.length)(_.asDoubleBuffer.put(values))
+}
+def _gwWriteLongs(path: String, values: Array[Long]) {
+    _gwWriteArray(path, values.length)(_.asLongBuffer.put(values))
+}
+"""
+
+# The Scala element types and helper suffixes of binary array files
+_SCALA_TYPES = {
+    'float64': ('Double', 'Doubles'),
+    'int64': ('Long', 'Longs')
+}
+
+
+def _write_scala_script(script, inputs, task_inputs, task_outputs, tmp_dir,
+                        job_dir=None):
     script_fname = os.path.join(tmp_dir, 'script.scala')
     with open(script_fname, 'w') as script_file:
         script_file.write('{\n')
 
-        # Send input values to the script
+        if job_dir:
+            script_file.write(_POOL_HEADER.format(
+                stdout=json.dumps(os.path.join(job_dir, 'stdout')),
+                stderr=json.dumps(os.path.join(job_dir, 'stderr'))))
+
+        script_file.write(_ARRAY_HELPERS)
+
+        # Send input values to the script. Number and integer lists are
+        # passed as binary array files rather than as literals.
         for name, binding in inputs.iteritems():
-            value = json.dumps(binding['script_data'])
+            dtype = utils.numeric_array_input_type(
+                task_inputs[name], binding['script_data'])
+            if dtype:
+                fname = os.path.join(tmp_dir, name + '.input')
+                utils.write_numeric_array(
+                    fname, binding['script_data'], dtype)
+                value = '_gwRead{}({})'.format(
+                    _SCALA_TYPES[dtype][1], json.dumps(fname))
+            else:
+                value = json.dumps(binding['script_data'])
             script_file.write('val ' + name + ' = ' + value + '\n')
 
         # Run the script
@@ -19,54 +105,111 @@ def _write_scala_script(script, inputs, task_outputs, tmp_dir):
 
         # Write output values to temporary files
         script_file.write('\nimport java.io._\n')
-        for name in task_outputs:
+        for name, task_output in task_outputs.iteritems():
             if name != '_stderr' and name != '_stdout':
                 fname = os.path.join(tmp_dir, name)
+                dtype = utils.ARRAY_OUTPUT_FORMATS.get(
+                    task_output.get('format'))
+                if dtype:
+                    script_file.write(
+                        '\n_gwWrite{}({}, {}.map(_.to{}).toArray)\n'.format(
+                            _SCALA_TYPES[dtype][1], json.dumps(fname), name,
+                            _SCALA_TYPES[dtype][0]))
+                    continue
+
                 script_file.write("""
 new PrintWriter({}) {{
     write({}); close
 }}
 """.format(json.dumps(fname), name + '.toString()'))
 
-        # Exit the interactive shell
-        script_file.write('}\n')
-        script_file.write('System.exit(0)\n')
+        if job_dir:
+            # Leave the shell running for the next task
+            script_file.write(_POOL_FOOTER.format(
+                status=json.dumps(os.path.join(job_dir, 'status'))))
+        else:
+            # Exit the interactive shell
+            script_file.write('}\n')
+            script_file.write('System.exit(0)\n')
 
     return script_fname
 
 
+def _run_pooled(spark, script_fname, job_dir, pipes):
+    """
+    Load the script into one of the pooled long-lived Scala (or Spark) shells
+    rather than starting a new one. The marker printed once the script is
+    done is split in two so that the shell echoing the command does not
+    match it.
+    """
+    command = ['spark-shell'] if spark else ['scala']
+    half = len(DONE_MARKER) // 2
+    lines = [
+        ':load ' + script_fname,
+        'println(%s + %s)' % (
+            _scala_string(DONE_MARKER[:half]),
+            _scala_string(DONE_MARKER[half:]))
+    ]
+
+    print('Running %s in pool: "%s"' % (command[0], script_fname))
+
+    pool.run_job(
+        pool.get_pool('scala', command, DONE_MARKER), lines, job_dir, pipes)
+
+
+def _scala_string(value):
+    return '"%s"' % ''.join(
+        c if ' ' <= c < '\x7f' and c not in '"\\' else '\\u%04x' % ord(c)
+        for c in value)
+
+
 def _run(spark, task, inputs, outputs, task_inputs, task_outputs, **kwargs):
     tmp_dir = kwargs.get('_tempdir')
 
+    job_dir = None
+    if task.get('scala_pool', False):
+        job_dir = tempfile.mkdtemp(prefix='scala_job', dir=tmp_dir)
+
     script_fname = _write_scala_script(
-        task['script'], inputs, task_outputs, tmp_dir)
+        task['script'], inputs, task_inputs, task_outputs, tmp_dir, job_dir)
 
     pipes = {}
     for id in ('_stdout', '_stderr'):
         if id in task_outputs and id in outputs:
-            pipes[id] = utils.AccumulateDictAdapter(outputs[id], 'script_data')
+            pipes[id] = utils.AccumulateDictAdapter(
+                outputs[id], 'script_data',
+                path=utils.stream_output_path(task_outputs[id], id, tmp_dir))
 
-    if spark:
-        command = ['spark-shell', '-i', script_fname]
+    if job_dir:
+        _run_pooled(spark, script_fname, job_dir, pipes)
     else:
-        command = ['scala', script_fname]
+        if spark:
+            command = ['spark-shell', '-i', script_fname]
+        else:
+            command = ['scala', script_fname]
 
-    print('Running scala: "%s"' % ' '.join(command))
+        print('Running scala: "%s"' % ' '.join(command))
 
-    p = utils.run_process(command, output_pipes=pipes)
+        p = utils.run_process(command, output_pipes=pipes)
 
-    if p.returncode != 0:
-        raise Exception('Error: scala run returned code {}.'.format(
-                        p.returncode))
+        if p.returncode != 0:
+            raise Exception('Error: scala run returned code {}.'.format(
+                            p.returncode))
 
     for name, task_output in task_outputs.iteritems():
         if name != '_stderr' and name != '_stdout':
             fname = os.path.join(tmp_dir, name)
+            dtype = utils.ARRAY_OUTPUT_FORMATS.get(task_output.get('format'))
+            if dtype:
+                outputs[name]['script_data'] = utils.read_numeric_array(
+                    fname, dtype)
+                continue
+
             with open(fname) as output_file:
                 outputs[name]['script_data'] = output_file.read()
 
             # Deal with converting from string - assume JSON
-            if task_output['type'] in ('number', 'boolean'):
+            if task_output['type'] in ('number', 'integer', 'boolean'):
                 outputs[name]['script_data'] = json.loads(
                     outputs[name]['script_data'])
 
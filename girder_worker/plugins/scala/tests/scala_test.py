@@ -277,3 +277,50 @@ println("Within Set Sum of Squared Errors = " + WSSSE)""",
 
         out = run(task, inputs=inputs)
         self.assertTrue(out['WSSSE']['data'] < 20)
+
+    def testScalaPool(self):
+        task = {
+            'mode': 'scala',
+            'script': 'println("x = " + x)\nval y = x * 2',
+            'inputs': [{'id': 'x', 'format': 'number', 'type': 'number'}],
+            'outputs': [
+                {'id': '_stdout', 'format': 'text', 'type': 'string'},
+                {'id': 'y', 'format': 'number', 'type': 'number'}
+            ],
+            'scala_pool': True
+        }
+
+        for x in (1, 2):
+            out = run(task, inputs={'x': {'format': 'number', 'data': x}})
+            self.assertEqual(out, {
+                '_stdout': {'data': 'x = %d\n' % x, 'format': 'text'},
+                'y': {'data': x * 2, 'format': 'number'}
+            })
+
+        # Errors are reported without taking down the pool
+        task['script'] = 'throw new Exception("failed")'
+        with self.assertRaisesRegexp(Exception, 'Error in task script'):
+            run(task, inputs={'x': {'format': 'number', 'data': 1}})
+
+    def testScalaArrays(self):
+        task = {
+            'mode': 'scala',
+            'script': 'val c = a.map(_ * 2)\nval d = b.take(2).map(_ * 2) :+ (1L << 40)',
+            'inputs': [
+                {'id': 'a', 'format': 'number_list', 'type': 'number_list'},
+                {'id': 'b', 'format': 'integer_list', 'type': 'integer_list'}
+            ],
+            'outputs': [
+                {'id': 'c', 'format': 'number_list', 'type': 'number_list'},
+                {'id': 'd', 'format': 'integer_list', 'type': 'integer_list'}
+            ]
+        }
+
+        out = run(task, inputs={
+            'a': {'format': 'number_list', 'data': [0.5, 1.5, 2.5]},
+            'b': {'format': 'integer_list', 'data': [1, 2, 3]}
+        })
+        self.assertEqual(out, {
+            'c': {'format': 'number_list', 'data': [1.0, 3.0, 5.0]},
+            'd': {'format': 'integer_list', 'data': [2, 4, 2 ** 40]}
+        })
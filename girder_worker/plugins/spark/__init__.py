@@ -1,4 +1,5 @@
 import os
+import uuid
 
 SC_KEY = '_girder_worker_spark_context'
 
@@ -7,18 +8,60 @@ def setup_pyspark_task(event):
     """
     This is executed before a task execution. If it is a pyspark task, we
     create the spark context here so it can be used for any input conversion.
+    If contexts are reused, the task gets a context from the shared pool, and
+    its Spark jobs are put in a job group of their own.
     """
     from . import spark
     info = event.info
     if info['mode'] == 'spark.python' and SC_KEY not in info['kwargs']:
         spark_conf = info['task'].get('spark_conf', {})
-        info['kwargs'][SC_KEY] = spark.create_spark_context(spark_conf)
+        pool = spark.get_context_pool()
+        if pool is None:
+            info['kwargs'][SC_KEY] = spark.create_spark_context(spark_conf)
+        else:
+            sc = pool.acquire(spark_conf)
+            info['kwargs'][SC_KEY] = sc
+            info['spark_pool'] = pool
+            info['spark_job_group'] = 'girder_worker-%s' % uuid.uuid4()
+            try:
+                sc.setJobGroup(
+                    info['spark_job_group'],
+                    info['task'].get('name', 'girder_worker task'),
+                    interruptOnCancel=True)
+            except Exception:
+                pool.release(sc)
+                raise
         info['cleanup_spark'] = True
 
 
-def pyspark_run_cleanup(event):
+def pyspark_run_succeeded(event):
     if event.info.get('cleanup_spark'):
-        event.info['kwargs'][SC_KEY].stop()
+        event.info['spark_succeeded'] = True
+
+
+def pyspark_run_cleanup(event):
+    info = event.info
+    if not info.get('cleanup_spark'):
+        return
+
+    sc = info['kwargs'][SC_KEY]
+    pool = info.get('spark_pool')
+    if pool is None:
+        sc.stop()
+        return
+
+    try:
+        # Cancel any jobs the task left running if it failed, and leave the
+        # context as it was for the next task
+        if not info.get('spark_succeeded'):
+            sc.cancelJobGroup(info['spark_job_group'])
+        for name in ('spark.jobGroup.id', 'spark.job.description',
+                     'spark.job.interruptOnCancel'):
+            sc.setLocalProperty(name, None)
+    except Exception:
+        pass
+    finally:
+        pool.release(sc)
 
 
 def load(params):
@@ -33,6 +76,7 @@ def load(params):
     register_executor('spark.python', pyspark_executor.run)
 
     events.bind('run.before', 'spark', setup_pyspark_task)
+    events.bind('run.after', 'spark', pyspark_run_succeeded)
     events.bind('run.finally', 'spark', pyspark_run_cleanup)
 
     format.import_converters(
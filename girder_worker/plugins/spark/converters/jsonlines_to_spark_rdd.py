@@ -0,0 +1,7 @@
+# flake8: noqa
+import json
+
+
+# Only split the lines on the driver, and parse them in the executors
+output = sc.parallelize(
+    [line for line in input.splitlines() if line.strip()]).map(json.loads)
@@ -1,4 +1,7 @@
 import json
 
 
-output = json.dumps(input.collect())
+# Serialize one partition at a time rather than collecting the whole RDD into
+# a list first
+output = '[%s]' % ', '.join(
+    json.dumps(item) for item in input.toLocalIterator())
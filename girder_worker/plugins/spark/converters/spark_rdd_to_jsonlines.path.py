@@ -0,0 +1,23 @@
+# flake8: noqa
+import json
+import os
+import uuid
+
+from girder_worker import config
+
+
+# Each partition is written to a part file of its own by the executors, so
+# the data never passes through the driver. The part files must outlive the
+# task's temporary directory, so they go in the directory (or Hadoop URI) that
+# the output binding names, or else in a new directory under the configured
+# output root.
+output = _output_binding.get('directory')
+if not output:
+    root = config.get('spark_io', 'output_root')
+    if not root:
+        raise Exception(
+            'A jsonlines.path output needs a "directory" in its binding or '
+            'spark_io.output_root to be set.')
+    output = os.path.join(root, 'rdd_%s' % uuid.uuid4().hex)
+
+input.map(json.dumps).saveAsTextFile(output)
@@ -0,0 +1,6 @@
+import json
+
+
+# Serialize in the executors and fetch one partition at a time
+output = ''.join(
+    line + '\n' for line in input.map(json.dumps).toLocalIterator())
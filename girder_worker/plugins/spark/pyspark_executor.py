@@ -1,6 +1,6 @@
 import imp
-import json
-import sys
+
+from girder_worker.core.executors.python import exec_script
 
 
 def run(task, inputs, outputs, task_inputs, task_outputs, **kwargs):
@@ -13,6 +13,7 @@ def run(task, inputs, outputs, task_inputs, task_outputs, **kwargs):
     custom.__dict__['spark_context'] = sc
     custom.__dict__['_job_manager'] = kwargs.get('_job_manager')
     custom.__dict__['_tempdir'] = kwargs.get('_tempdir')
+    custom.__dict__['_output_binding'] = kwargs.get('_output_binding', {})
 
     for name in inputs:
         custom.__dict__[name] = inputs[name]['script_data']
@@ -27,17 +28,7 @@ def run(task, inputs, outputs, task_inputs, task_outputs, **kwargs):
             exec fh in custom.__dict__
 
     else:
-        try:
-            exec task['script'] in custom.__dict__
-        except Exception, e:
-            trace = sys.exc_info()[2]
-            lines = task['script'].split('\n')
-            lines = [(str(i+1) + ': ' + lines[i]) for i in xrange(len(lines))]
-            error = (
-                str(e) + '\nScript:\n' + '\n'.join(lines) +
-                '\nTask:\n' + json.dumps(task, indent=4)
-            )
-            raise Exception(error), None, trace
+        exec_script(task, custom.__dict__)
 
     for name, task_output in task_outputs.iteritems():
         outputs[name]['script_data'] = custom.__dict__[name]
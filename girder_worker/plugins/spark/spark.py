@@ -1,6 +1,8 @@
+import atexit
 import girder_worker
 import os
 import sys
+import threading
 
 from ConfigParser import NoOptionError, NoSectionError
 
@@ -35,20 +37,145 @@ def setup_spark_env():
     from pyspark import SparkConf, SparkContext  # noqa
 
 
-def create_spark_context(task_spark_conf):
-    from pyspark import SparkConf, SparkContext
-    # Set can spark configuration parameter user has specified
-    spark_conf = SparkConf()
+def effective_spark_conf(task_spark_conf):
+    """
+    Return the Spark configuration a task runs with as a dict, which is the
+    ``spark`` section of the worker configuration overridden by the task's
+    own ``spark_conf``.
+    """
+    conf = {}
 
+    # Set can spark configuration parameter user has specified
     if girder_worker.config.has_section('spark'):
         for (name, value) in girder_worker.config.items('spark'):
-            spark_conf.set(name, value)
+            conf[name] = value
 
     # Override with any task specific configuration
     for (name, value) in task_spark_conf.items():
+        conf[name] = value
+
+    return conf
+
+
+def create_spark_context(task_spark_conf):
+    from pyspark import SparkConf, SparkContext
+    spark_conf = SparkConf()
+
+    for (name, value) in effective_spark_conf(task_spark_conf).items():
         spark_conf.set(name, value)
 
     # Build up the context, using the master URL
     sc = SparkContext(conf=spark_conf)
 
     return sc
+
+
+class SparkContextPool(object):
+    """
+    Shares SparkContexts between ``spark.python`` tasks, so that each task does
+    not pay for starting and stopping a context of its own.
+
+    Contexts are keyed by their effective configuration. Since pyspark only
+    allows one active context per process, a task that needs a different
+    configuration than the current context waits until no task is using it,
+    and then the context is replaced. A context that no task has used for
+    ``idle_timeout`` seconds is stopped, if ``idle_timeout`` is nonzero.
+    """
+    def __init__(self, idle_timeout=0, factory=create_spark_context):
+        self.idle_timeout = idle_timeout
+        self._factory = factory
+        self._cond = threading.Condition()
+        self._context = None
+        self._key = None
+        self._users = 0
+        self._timer = None
+
+    def acquire(self, task_spark_conf):
+        """
+        Return a context with the given task configuration, which must be
+        handed back with :py:meth:`release` once the task is done with it.
+        """
+        key = tuple(sorted(effective_spark_conf(task_spark_conf).items()))
+
+        with self._cond:
+            self._cancel_timer()
+
+            while self._key != key and self._users:
+                self._cond.wait()
+
+            if self._context is not None and (
+                    self._key != key or _is_stopped(self._context)):
+                self._stop()
+
+            if self._context is None:
+                self._context = self._factory(task_spark_conf)
+                self._key = key
+
+            self._users += 1
+            return self._context
+
+    def release(self, sc):
+        with self._cond:
+            self._users -= 1
+            if self._users:
+                return
+
+            self._cond.notify_all()
+            if self.idle_timeout and self._context is sc:
+                self._timer = threading.Timer(
+                    self.idle_timeout, self._evict, (sc,))
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _evict(self, sc):
+        with self._cond:
+            if self._context is sc and not self._users:
+                self._stop()
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _stop(self):
+        context, self._context, self._key = self._context, None, None
+        try:
+            context.stop()
+        except Exception:
+            pass
+
+    def shutdown(self):
+        """
+        Stop the current context, if no task is using it.
+        """
+        with self._cond:
+            self._cancel_timer()
+            if self._context is not None and not self._users:
+                self._stop()
+
+
+def _is_stopped(sc):
+    # A context that a task stopped itself can not be used again
+    return getattr(sc, '_jsc', True) is None
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_context_pool():
+    """
+    Return the process-wide SparkContext pool, creating it on first use, or
+    ``None`` if the ``spark_context.reuse`` config setting is off.
+    """
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            if not girder_worker.config.getboolean('spark_context', 'reuse'):
+                return None
+
+            _pool = SparkContextPool(idle_timeout=girder_worker.config.getint(
+                'spark_context', 'idle_timeout'))
+            atexit.register(_pool.shutdown)
+        return _pool
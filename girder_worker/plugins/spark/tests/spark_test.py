@@ -1,4 +1,11 @@
+from girder_worker import config
+from girder_worker.plugins.spark import spark
 from girder_worker.tasks import run
+import mock
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 import os
 
@@ -78,3 +85,142 @@ class TestSpark(unittest.TestCase):
 
     def tearDown(self):
         os.chdir(self.prevdir)
+
+    def testJsonLines(self):
+        analysis = {
+            'name': 'map',
+            'inputs': [
+                {'name': 'a', 'type': 'collection', 'format': 'spark.rdd'}
+            ],
+            'outputs': [
+                {'name': 'b', 'type': 'collection', 'format': 'spark.rdd'}
+            ],
+            'mode': 'spark.python',
+            'spark_conf': {
+                'spark.app.name': 'test_square',
+                'spark.master': os.environ['SPARK_TEST_MASTER_URL']
+            }
+        }
+
+        with open('data/spark_square_script.py', 'r') as fp:
+            analysis['script'] = fp.read()
+
+        outputs = run(analysis,
+                      {'a': {'format': 'jsonlines', 'data': '1\n2\n\n3\n'}},
+                      {'b': {'format': 'jsonlines'}})
+        self.assertEqual(outputs, {
+            'b': {'data': '1\n4\n9\n', 'format': 'jsonlines'}
+        })
+
+        # Inputs can also be read from files by the executors
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'input.jsonl')
+        with open(path, 'w') as f:
+            f.write('1\n2\n3\n')
+
+        outputs = run(analysis,
+                      {'a': {'format': 'jsonlines.path', 'data': path}},
+                      {'b': {'format': 'json'}})
+        self.assertEqual(outputs, {
+            'b': {'data': '[1, 4, 9]', 'format': 'json'}
+        })
+
+        # Outputs are written by the executors to the directory named by the
+        # binding, which outlives the task
+        outdir = os.path.join(tmpdir, 'output')
+        outputs = run(analysis,
+                      {'a': {'format': 'jsonlines', 'data': '1\n2\n3\n'}},
+                      {'b': {'format': 'jsonlines.path', 'directory': outdir}})
+        self.assertEqual(outputs['b']['data'], outdir)
+        lines = []
+        for name in sorted(os.listdir(outdir)):
+            if name.startswith('part-'):
+                with open(os.path.join(outdir, name)) as f:
+                    lines.extend(f.read().split())
+        self.assertEqual(lines, ['1', '4', '9'])
+
+        outputs = run(analysis,
+                      {'a': {'format': 'jsonlines.path', 'data': outdir}},
+                      {'b': {'format': 'json'}})
+        self.assertEqual(outputs['b']['data'], '[1, 16, 81]')
+
+        # Otherwise they are written under the configured output root
+        with self.assertRaisesRegexp(Exception, 'output_root'):
+            run(analysis, {'a': {'format': 'jsonlines', 'data': '1\n'}},
+                {'b': {'format': 'jsonlines.path'}})
+
+        self.addCleanup(config.set, 'spark_io', 'output_root',
+                        config.get('spark_io', 'output_root'))
+        config.set('spark_io', 'output_root', tmpdir)
+        outputs = run(analysis,
+                      {'a': {'format': 'jsonlines', 'data': '1\n'}},
+                      {'b': {'format': 'jsonlines.path'}})
+        self.assertEqual(os.path.dirname(outputs['b']['data']), tmpdir)
+        self.assertTrue(os.path.isdir(outputs['b']['data']))
+
+    def testContextReuse(self):
+        analysis = {
+            'name': 'context',
+            'inputs': [],
+            'outputs': [{'name': 'id', 'type': 'number', 'format': 'number'}],
+            'mode': 'spark.python',
+            'script': 'id = __import__("__builtin__").id(sc)',
+            'spark_conf': {
+                'spark.app.name': 'test_reuse',
+                'spark.master': os.environ['SPARK_TEST_MASTER_URL']
+            }
+        }
+
+        first = run(analysis)['id']['data']
+        self.assertEqual(run(analysis)['id']['data'], first)
+
+        # A failed task does not take the context down with it
+        with self.assertRaises(Exception):
+            run(dict(analysis, script=(
+                'sc.parallelize([1]).map(lambda x: x / 0).collect()')))
+        self.assertEqual(run(analysis)['id']['data'], first)
+
+
+class TestSparkContextPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = spark.SparkContextPool(factory=lambda conf: mock.Mock(
+            spec=['stop', '_jsc'], conf=conf))
+
+    def testSharing(self):
+        sc = self.pool.acquire({'spark.app.name': 'a'})
+        self.assertIs(self.pool.acquire({'spark.app.name': 'a'}), sc)
+        self.pool.release(sc)
+        self.pool.release(sc)
+        self.assertIs(self.pool.acquire({'spark.app.name': 'a'}), sc)
+        self.pool.release(sc)
+        self.assertFalse(sc.stop.called)
+
+        # A context stopped by a task is replaced
+        sc._jsc = None
+        other = self.pool.acquire({'spark.app.name': 'a'})
+        self.assertIsNot(other, sc)
+        self.pool.release(other)
+
+    def testConfChange(self):
+        sc = self.pool.acquire({'spark.app.name': 'a'})
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(
+            self.pool.acquire({'spark.app.name': 'b'})))
+        thread.start()
+
+        # The context can not be replaced while a task is using it
+        time.sleep(0.1)
+        self.assertEqual(acquired, [])
+        self.pool.release(sc)
+        thread.join()
+        self.assertTrue(sc.stop.called)
+        self.assertEqual(acquired[0].conf, {'spark.app.name': 'b'})
+
+    def testIdleTimeout(self):
+        self.pool.idle_timeout = 0.05
+        sc = self.pool.acquire({})
+        self.pool.release(sc)
+        time.sleep(0.3)
+        self.assertTrue(sc.stop.called)
+        self.assertIsNone(self.pool._context)
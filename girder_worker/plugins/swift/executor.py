@@ -38,7 +38,9 @@ def run(task, inputs, outputs, task_inputs, task_outputs, **kwargs):
     pipes = {}
     for id in ('_stdout', '_stderr'):
         if id in task_outputs and id in outputs:
-            pipes[id] = utils.AccumulateDictAdapter(outputs[id], 'script_data')
+            pipes[id] = utils.AccumulateDictAdapter(
+                outputs[id], 'script_data',
+                path=utils.stream_output_path(task_outputs[id], id, tmpDir))
 
     command = ['swift', script_fname] + args
 
@@ -1,4 +1,5 @@
 import core
+from girder_worker import config
 from .core.utils import JobManager, JobStatus
 from .app import app
 
@@ -11,7 +12,13 @@ def run(*pargs, **kwargs):
     with JobManager(logPrint=jobInfo.get('logPrint', True),
                     url=jobInfo.get('url'), method=jobInfo.get('method'),
                     headers=jobInfo.get('headers'),
-                    reference=jobInfo.get('reference')) as jm:
+                    reference=jobInfo.get('reference'),
+                    asynchronous=config.getboolean(
+                        'girder_worker', 'job_update_async'),
+                    queueSize=config.getint(
+                        'girder_worker', 'job_update_queue_size'),
+                    bufferLimit=config.getint(
+                        'girder_worker', 'job_log_buffer_limit')) as jm:
         kwargs['_job_manager'] = jm
         kwargs['status'] = JobStatus.RUNNING
         retval = core.run(*pargs, **kwargs)
@@ -0,0 +1,309 @@
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+from girder_worker.core import cache, convert, utils
+from girder_worker.core import run as core_run
+from girder_worker.core.executors import python
+from girder_worker.tasks import run
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_eviction(self):
+        cache = utils.LRUCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+
+        # 'b' was the least recently used entry
+        self.assertNotIn('b', cache)
+        self.assertIn('a', cache)
+        self.assertIn('c', cache)
+        self.assertEqual(cache.get('b', 'missing'), 'missing')
+        self.assertEqual(cache.stats(), {
+            'hits': 1,
+            'misses': 1,
+            'size': 2,
+            'maxsize': 2
+        })
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.hits, 0)
+
+    def test_disabled(self):
+        cache = utils.LRUCache(maxsize=0)
+        cache.put('a', 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_weigh(self):
+        cache = utils.LRUCache(maxsize=10, weigh=len)
+        cache.put('a', 'x' * 4)
+        cache.put('b', 'x' * 4)
+        cache.put('c', 'x' * 11)  # too large to be cached
+        self.assertEqual(cache.stats()['size'], 8)
+        cache.put('c', 'x' * 4)
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.stats()['size'], 8)
+        self.assertEqual(cache.pop('b'), 'x' * 4)
+        self.assertEqual(cache.stats()['size'], 4)
+
+
+class TestCodeCache(unittest.TestCase):
+    def setUp(self):
+        python.code_cache.clear()
+        self.task = {
+            'inputs': [{'name': 'a', 'type': 'number', 'format': 'number'}],
+            'outputs': [{'name': 'b', 'type': 'number', 'format': 'number'}],
+            'script': 'b = a * 2',
+            'mode': 'python'
+        }
+
+    def test_compile_script(self):
+        code = python.compile_script('x = 1')
+        self.assertIs(python.compile_script('x = 1'), code)
+        self.assertIs(python.compile_script(u'x = 1'), code)
+        self.assertEqual(python.code_cache.hits, 2)
+        self.assertEqual(python.code_cache.misses, 1)
+
+    def test_run_reuses_code(self):
+        outputs = run(self.task, {'a': {'format': 'number', 'data': 3}})
+        self.assertEqual(outputs['b']['data'], 6)
+        misses = python.code_cache.misses
+
+        # The task script, validators and converters are all cached by now
+        outputs = run(self.task, {'a': {'format': 'number', 'data': 4}})
+        self.assertEqual(outputs['b']['data'], 8)
+        self.assertEqual(python.code_cache.misses, misses)
+        self.assertGreater(python.code_cache.hits, 0)
+
+    def test_syntax_error(self):
+        self.task['script'] = 'b = ('
+        with self.assertRaisesRegexp(Exception, 'Script:\n1: b = \\('):
+            run(self.task, {'a': {'format': 'number', 'data': 3}})
+
+
+class TestConversionCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = cache.ConversionCache(
+            memory_limit=1024, directory=self.tmpdir, disk_limit=1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_key(self):
+        key = cache.ConversionCache.key('string', 'text', 'json', 'a')
+        self.assertEqual(
+            key, cache.ConversionCache.key('string', 'text', 'json', 'a'))
+        self.assertNotEqual(
+            key, cache.ConversionCache.key('string', 'text', 'json', 'b'))
+        self.assertNotEqual(
+            key, cache.ConversionCache.key('string', 'text', 'json', u'a'))
+        self.assertIsNone(
+            cache.ConversionCache.key('table', 'rows', 'csv', {}))
+
+    def test_tiers(self):
+        rows = {'fields': ['a'], 'rows': [{'a': 1}]}
+        self.cache.put('key', rows)
+        found, data = self.cache.get('key')
+        self.assertTrue(found)
+        self.assertEqual(data, rows)
+        self.assertIsNot(data, rows)
+
+        # Results are restored from disk once evicted from memory
+        self.cache.memory.clear()
+        self.assertEqual(self.cache.get('key'), (True, rows))
+        self.assertIn('key', self.cache.memory)
+        self.assertEqual(self.cache.get('missing'), (False, None))
+        self.assertEqual(self.cache.hits, 2)
+        self.assertEqual(self.cache.misses, 1)
+
+        # Unpicklable results are not cached
+        self.cache.put('lambda', lambda: None)
+        self.assertEqual(self.cache.get('lambda'), (False, None))
+
+    def test_disk_eviction(self):
+        on_cull = mock.Mock()
+        store = cache.DiskStore(self.tmpdir, 10, on_cull=on_cull)
+        self.assertTrue(store.put('a', 'x' * 6))
+        os.utime(store.path('a'), (0, 0))
+        self.assertFalse(on_cull.called)
+        self.assertTrue(store.put('b', 'x' * 6))
+        self.assertIsNone(store.get('a'))
+        self.assertEqual(store.get('b'), 'x' * 6)
+        on_cull.assert_called_once_with(['a'])
+
+        # Values larger than the store are not stored
+        self.assertFalse(store.put('c', 'x' * 11))
+        self.assertIsNone(store.get('c'))
+
+    def test_convert(self):
+        csv = 'a,b\n1,2\n3,4\n'
+        with mock.patch.object(cache, 'conversion_cache', self.cache):
+            first = convert('table', {'format': 'csv', 'data': csv},
+                            {'format': 'rows'})
+            self.assertEqual(self.cache.misses, 1)
+            first['data']['rows'].append('modified')
+
+            with mock.patch('girder_worker.core.run') as run:
+                second = convert('table', {'format': 'csv', 'data': csv},
+                                 {'format': 'rows'})
+                self.assertFalse(run.called)
+
+            self.assertEqual(self.cache.hits, 1)
+            self.assertEqual(second['data'], {
+                'fields': ['a', 'b'],
+                'rows': [{'a': 1, 'b': 2}, {'a': 3, 'b': 4}]
+            })
+
+            # Paths can not be content addressed
+            convert('table', {'format': 'csv', 'data': csv},
+                    {'format': 'rows'}, fetch=False,
+                    task_input={'target': 'filepath'})
+            self.assertEqual(self.cache.misses, 1)
+
+
+class TestStepCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = cache.StepCache(memory_limit=1 << 20)
+
+        def step(name, script):
+            return {
+                'name': name,
+                'task': {
+                    'inputs': [{'name': 'a', 'type': 'number',
+                                'format': 'number'}],
+                    'outputs': [{'name': 'b', 'type': 'number',
+                                 'format': 'number'}],
+                    'mode': 'python',
+                    'script': script
+                }
+            }
+
+        self.workflow = {
+            'mode': 'workflow',
+            'inputs': [{'name': 'x', 'type': 'number', 'format': 'number'}],
+            'outputs': [{'name': 'y', 'type': 'number', 'format': 'number'}],
+            'steps': [step('first', 'b = a + 1'), step('last', 'b = a * 2')],
+            'connections': [
+                {'name': 'x', 'input_step': 'first', 'input': 'a'},
+                {'output_step': 'first', 'output': 'b',
+                 'input_step': 'last', 'input': 'a'},
+                {'name': 'y', 'output_step': 'last', 'output': 'b'}
+            ]
+        }
+
+    def run_workflow(self, x):
+        job_mgr = mock.Mock()
+        with mock.patch.object(cache, 'step_cache', self.cache):
+            outputs = core_run(
+                self.workflow, {'x': {'format': 'number', 'data': x}},
+                _job_manager=job_mgr)
+        return outputs['y']['data'], job_mgr
+
+    def test_key(self):
+        task = self.workflow['steps'][0]['task']
+        key = cache.StepCache.key(task, {'a': {'format': 'json', 'data': '1'}})
+        self.assertEqual(key, cache.StepCache.key(
+            task, {'a': {'format': 'json', 'data': '1'}}))
+        self.assertNotEqual(key, cache.StepCache.key(
+            task, {'a': {'format': 'number', 'data': 1}}))
+        self.assertNotEqual(key, cache.StepCache.key(
+            dict(task, script='b = a'),
+            {'a': {'format': 'json', 'data': '1'}}))
+        self.assertIsNone(cache.StepCache.key(
+            task, {'a': {'format': 'json', 'uri': 'file://a.json'}}))
+
+    def test_workflow(self):
+        self.assertEqual(self.run_workflow(1)[0], 4)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+
+        result, job_mgr = self.run_workflow(1)
+        self.assertEqual(result, 4)
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 2))
+        job_mgr.write.assert_any_call(
+            'Workflow step cache: 2 hits, 0 misses\n')
+
+        # Only the changed step is run again
+        self.workflow['steps'][1]['task']['script'] = 'b = a * 3'
+        self.assertEqual(self.run_workflow(1)[0], 6)
+        self.assertEqual((self.cache.hits, self.cache.misses), (3, 3))
+
+        # Steps may opt out of caching
+        self.workflow['steps'][0]['cache'] = False
+        self.assertEqual(self.run_workflow(1)[0], 6)
+        self.assertEqual((self.cache.hits, self.cache.misses), (4, 3))
+
+
+class TestInputCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_materialize(self):
+        source = os.path.join(self.tmpdir, 'source')
+        dest = os.path.join(self.tmpdir, 'dest')
+        with open(source, 'w') as f:
+            f.write('data')
+        cache.materialize(source, dest)
+        with open(dest) as f:
+            self.assertEqual(f.read(), 'data')
+
+        # Falls back to copying where the file can not be reflinked, and
+        # never shares an inode with the source
+        with mock.patch('fcntl.ioctl', side_effect=IOError):
+            cache.materialize(source, dest)
+        self.assertEqual(os.stat(dest).st_nlink, 1)
+        with open(dest, 'a') as f:
+            f.write('modified')
+        with open(source) as f:
+            self.assertEqual(f.read(), 'data')
+
+        # Open files are copied through their descriptor
+        with open(source, 'rb') as src:
+            os.remove(source)
+            with mock.patch('fcntl.ioctl', side_effect=IOError):
+                cache.materialize(src, dest)
+        with open(dest) as f:
+            self.assertEqual(f.read(), 'data')
+
+    def test_store(self):
+        input_cache = cache.InputCache(os.path.join(self.tmpdir, 'c'), 10)
+        key = input_cache.key('http://x/a', {'Girder-Token': 't'})
+        self.assertNotEqual(key, input_cache.key('http://x/a'))
+
+        path = os.path.join(self.tmpdir, 'a')
+        with open(path, 'w') as f:
+            f.write('x' * 6)
+        input_cache.store(key, path)
+        self.assertIsNone(input_cache.lookup(key))
+
+        input_cache.store(key, path, etag='"1"', filename='a')
+        entry = input_cache.lookup(key)
+        self.assertEqual(entry['filename'], 'a')
+        self.assertEqual(input_cache.validators(entry),
+                         {'If-None-Match': '"1"'})
+
+        # The store keeps its own copy of the downloaded file
+        self.assertEqual(os.stat(path).st_nlink, 1)
+
+        # Files are evicted once the cache is full
+        os.utime(input_cache.files.path(entry['digest']), (0, 0))
+        with open(path, 'w') as f:
+            f.write('y' * 6)
+        input_cache.store('other', path, last_modified='now')
+        self.assertEqual(os.listdir(input_cache.index), ['other'])
+        self.assertIsNone(input_cache.lookup(key))
+        self.assertIsNotNone(input_cache.lookup('other'))
+
+        # Files too large for the cache are not indexed
+        with open(path, 'w') as f:
+            f.write('z' * 11)
+        input_cache.store('large', path, etag='"2"')
+        self.assertIsNone(input_cache.lookup('large'))
+        self.assertEqual(os.listdir(input_cache.index), ['other'])
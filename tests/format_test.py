@@ -1,8 +1,19 @@
+import mock
+import os
+import shutil
 import sys
+import tempfile
 import unittest
 from girder_worker.tasks import run
-from girder_worker.core.format import (conv_graph, converter_path,
-                                       has_converter,
+from girder_worker.core import convert, events, isvalid
+from girder_worker.core import format
+from girder_worker.core.format import (AnalysisFunction, conv_graph,
+                                       ConverterCost, converter_edges,
+                                       converter_path, get_analysis_function,
+                                       get_routing_table, has_converter,
+                                       import_converters,
+                                       invalidate_routing_table,
+                                       reachable_formats,
                                        Validator, print_conversion_graph,
                                        print_conversion_table)
 from six import StringIO
@@ -127,3 +138,130 @@ class TestFormat(unittest.TestCase):
 
     def test_conversion_table(self):
         print_conversion_table()
+
+    def test_analysis_functions(self):
+        runs = []
+        events.bind('run.before', 'format_test', lambda e: runs.append(e))
+
+        try:
+            self.assertTrue(isvalid('string', {'format': 'text', 'data': 'a'}))
+            self.assertFalse(isvalid('number', {'format': 'number',
+                                                'data': 'a'}))
+            output = convert('string', {'format': 'text', 'data': 'a'},
+                             {'format': 'json'})
+            self.assertEqual(output['data'], '"a"')
+        finally:
+            events.unbind('run.before', 'format_test')
+
+        # Validators and converters were called without a nested run
+        self.assertEqual(runs, [])
+
+        fn = get_analysis_function(self.stringTextValidator)
+        self.assertIsInstance(fn, AnalysisFunction)
+        self.assertTrue(fn('a'))
+        self.assertIsNotNone(get_analysis_function(
+            self.stringTextValidator, Validator('string', 'string')))
+        self.assertIsNone(get_analysis_function(Validator('foo', 'bar')))
+
+        # Analyses that declare they need a temp dir must go through run
+        self.assertFalse(AnalysisFunction.supports(
+            dict(fn.analysis, needs_tempdir=True)))
+        self.assertFalse(AnalysisFunction.supports(
+            dict(fn.analysis, mode='r')))
+
+    def test_routing_table(self):
+        table = get_routing_table()
+        self.assertIs(get_routing_table(), table)
+        self.assertEqual(table[self.stringTextValidator][
+            self.stringTextValidator], (self.stringTextValidator,))
+
+        reachable = reachable_formats(self.stringTextValidator)
+        self.assertIn(Validator('string', 'json'), reachable)
+        self.assertNotIn(self.stringTextValidator, reachable)
+        self.assertTrue(all(v.type == 'string' for v in reachable))
+        self.assertEqual(reachable, sorted(reachable))
+        self.assertEqual(reachable_formats(Validator('foo', 'bar')), [])
+
+        # Paths are rebuilt once the table is invalidated
+        invalidate_routing_table()
+        self.assertIsNot(get_routing_table(), table)
+        self.assertEqual(get_routing_table(), table)
+
+    def test_import_converters_failure(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with open(os.path.join(tmpdir, 'string_to_broken.json'), 'w') as f:
+            f.write('{')
+
+        # The routing table is invalidated even if an import fails
+        table = get_routing_table()
+        cwd = os.getcwd()
+        with self.assertRaises(ValueError):
+            import_converters(tmpdir)
+        self.assertEqual(os.getcwd(), cwd)
+        self.assertIsNot(get_routing_table(), table)
+
+    @mock.patch.object(format, '_has_known_costs', False)
+    def test_converter_cost(self):
+        cost = ConverterCost(fixed=1.0, per_byte=0.5)
+        self.assertTrue(cost.is_known())
+        self.assertEqual(cost.estimate(), 1.0)
+        self.assertEqual(cost.estimate(4), 3.0)
+
+        cost = ConverterCost()
+        self.assertFalse(cost.is_known())
+        for size in range(1, 6):
+            self.assertFalse(format._has_known_costs)
+            cost.record(0.25 + 2.0 * size, size)
+        self.assertTrue(cost.learned)
+        self.assertTrue(format._has_known_costs)
+        self.assertAlmostEqual(cost.estimate(10), 20.25)
+
+        # Samples of unknown size are modeled by their mean time
+        cost = ConverterCost()
+        for seconds in (1.0, 2.0, 3.0, 4.0, 5.0):
+            cost.record(seconds)
+        self.assertAlmostEqual(cost.estimate(), 3.0)
+        self.assertAlmostEqual(cost.estimate(1000), 3.0)
+
+    @mock.patch.object(format, '_has_known_costs', False)
+    def test_converter_cost_spec(self):
+        cost = ConverterCost.from_spec({'per_byte': 1}, 'a to b')
+        self.assertTrue(cost.is_known())
+        self.assertTrue(format._has_known_costs)
+        self.assertEqual(cost.per_byte, 1)
+
+        for spec, message in (
+                ({'fixed': 1, 'perbyte': 2}, 'Unknown key.*perbyte.*a to b'),
+                ({'fixed': '1'}, '"fixed" cost of converter a to b'),
+                ([1, 2], 'converter a to b must be an object')):
+            with self.assertRaisesRegexp(Exception, message):
+                ConverterCost.from_spec(spec, 'a to b')
+
+    def test_cost_weighted_path(self):
+        a, b, c = [Validator('cost_test', f) for f in 'abc']
+        for node in (a, b, c):
+            conv_graph.add_node(node, {})
+        conv_graph.add_edge(a, c)
+        conv_graph.add_edge(a, b)
+        conv_graph.add_edge(b, c)
+        costs = {
+            (a, c): ConverterCost(fixed=0.1, per_byte=1.0),
+            (a, b): ConverterCost(fixed=1.0, per_byte=0.01),
+            (b, c): ConverterCost(fixed=1.0, per_byte=0.01)
+        }
+
+        try:
+            with mock.patch.dict(format._converter_costs, costs), \
+                    mock.patch.object(format, '_has_known_costs', True):
+                self.assertEqual(converter_edges(a, c, size=1), [(a, c)])
+                self.assertEqual(converter_edges(a, c, size=1000),
+                                 [(a, b), (b, c)])
+
+            # Without any known cost, the path with the fewest hops is used
+            format.invalidate_routing_table()
+            self.assertEqual(converter_edges(a, c, size=1000), [(a, c)])
+        finally:
+            for node in (a, b, c):
+                conv_graph.remove_node(node)
+            format.invalidate_routing_table()
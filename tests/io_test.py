@@ -1,8 +1,12 @@
+import BaseHTTPServer
 import copy
 import httmock
+import mock
 import os
+import re
 import girder_worker
 import shutil
+import threading
 import unittest
 
 from girder_worker.core.utils import JobStatus
@@ -293,3 +297,236 @@ with open(file) as f:
             ]
             self.assertEqual(status_changes, [
                 'status=%d' % i for i in expected_statuses])
+
+    def testConcurrentFetch(self):
+        task = {
+            'inputs': [
+                {'id': 'a', 'format': 'text', 'type': 'string'},
+                {'id': 'b', 'format': 'text', 'type': 'string'}
+            ],
+            'outputs': [{'id': 'c', 'format': 'text', 'type': 'string'}],
+            'script': 'c = a + b',
+            'mode': 'python'
+        }
+        inputs = {
+            'a': {'format': 'text', 'url': 'https://foo.com/a'},
+            'b': {'format': 'text', 'url': 'https://foo.com/b'}
+        }
+
+        fetching = []
+        both_fetching = threading.Event()
+
+        @httmock.all_requests
+        def fetchMock(url, request):
+            # Each request only completes once both are in flight
+            fetching.append(url.path)
+            if len(fetching) == 2:
+                both_fetching.set()
+            both_fetching.wait(5)
+            return url.path[1:]
+
+        with httmock.HTTMock(fetchMock):
+            out = girder_worker.core.run(task, inputs=inputs)
+
+        self.assertTrue(both_fetching.is_set())
+        self.assertEqual(out['c']['data'], 'ab')
+
+
+class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves ``server.data``, honoring Range requests if ``server.ranges`` is
+    set, and dropping the connection partway through the first response to
+    each range listed in ``server.drop``. If ``server.changes`` is set, it
+    maps the number of requests served to the ``(data, etag)`` that the
+    resource is replaced with from then on. ``If-Range`` is ignored unless
+    ``server.if_range`` is set.
+    """
+    def do_GET(self):
+        if len(self.server.requests) in self.server.changes:
+            self.server.data, self.server.etag = self.server.changes[
+                len(self.server.requests)]
+        data = self.server.data
+        start, end = 0, len(data)
+        match = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range', ''))
+        if_range = self.headers.get('If-Range')
+        if match and self.server.ranges and (
+                if_range in (None, self.server.etag) or
+                not self.server.if_range):
+            start, end = int(match.group(1)), int(match.group(2)) + 1
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, end - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        if self.server.etag:
+            self.send_header('ETag', self.server.etag)
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+
+        self.server.requests.append((start, end))
+        if (start, end) in self.server.drop:
+            self.server.drop.remove((start, end))
+            end = start + (end - start) // 2
+        self.wfile.write(data[start:end])
+
+    def log_message(self, *args):
+        pass
+
+
+class TestSegmentedDownload(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), RangeHandler)
+        self.server.data = os.urandom(100000)
+        self.server.ranges = True
+        self.server.drop = []
+        self.server.requests = []
+        self.server.etag = None
+        self.server.changes = {}
+        self.server.if_range = True
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.url = 'http://127.0.0.1:%d/data.bin' % self.server.server_port
+        self.task = {
+            'inputs': [{'id': 'a', 'type': 'string', 'format': 'text',
+                        'target': 'filepath'}],
+            'outputs': [{'id': 'b', 'type': 'string', 'format': 'text'}],
+            'script': 'b = open(a, "rb").read()',
+            'mode': 'python'
+        }
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fetch(self, **spec):
+        inputs = {'a': dict(spec, format='text', url=self.url)}
+        with mock.patch('girder_worker.core.io.http.RETRY_BACKOFF', 0):
+            return girder_worker.core.run(self.task, inputs)['b']['data']
+
+    def testSegments(self):
+        self.server.drop = [(25000, 50000)]
+        self.assertEqual(self.fetch(segments=4), self.server.data)
+
+        # The initial request is dropped in favor of the byte ranges, and the
+        # dropped range is resumed from where it left off
+        self.assertEqual(self.server.requests[0], (0, 100000))
+        self.assertEqual(sorted(self.server.requests[1:]), [
+            (0, 25000), (25000, 50000), (37500, 50000), (50000, 75000),
+            (75000, 100000)])
+
+    def testSizeThreshold(self):
+        config = girder_worker.core.io.http.config
+        for key, value in (('http_segmented_min_size', '50000'),
+                           ('http_segments', '2')):
+            self.addCleanup(config.set, 'girder_worker', key,
+                            config.get('girder_worker', key))
+            config.set('girder_worker', key, value)
+
+        self.assertEqual(self.fetch(), self.server.data)
+        self.assertEqual(sorted(self.server.requests[1:]), [
+            (0, 50000), (50000, 100000)])
+
+        # Smaller downloads are read as a single stream
+        self.server.data = self.server.data[:40000]
+        self.server.requests = []
+        self.assertEqual(self.fetch(), self.server.data)
+        self.assertEqual(self.server.requests, [(0, 40000)])
+
+    def testRangesNotSupported(self):
+        self.server.ranges = False
+        self.assertEqual(self.fetch(segments=4), self.server.data)
+
+        # Falls back to a single stream once the server ignores a Range
+        self.assertEqual(set(self.server.requests), {(0, 100000)})
+        self.assertGreaterEqual(len(self.server.requests), 3)
+
+    def testResourceChanged(self):
+        self.server.etag = '"v1"'
+        self.server.drop = [(25000, 50000)]
+        self.assertEqual(self.fetch(segments=4), self.server.data)
+
+        # Ranges are only served from the version that the download started
+        # with, including when a range is resumed
+        self.server.requests = []
+        self.server.changes = {3: (os.urandom(100000), '"v2"')}
+        with self.assertRaisesRegexp(Exception, 'changed during the download'):
+            self.fetch(segments=4)
+
+        # Ranges of another version are detected even if the server ignores
+        # If-Range
+        self.server.requests = []
+        self.server.if_range = False
+        self.server.changes = {0: (self.server.data, '"v3"'),
+                               3: (os.urandom(100000), '"v4"')}
+        with self.assertRaisesRegexp(Exception, 'changed during the download'):
+            self.fetch(segments=4)
+
+
+class TestInputCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = os.path.join(_tmp, 'input_cache')
+        self.cache = girder_worker.core.cache.InputCache(self.dir, 1 << 20)
+        self.content = {'/a.txt': ('"v1"', 'first'), '/b.txt': ('"v1"', 'first')}
+        self.requests = []
+
+        self.task = {
+            'inputs': [{'id': 'a', 'type': 'string', 'format': 'text',
+                        'target': 'filepath'}],
+            'outputs': [{'id': 'b', 'type': 'string', 'format': 'text'}],
+            'script': 'b = open(a).read()',
+            'mode': 'python'
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def fetch(self, path, **spec):
+        @httmock.all_requests
+        def fetchMock(url, request):
+            etag, body = self.content[url.path]
+            self.requests.append((url.path, request.headers.get(
+                'If-None-Match')))
+            if request.headers.get('If-None-Match') == etag:
+                return {'status_code': 304, 'content': '',
+                        'headers': {'ETag': etag}}
+            return {'status_code': 200, 'content': body,
+                    'headers': {'ETag': etag}}
+
+        inputs = {'a': dict(
+            spec, mode='http', format='text', url='http://x' + path)}
+        with httmock.HTTMock(fetchMock), mock.patch.object(
+                girder_worker.core.cache, 'input_cache', self.cache):
+            return girder_worker.core.run(self.task, inputs)['b']['data']
+
+    def testRevalidation(self):
+        self.assertEqual(self.fetch('/a.txt'), 'first')
+        self.assertEqual(self.fetch('/a.txt'), 'first')
+        self.assertEqual(self.requests, [('/a.txt', None), ('/a.txt', '"v1"')])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+        # A changed file is downloaded again
+        self.content['/a.txt'] = ('"v2"', 'second')
+        self.assertEqual(self.fetch('/a.txt'), 'second')
+        self.assertEqual(self.fetch('/a.txt'), 'second')
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 2))
+
+        # Identical contents at different URLs are stored once
+        self.assertEqual(self.fetch('/b.txt'), 'first')
+        self.assertEqual(len(os.listdir(self.cache.files.directory)), 2)
+
+        # Inputs may bypass the cache
+        self.requests = []
+        self.assertEqual(self.fetch('/a.txt', use_cache=False), 'second')
+        self.assertEqual(self.requests, [('/a.txt', None)])
+
+    def testEviction(self):
+        self.fetch('/a.txt')
+        for name in os.listdir(self.cache.files.directory):
+            os.remove(self.cache.files.path(name))
+
+        self.assertEqual(self.fetch('/a.txt'), 'first')
+        self.assertEqual(self.requests, [('/a.txt', None), ('/a.txt', None)])
+        self.assertEqual(self.cache.misses, 2)
@@ -0,0 +1,100 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from girder_worker.core import pool, utils
+
+MARKER = '\x01done\x01'
+
+# A stand-in interpreter that runs each line it reads as a python statement
+# with its stdout and stderr written to files, in the same way the Julia
+# worker does.
+WORKER = r'''
+import sys
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    code, out, err, status = line.rstrip('\n').split('\t')
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = open(out, 'w'), open(err, 'w')
+    message = ''
+    try:
+        exec(code, {})
+    except Exception as e:
+        message = str(e)
+    sys.stdout.close()
+    sys.stderr.close()
+    sys.stdout, sys.stderr = stdout, stderr
+    open(status, 'w').write(message)
+    sys.stdout.write('\n' + sys.argv[1] + '\n')
+    sys.stdout.flush()
+'''
+
+
+class TestInterpreterPool(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.pool = pool.InterpreterPool(
+            [sys.executable, '-c', WORKER, MARKER], MARKER, max_tasks=3)
+
+    def tearDown(self):
+        self.pool.shutdown()
+        shutil.rmtree(self.tmp)
+
+    def run_job(self, code, pipes=None):
+        job_dir = tempfile.mkdtemp(dir=self.tmp)
+        line = '\t'.join((code,) + tuple(
+            os.path.join(job_dir, name)
+            for name in ('stdout', 'stderr', 'status')))
+        pool.run_job(self.pool, [line], job_dir, pipes)
+
+    def test_reuse(self):
+        pids = []
+        for i in range(5):
+            outputs = {'_stdout': {}, '_stderr': {}}
+            pipes = {
+                id: utils.AccumulateDictAdapter(outputs[id], 'script_data')
+                for id in outputs
+            }
+            self.run_job(
+                'import os, sys; print(os.getpid()); '
+                'sys.stderr.write("err")', pipes)
+            pids.append(int(outputs['_stdout']['script_data']))
+            self.assertEqual(outputs['_stderr']['script_data'], 'err')
+
+        # Processes are replaced after max_tasks tasks
+        self.assertEqual(pids[:3], [pids[0]] * 3)
+        self.assertEqual(pids[3:], [pids[3]] * 2)
+        self.assertNotEqual(pids[0], pids[3])
+        self.assertEqual(len(self.pool._idle), 1)
+
+    def test_errors(self):
+        with self.assertRaisesRegexp(Exception, 'Error in task script: bad'):
+            self.run_job('raise Exception("bad")')
+        self.assertEqual(len(self.pool._idle), 1)
+
+        # A process that dies is not reused
+        with self.assertRaisesRegexp(Exception, 'exited unexpectedly'):
+            self.run_job('import os; os._exit(3)')
+        self.assertEqual(len(self.pool._idle), 0)
+
+        self.run_job('pass')
+        self.assertEqual(len(self.pool._idle), 1)
+
+    def test_max_memory(self):
+        self.pool.max_memory = 1
+        process = self.pool._acquire()
+        memory = process.memory()
+        self.pool._release(process)
+        if not memory:
+            self.skipTest('Process memory is not available')
+
+        self.run_job('pass')
+        self.assertEqual(len(self.pool._idle), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,434 @@
+import fcntl
+import girder_worker.core.utils
+import httmock
+import mock
+import os
+import select
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+import urlparse
+from girder_worker.core.io.local import (
+    LocalStreamFetchAdapter, LocalStreamPushAdapter)
+from girder_worker.core.utils import (
+    AccumulateDictAdapter, CyclicDependencyError, JobManager, JobStatus,
+    LogBuffer, MemoryFetchAdapter, numeric_array_input_type,
+    numeric_array_type, read_numeric_array, run_process, StreamFetchAdapter,
+    StreamPushAdapter, ThreadedFetchAdapter, toposort, TopologicalSorter,
+    write_numeric_array)
+
+
+class TestToposort(unittest.TestCase):
+    def test_toposort(self):
+        data = {
+            'a': {'b', 'c'},
+            'b': {'c', 'b'},
+            'c': {'d'}
+        }
+        self.assertEqual(list(toposort(data)), [{'d'}, {'c'}, {'b'}, {'a'}])
+        self.assertEqual(list(toposort({})), [])
+
+        # The input is not modified
+        self.assertEqual(data['b'], {'c', 'b'})
+        self.assertNotIn('d', data)
+
+    def test_sorter(self):
+        sorter = TopologicalSorter({
+            'fit1': {'table'},
+            'fit2': {'table'},
+            'summary': {'fit1', 'fit2'}
+        })
+        self.assertEqual(sorter.get_ready(), ('table',))
+        self.assertEqual(sorter.get_ready(), ())
+        self.assertTrue(sorter.is_active())
+
+        sorter.done('table')
+        self.assertEqual(set(sorter.get_ready()), {'fit1', 'fit2'})
+
+        # Items are ready as soon as their own dependencies are done
+        sorter.done('fit2')
+        self.assertEqual(sorter.get_ready(), ())
+        sorter.done('fit1')
+        self.assertEqual(sorter.get_ready(), ('summary',))
+        sorter.done('summary')
+        self.assertFalse(sorter.is_active())
+
+    def test_cycles(self):
+        data = {
+            'a': {'b'},
+            'b': {'c'},
+            'c': {'d', 'a'},
+            'd': {'c'},
+            'e': set()
+        }
+        with self.assertRaises(CyclicDependencyError) as cm:
+            TopologicalSorter(data)
+        self.assertEqual(cm.exception.cycle, ['c', 'd', 'c'])
+        self.assertIn("'c' -> 'd' -> 'c'", str(cm.exception))
+
+        with self.assertRaises(CyclicDependencyError):
+            list(toposort(data))
+
+
+class TestLogBuffer(unittest.TestCase):
+    def test_unlimited(self):
+        buf = LogBuffer()
+        for i in range(100):
+            buf.write('line %d\n' % i)
+        self.assertEqual(len(buf), len(buf.getvalue()))
+        self.assertEqual(
+            buf.pop(), ''.join('line %d\n' % i for i in range(100)))
+        self.assertEqual(len(buf), 0)
+        self.assertEqual(buf.pop(), '')
+
+        # A limit of 0 or less also means no limit
+        for limit in (0, -1):
+            buf = LogBuffer(limit=limit)
+            buf.write('hello')
+            self.assertEqual(buf.pop(), 'hello')
+
+    def test_truncate(self):
+        buf = LogBuffer(limit=10)
+        buf.write('abcd')
+        buf.write('efgh')
+        self.assertEqual(buf.getvalue(), 'abcdefgh')
+
+        # The middle of the output is left out once the limit is exceeded
+        buf.write('ijkl')
+        self.assertEqual(len(buf), 10)
+        self.assertEqual(
+            buf.getvalue(),
+            'abcde\n... [2 bytes of log output truncated] ...\nhijkl')
+
+        buf.write('mn')
+        buf.write('opqrstuvwxyz')
+        self.assertEqual(len(buf), 10)
+        self.assertEqual(
+            buf.pop(),
+            'abcde\n... [16 bytes of log output truncated] ...\nvwxyz')
+
+        buf.write('abc')
+        self.assertEqual(buf.pop(), 'abc')
+
+    def test_threads(self):
+        buf = LogBuffer()
+        popped = []
+        done = threading.Event()
+
+        def write():
+            for i in range(2000):
+                buf.write('x' * 10)
+
+        def pop():
+            while not done.is_set():
+                popped.append(buf.pop())
+
+        writers = [threading.Thread(target=write) for _ in range(4)]
+        popper = threading.Thread(target=pop)
+        popper.start()
+        for thread in writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        done.set()
+        popper.join()
+        popped.append(buf.pop())
+
+        # No write is lost between reading the buffer and emptying it
+        self.assertEqual(len(''.join(popped)), 4 * 2000 * 10)
+
+
+class TestJobManager(unittest.TestCase):
+    def test_async_updates(self):
+        requests = []
+        sending = threading.Event()
+        release = threading.Event()
+
+        @httmock.urlmatch(netloc='jobstatus', method='PUT')
+        def jobMock(url, request):
+            requests.append(urlparse.parse_qs(request.body))
+            sending.set()
+            release.wait(10)  # simulate a slow server
+            return ''
+
+        with httmock.HTTMock(jobMock):
+            with JobManager(False, url='http://jobstatus/', interval=0,
+                            asynchronous=True) as jm:
+                jm.write('first\n')
+                self.assertTrue(sending.wait(10))
+
+                # These queue up while the first request is in flight
+                jm.write('second\n')
+                jm.updateProgress(total=10, current=1)
+                jm.updateProgress(current=5)
+                jm.updateStatus(JobStatus.RUNNING)
+                jm.write('third\n')
+                release.set()
+
+        # Everything queued during the first request is sent in one batch
+        self.assertEqual(requests[0], {'log': ['first\n']})
+        self.assertEqual(requests[1], {
+            'log': ['second\nthird\n'], 'progressTotal': ['10'],
+            'progressCurrent': ['5'], 'status': [str(JobStatus.RUNNING)]})
+        # The final status is sent before the context is exited
+        self.assertEqual([r['status'] for r in requests if 'status' in r], [
+            [str(JobStatus.RUNNING)], [str(JobStatus.SUCCESS)]])
+
+
+    def test_threads(self):
+        logs = []
+        with JobManager(False, url='http://jobstatus/', interval=0) as jm:
+            jm._send = lambda data: logs.append(data.get('log', ''))
+
+            def write(i):
+                for j in range(500):
+                    jm.write('%d.%d\n' % (i, j))
+                    jm.updateProgress(current=j)
+
+            threads = [threading.Thread(target=write, args=(i,))
+                       for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        lines = ''.join(logs).splitlines()
+        self.assertEqual(sorted(lines), sorted(
+            '%d.%d' % (i, j) for i in range(4) for j in range(500)))
+
+
+class TestAccumulateDictAdapter(unittest.TestCase):
+    def test_memory(self):
+        spec = {}
+        adapter = AccumulateDictAdapter(spec, 'script_data')
+        self.assertEqual(spec['script_data'], '')
+        for chunk in ('a', 'bc', 'def'):
+            adapter.write(chunk)
+        adapter.close()
+        self.assertEqual(spec['script_data'], 'abcdef')
+
+    def test_spill(self):
+        spec = {}
+        adapter = AccumulateDictAdapter(spec, 'script_data', spill_threshold=4)
+        adapter.write('abc')
+        self.assertIsNone(adapter._file)
+        adapter.write('def')
+        adapter.write('ghi')
+        self.assertIsNotNone(adapter._file)
+        self.assertEqual(adapter._chunks, [])
+        adapter.close()
+        self.assertEqual(spec['script_data'], 'abcdefghi')
+
+    def test_memory_limit(self):
+        spec = {}
+        adapter = AccumulateDictAdapter(
+            spec, 'script_data', spill_threshold=4, memory_limit=8)
+        adapter.write('abcd')
+        adapter.write('efghi')
+        self.assertIsNotNone(adapter._file)
+        with self.assertRaisesRegexp(Exception, 'output_memory_limit'):
+            adapter.close()
+        self.assertEqual(spec['script_data'], '')
+        self.assertIsNone(adapter._file)
+
+        # Closing again does nothing
+        adapter.close()
+        self.assertEqual(spec['script_data'], '')
+
+        # The limit does not apply to output written to a path
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, '_stdout')
+        adapter = AccumulateDictAdapter(
+            spec, 'script_data', path=path, memory_limit=8)
+        adapter.write('abcdefghi')
+        adapter.close()
+        self.assertEqual(spec['script_data'], path)
+
+    def test_path(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, '_stdout')
+
+        spec = {}
+        adapter = AccumulateDictAdapter(spec, 'script_data', path=path)
+        adapter.write('abc')
+        adapter.write('def')
+        adapter.close()
+        self.assertEqual(spec['script_data'], path)
+        with open(path) as f:
+            self.assertEqual(f.read(), 'abcdef')
+
+
+class TestNumericArray(unittest.TestCase):
+    def test_type(self):
+        self.assertEqual(numeric_array_type([1, 2L, -3]), 'int64')
+        self.assertEqual(numeric_array_type((1, 2.5)), 'float64')
+        self.assertEqual(numeric_array_type([1, 2 ** 63 - 1]), 'int64')
+        self.assertIsNone(numeric_array_type([]))
+        self.assertIsNone(numeric_array_type([1, True]))
+        self.assertIsNone(numeric_array_type([1, '2']))
+        self.assertIsNone(numeric_array_type('12'))
+
+        # Integers outside the int64 range would be rounded as doubles
+        self.assertIsNone(numeric_array_type([1, 2 ** 64 + 1]))
+        self.assertIsNone(numeric_array_type([0.5, -2 ** 63 - 1]))
+
+    def test_input_type(self):
+        self.assertEqual(numeric_array_input_type(
+            {'format': 'number_list'}, [0.5, 1]), 'float64')
+        self.assertEqual(numeric_array_input_type(
+            {'format': 'integer_list'}, [1, 2]), 'int64')
+
+        # Only number and integer lists are passed as arrays
+        self.assertIsNone(numeric_array_input_type({'format': 'json'}, [1, 2]))
+        self.assertIsNone(numeric_array_input_type({}, [1, 2]))
+
+    def test_round_trip(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'array')
+
+        for values, dtype in (([1, -2, 2 ** 62], 'int64'),
+                              ([0.5, -1e300, 3], 'float64')):
+            write_numeric_array(path, values, dtype)
+            self.assertEqual(os.path.getsize(path), 8 * len(values))
+            self.assertEqual(read_numeric_array(path, dtype), values)
+
+
+class TestRunProcess(unittest.TestCase):
+    def test_large_input_and_output(self):
+        # The child echoes its input while it is still being written, which
+        # deadlocks unless writing to its stdin and reading from its stdout
+        # are interleaved.
+        data = os.urandom(4 * 1024 * 1024)
+        outputs = {}
+        script = ('import sys\n'
+                  'for chunk in iter(lambda: sys.stdin.read(4096), ""):\n'
+                  '    sys.stdout.write(chunk)\n')
+        p = run_process(
+            [sys.executable, '-c', script],
+            output_pipes={'_stdout': AccumulateDictAdapter(
+                {}, 'out', outputs)},
+            input_pipes={'_stdin': MemoryFetchAdapter({}, data)})
+        self.assertEqual(p.returncode, 0)
+        self.assertEqual(outputs['out'], data)
+
+    def test_slow_input(self):
+        # The input adapter blocks until the child's output has been drained,
+        # which never happens if reading the input holds up the output pipes.
+        size = 1024 * 1024
+        drained = threading.Event()
+        waited = []
+
+        class SlowInput(StreamFetchAdapter):
+            def __init__(self):
+                super(SlowInput, self).__init__({})
+                self.chunks = ['abc', '']
+
+            def read(self, buf_len):
+                if not waited:
+                    waited.append(drained.wait(10))
+                return self.chunks.pop(0)
+
+        class Output(StreamPushAdapter):
+            received = 0
+
+            def write(self, buf):
+                self.received += len(buf)
+                if self.received >= size:
+                    drained.set()
+
+        output = Output({})
+        script = ('import sys\n'
+                  'sys.stdout.write("x" * %d)\n'
+                  'sys.stdout.flush()\n'
+                  'sys.stderr.write(sys.stdin.read())\n' % size)
+        outputs = {}
+        run_process(
+            [sys.executable, '-c', script],
+            output_pipes={
+                '_stdout': output,
+                '_stderr': AccumulateDictAdapter({}, 'err', outputs)},
+            input_pipes={'_stdin': SlowInput()})
+        self.assertEqual(waited, [True])
+        self.assertEqual(output.received, size)
+        self.assertEqual(outputs['err'], 'abc')
+
+    def test_threaded_fetch_adapter(self):
+        class Failing(StreamFetchAdapter):
+            def read(self, buf_len):
+                raise IOError('connection reset')
+
+        adapter = ThreadedFetchAdapter(MemoryFetchAdapter({}, 'abcdef'), 4)
+        chunks = []
+        while True:
+            if not adapter.ready():
+                select.select([adapter.fileno()], [], [], 10)
+            chunks.append(adapter.read(3))
+            if not chunks[-1]:
+                break
+        self.assertEqual(chunks, ['abc', 'd', 'ef', ''])
+        adapter.close()
+
+        # Errors are raised from read rather than on the reader thread
+        adapter = ThreadedFetchAdapter(Failing({}))
+        select.select([adapter.fileno()], [], [], 10)
+        with self.assertRaises(IOError):
+            adapter.read(3)
+        adapter.close()
+
+    def test_local_file_streams(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        source = os.path.join(tmpdir, 'source')
+        data = os.urandom(1024 * 1024)
+        with open(source, 'wb') as f:
+            f.write(data)
+
+        def cat(target):
+            return run_process(
+                ['cat'], buf_len=4096,
+                output_pipes={'_stdout': LocalStreamPushAdapter(
+                    {'path': target})},
+                input_pipes={'_stdin': LocalStreamFetchAdapter(
+                    {'path': source})})
+
+        # Data is copied between the files and pipes in the kernel
+        utils = girder_worker.core.utils
+        with mock.patch.object(utils, '_libc_sendfile',
+                               wraps=utils._libc_sendfile) as sendfile, \
+                mock.patch.object(utils, '_libc_splice',
+                                  wraps=utils._libc_splice) as splice:
+            p = cat(os.path.join(tmpdir, 'zero_copy'))
+        self.assertEqual(p.returncode, 0)
+        if utils._libc_sendfile is not None:
+            self.assertTrue(sendfile.called)
+            self.assertTrue(splice.called)
+        with open(os.path.join(tmpdir, 'zero_copy'), 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+        # and by reading and writing where that is not possible
+        with mock.patch.object(utils, '_libc_sendfile', None), \
+                mock.patch.object(utils, '_libc_splice', None):
+            p = cat(os.path.join(tmpdir, 'copy'))
+        self.assertEqual(p.returncode, 0)
+        with open(os.path.join(tmpdir, 'copy'), 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'Linux only')
+    def test_pipe_size(self):
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+        self.addCleanup(os.close, w)
+        girder_worker.core.utils._set_pipe_size(w, 1024 * 1024)
+        self.assertEqual(fcntl.fcntl(w, 1032), 1024 * 1024)  # F_GETPIPE_SZ
+
+    def test_idle_wait(self):
+        # Waiting on a quiet process should not keep this process busy
+        before = sum(os.times()[:2])
+        p = run_process([sys.executable, '-c', 'import time; time.sleep(1)'])
+        self.assertEqual(p.returncode, 0)
+        self.assertLess(sum(os.times()[:2]) - before, 0.5)
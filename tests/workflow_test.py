@@ -1,6 +1,9 @@
 from girder_worker.tasks import run
 from girder_worker.core import load
+import girder_worker.core
+import mock
 import os
+import threading
 import unittest
 
 
@@ -358,6 +361,112 @@ class TestWorkflow(unittest.TestCase):
         self.assertEqual(outputs['result']['format'], 'number')
         self.assertEqual(outputs['result']['data'], (10+3)*(2+2))
 
+    def test_parallel_workflow(self):
+        self.workflow['max_parallelism'] = 4
+        outputs = run(
+            self.workflow,
+            inputs={
+                'x': {'format': 'json', 'data': '1'},
+                'y': {'format': 'number', 'data': 2}
+            })
+        self.assertEqual(outputs['result']['format'], 'number')
+        self.assertEqual(outputs['result']['data'], (1+3)*(2+2))
+
+        self.multi_input['max_parallelism'] = 2
+        outputs = run(
+            self.multi_input,
+            inputs={
+                'x': {'format': 'number', 'data': 2},
+                'y': {'format': 'number', 'data': 3}
+            })
+        self.assertEqual(outputs['result']['data'], (2*2)+(3*3))
+
+    def test_parallel_steps_overlap(self):
+        def rendezvous(mine, theirs):
+            return {
+                'inputs': [
+                    {'name': mine, 'type': 'python', 'format': 'object'},
+                    {'name': theirs, 'type': 'python', 'format': 'object'}
+                ],
+                'outputs': [
+                    {'name': 'met', 'type': 'boolean', 'format': 'boolean'}
+                ],
+                'script': '%s.set()\nmet = %s.wait(10)' % (mine, theirs),
+                'mode': 'python'
+            }
+
+        steps = ('a', 'b')
+        workflow = {
+            'mode': 'workflow',
+            'max_parallelism': 2,
+            'inputs': [
+                {'name': name, 'type': 'python', 'format': 'object'}
+                for name in steps
+            ],
+            'outputs': [
+                {'name': 'met_' + name, 'type': 'boolean',
+                 'format': 'boolean'}
+                for name in steps
+            ],
+            'steps': [
+                {'name': 'a', 'task': rendezvous('a', 'b')},
+                {'name': 'b', 'task': rendezvous('b', 'a')}
+            ],
+            'connections': [
+                {'name': name, 'input_step': step, 'input': name}
+                for name in steps for step in steps
+            ] + [
+                {'name': 'met_' + step, 'output_step': step, 'output': 'met'}
+                for step in steps
+            ]
+        }
+
+        # Neither step can finish unless both are running at the same time
+        outputs = run(workflow, inputs={
+            name: {'format': 'object', 'data': threading.Event()}
+            for name in steps
+        })
+        self.assertTrue(outputs['met_a']['data'])
+        self.assertTrue(outputs['met_b']['data'])
+
+    def test_handoff(self):
+        # The multiply inputs are fed from step outputs of the same type and
+        # format, so they should be handed off without being revalidated,
+        # while the inputs of the first steps must still be validated.
+        isvalid = girder_worker.core.isvalid
+        with mock.patch('girder_worker.core.isvalid',
+                        side_effect=isvalid) as mock_isvalid:
+            outputs = run(
+                self.workflow,
+                inputs={
+                    'x': {'format': 'json', 'data': '1'},
+                    'y': {'format': 'number', 'data': 2}
+                })
+        self.assertEqual(outputs['result']['data'], (1+3)*(2+2))
+
+        validated_inputs = [
+            call[1]['task_input']['name']
+            for call in mock_isvalid.call_args_list
+            if 'task_input' in call[1]]
+        self.assertIn('a', validated_inputs)
+        self.assertNotIn('in1', validated_inputs)
+        self.assertNotIn('in2', validated_inputs)
+
+        # Handed off data that does not match the input format is converted
+        b, handed_off = girder_worker.core.executors.workflow._handoff(
+            {'format': 'json', 'data': '1'},
+            {'name': 'b', 'type': 'number', 'format': 'json'},
+            {'name': 'a', 'type': 'number', 'format': 'number'})
+        self.assertEqual(b, {'format': 'json', 'data': '1'})
+        self.assertFalse(handed_off)
+
+        # Callers can not mark their own inputs as already validated
+        task = self.workflow['steps'][0]['task']
+        with self.assertRaisesRegexp(Exception, 'not in the expected type'):
+            run(task, inputs={
+                name: {'format': 'number', 'data': 'nan?', '_validated': True}
+                for name in (i['name'] for i in task['inputs'])})
+
     def test_multi_input(self):
         outputs = run(
             self.multi_input,